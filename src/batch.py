@@ -0,0 +1,328 @@
+"""This module contains a Levenberg-Marquardt solver that fits many small
+independent problems at once, e.g. thousands of single buffers fit to the
+same model with the same starting parameters.
+
+Fitting each buffer with lmfit costs far more in Python overhead than in
+arithmetic, since each problem only has a few parameters and points. Here
+the parameters, residuals, Jacobians and damping of all the problems are
+kept in stacked arrays, every step is solved for all of them with one
+batched np.linalg.solve, and the model is evaluated for all of them with one
+broadcast call. A problem stops taking steps once it has converged, while
+the others go on.
+
+Bounds are handled with the same transformation lmfit uses for leastsq, and
+the convergence tests follow MINPACK's, so results match per-buffer fits
+with lmfit's default method to within its tolerances."""
+
+from src import fit
+from src import models
+from src import params
+
+import time
+
+import numpy as np
+from lmfit.minimizer import MinimizerResult
+
+# status of each problem while fitting, and what it means once finished.
+RUNNING = 0
+MESSAGES = {
+    1: "Both actual and predicted relative reductions in the sum of squares"
+       " are at most ftol.",
+    2: "The relative error between two consecutive iterates is at most "
+       "xtol.",
+    3: "The damping grew so large that no step reduces the sum of squares.",
+    4: "The number of calls to the function has reached max_nfev.",
+}
+CONVERGED = {1, 2}
+
+
+def batchable(model, parameters):
+    """True if fits of the model with these parameters can be run by
+    batch_fit: the model must broadcast (see models.broadcasts) over the x
+    values of many problems at once, so it can't be one that needs a single
+    grid of x values (see models.needs_uniform_x), and no parameter may be
+    constrained by an expr."""
+    if isinstance(model, str):
+        model = models.get_models(model)
+    return (models.broadcasts(model) and
+            not models.needs_uniform_x(model) and
+            not any(par.expr for par in parameters.values()))
+
+
+def to_internal(values, lower, upper):
+    """Map values (n problems x k parameters) inside their bounds to the
+    unbounded values the solver varies, as lmfit's Parameter.setup_bounds
+    does for each parameter."""
+    values = np.clip(np.array(values, dtype=np.float64), lower, upper)
+    for j, (a, b) in enumerate(zip(lower, upper)):
+        v = values[:, j]
+        if a == -np.inf and b == np.inf:
+            continue
+        elif b == np.inf:
+            values[:, j] = np.sqrt((v - a + 1.0) ** 2 - 1)
+        elif a == -np.inf:
+            values[:, j] = np.sqrt((b - v + 1.0) ** 2 - 1)
+        else:
+            values[:, j] = np.arcsin(2 * (v - a) / (b - a) - 1)
+    return values
+
+
+def from_internal(internal, lower, upper):
+    """Inverse of to_internal."""
+    values = np.array(internal, dtype=np.float64)
+    for j, (a, b) in enumerate(zip(lower, upper)):
+        u = internal[:, j]
+        if a == -np.inf and b == np.inf:
+            continue
+        elif b == np.inf:
+            values[:, j] = a - 1.0 + np.sqrt(u * u + 1)
+        elif a == -np.inf:
+            values[:, j] = b + 1 - np.sqrt(u * u + 1)
+        else:
+            values[:, j] = a + (np.sin(u) + 1) * (b - a) / 2.0
+    return values
+
+
+def forward_jacobian(residual, values, resid, rows):
+    """Estimate the Jacobians of the residuals of the problems in rows by
+    forward differences, stepping each parameter of every problem at once,
+    as MINPACK does. Returns an array of shape (len(rows), m, k)."""
+    eps = np.sqrt(np.finfo(np.float64).eps)
+    nrows, k = values.shape
+    jac = np.empty((nrows, resid.shape[1], k))
+    for j in range(k):
+        h = eps * np.abs(values[:, j])
+        h[h == 0] = eps
+        stepped = values.copy()
+        stepped[:, j] += h
+        jac[:, :, j] = (residual(stepped, rows) - resid) / h[:, None]
+    return jac
+
+
+def levenberg_marquardt(residual, start, lower, upper, max_nfev=None,
+                        ftol=1.5e-8, xtol=1.5e-8):
+    """Minimize the sum of squares of the residuals of n independent
+    problems, each with the same k parameters, at once.
+
+    Parameters
+    ----------
+        residual: function
+            residual(values, rows) returns the residuals, shape (len(rows),
+            m), of the problems in rows (an integer array) when their
+            parameters are values, shape (len(rows), k).
+        start: np.ndarray (2D)
+            Starting values, shape (n, k).
+        lower, upper: np.ndarray (1D)
+            Bounds of each of the k parameters, shared by every problem.
+        max_nfev: int, optional
+            Most calls of the residual per problem (counting each problem
+            separately). Defaults to 2000 * (k + 1), like lmfit's leastsq.
+        ftol, xtol: float
+            Relative tolerances on the sum of squares and the parameters,
+            as in scipy.optimize.leastsq.
+
+    Returns
+    -------
+        values: np.ndarray (2D)
+            Best values of the parameters, shape (n, k).
+        resid: np.ndarray (2D)
+            Residuals at values, shape (n, m).
+        nfev: np.ndarray (1D)
+            How many times the residuals of each problem were calculated.
+        status: np.ndarray (1D)
+            Why each problem stopped, a key of MESSAGES.
+    """
+    n, k = start.shape
+    if max_nfev is None:
+        max_nfev = 2000 * (k + 1)
+
+    def internal_residual(u, rows):
+        return residual(from_internal(u, lower, upper), rows)
+
+    everything = np.arange(n)
+    u = to_internal(start, lower, upper)
+    resid = internal_residual(u, everything)
+    cost = np.einsum('nm,nm->n', resid, resid)
+    nfev = np.ones(n, dtype=int)
+    damping = np.full(n, 1e-3)
+    status = np.full(n, RUNNING)
+
+    jac = np.empty(resid.shape + (k,))
+    stale = np.ones(n, dtype=bool)  # whose Jacobian must be recalculated
+    while True:
+        active = np.flatnonzero(status == RUNNING)
+        if not active.size:
+            break
+
+        rows = active[stale[active]]
+        if rows.size:
+            jac[rows] = forward_jacobian(internal_residual, u[rows],
+                                         resid[rows], rows)
+            nfev[rows] += k
+            stale[rows] = False
+
+        # solve (J^T J + damping * diag(J^T J)) step = -J^T r for every
+        # active problem at once.
+        J = jac[active]
+        r = resid[active]
+        hess = np.einsum('nmk,nml->nkl', J, J)
+        grad = np.einsum('nmk,nm->nk', J, r)
+        scale = np.maximum(np.diagonal(hess, axis1=1, axis2=2), 1e-300)
+        damped = hess + (damping[active, None] * scale)[:, :, None] * np.eye(k)
+        try:
+            step = np.linalg.solve(damped, -grad[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('nkl,nl->nk', np.linalg.pinv(damped), -grad)
+
+        trial = u[active] + step
+        trial_resid = internal_residual(trial, active)
+        nfev[active] += 1
+        trial_cost = np.einsum('nm,nm->n', trial_resid, trial_resid)
+
+        old = cost[active]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            actual = (old - trial_cost) / old
+            predicted = -(2 * np.einsum('nk,nk->n', grad, step) +
+                          np.einsum('nk,nkl,nl->n', step, hess, step)) / old
+        better = np.isfinite(trial_cost) & (trial_cost < old)
+        small_step = (np.linalg.norm(step, axis=1) <=
+                      xtol * (xtol + np.linalg.norm(u[active], axis=1)))
+        small_change = ((np.abs(actual) <= ftol) & (predicted <= ftol) &
+                        (actual <= 2 * predicted))
+        # a perfect fit can't get any better
+        small_change |= old == 0
+
+        # take the steps that helped and trust the model more next time.
+        took = active[better]
+        u[took] = trial[better]
+        resid[took] = trial_resid[better]
+        cost[took] = trial_cost[better]
+        stale[took] = True
+        damping[took] = np.maximum(damping[took] / 10, 1e-15)
+        damping[active[~better]] *= 10
+
+        done = np.full(active.size, RUNNING)
+        done[small_step] = 2
+        done[small_change] = 1
+        done[(done == RUNNING) & (damping[active] > 1e16)] = 3
+        done[(done == RUNNING) & (nfev[active] >= max_nfev)] = 4
+        status[active] = done
+
+    return from_internal(u, lower, upper), resid, nfev, status
+
+
+def batch_fit(problems, model, parameters, max_nfev=None, ftol=1.5e-8,
+              xtol=1.5e-8):
+    """Fit many independent datasets to the same model with the same starting
+    parameters, all at once with levenberg_marquardt. Datasets of the same
+    length are fit together. Results are equivalent to calling fit.fit on
+    each dataset on its own with lmfit's default method, leastsq.
+
+    Parameters
+    ----------
+        problems: list
+            A list of (data, x) pairs, each fit on its own. data has shape
+            (1, len(x)), as for a fit of a single buffer.
+        model: string OR function object
+            The model function that data should be fit to. It must be able
+            to broadcast (see batchable).
+        parameters: lmfit.Parameters
+            Starting parameters for every fit, named as for a single buffer
+            (e.g. amp_0). None may have an expr.
+        max_nfev: int, optional
+            Most calls of the model for each fit.
+        ftol, xtol: float
+            Relative tolerances on the sum of squares and the parameters.
+
+    Returns
+    -------
+        A list of (result, data, x, model) tuples, in the same order as
+        problems, like fit.fit_many.
+    """
+    if isinstance(model, str):
+        model = models.get_models(model)
+    if not batchable(model, parameters):
+        raise ValueError("Only models that broadcast, with no parameters "
+                         "constrained by expr, can be fit in a batch.")
+
+    layout = fit.ParameterLayout(parameters, 1)
+    values = layout.values(parameters)
+    free = [(arg, slot) for arg, slot in layout.slots[0]
+            if parameters[layout.names[slot]].vary]
+    fixed = {arg: values[slot] for arg, slot in layout.slots[0]
+             if not parameters[layout.names[slot]].vary}
+    var_names = [layout.names[slot] for _, slot in free]
+    lower = np.asarray([parameters[name].min for name in var_names], float)
+    upper = np.asarray([parameters[name].max for name in var_names], float)
+    start = np.asarray([values[slot] for _, slot in free])
+
+    # problems with the same number of points share one stacked array.
+    groups = {}
+    for i, (data, x) in enumerate(problems):
+        groups.setdefault(len(x), []).append(i)
+
+    fits = [None] * len(problems)
+    for members in groups.values():
+        began = time.perf_counter()
+        xs = np.asarray([problems[i][1] for i in members], dtype=np.float64)
+        ys = np.asarray([np.ravel(problems[i][0]) for i in members],
+                        dtype=np.float64)
+
+        def evaluate(values, rows):
+            kwargs = dict(fixed)
+            for j, (arg, _) in enumerate(free):
+                kwargs[arg] = values[:, j, None]
+            return np.broadcast_to(model(xs[rows], **kwargs), ys[rows].shape)
+
+        def residual(values, rows):
+            return evaluate(values, rows) - ys[rows]
+
+        best, resid, nfev, status = levenberg_marquardt(
+            residual, np.tile(start, (len(members), 1)), lower, upper,
+            max_nfev=max_nfev, ftol=ftol, xtol=xtol)
+
+        # uncertainties come from the Jacobian w.r.t. the parameters
+        # themselves, not the unbounded values the solver varied.
+        rows = np.arange(len(members))
+        jac = forward_jacobian(residual, best, resid, rows)
+
+        seconds = (time.perf_counter() - began) / len(members)
+        for row, i in enumerate(members):
+            result = batch_result(parameters, var_names, best[row],
+                                  resid[row], jac[row], nfev[row],
+                                  status[row])
+            result.layout = layout
+            stats = fit.FitStats()
+            stats.ncalls = int(nfev[row])
+            stats.wall_seconds = seconds
+            result.stats = stats
+            data, x = problems[i]
+            fits[i] = (result, data, x, model)
+    return fits
+
+
+def batch_result(parameters, var_names, best, resid, jac, nfev, status):
+    """Return a MinimizerResult for one problem of a batch, filled in as
+    lmfit fills in the result of a fit."""
+    result = MinimizerResult()
+    result.method = 'batch_leastsq'
+    result.params = params.deep_copy(parameters)
+    result.var_names = list(var_names)
+    result.nvarys = len(var_names)
+    result.init_vals = [parameters[name].value for name in var_names]
+    for name, value in zip(var_names, best):
+        par = result.params[name]
+        par.init_value = par.value
+        par.value = value
+        par.stderr = None
+        par.correl = None
+    result.nfev = int(nfev)
+    result.status = int(status)
+    result.success = status in CONVERGED
+    result.aborted = False
+    result.message = MESSAGES[status]
+    result.errorbars = False
+    fit.set_statistics(result, resid)
+    if result.nvarys:
+        fit.set_uncertainties(result, jac)
+    return result
@@ -0,0 +1,250 @@
+"""This module contains benchmarks of the fitting routines in the fit module.
+They are not run with the tests. To run them all:
+
+    python -m src.benchmarks
+
+Each benchmark prints a table showing how the time taken grows with the
+number of buffers being fit."""
+
+from src import batch
+from src import fit
+from src import models
+
+import time
+import tracemalloc
+
+import numpy as np
+from lmfit import Parameters
+
+# how many buffers to benchmark with
+BUFFER_COUNTS = (1, 10, 50, 100, 200, 500)
+
+
+def make_global_problem(nbufs, model, npoints=100, seed=0):
+    """Create noisy data for nbufs buffers, and Parameters for a global fit of
+    that data to the model. The first parameter of the model is linked across
+    all buffers, as a user would do in the parameters window.
+
+    Parameters
+    ----------
+        nbufs: int
+            How many buffers (datasets) should be made.
+        model: function object
+            A model function from src.models.
+        npoints: int
+            How many points each buffer has.
+        seed: int
+            Seed for the random noise added to the data.
+
+    Returns
+    -------
+        data: np.ndarray (2D)
+        x: np.ndarray (1D)
+        parameters: lmfit.Parameters
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0.0, 8.0, npoints)
+    defaults = models.default_values(model)
+
+    data = np.asarray([model(x, **defaults) for _ in range(nbufs)])
+    data += rng.normal(0.0, 0.01 * (np.abs(data).max() or 1.0), data.shape)
+
+    linked = list(defaults)[0]
+    parameters = Parameters()
+    for i in range(nbufs):
+        for name, value in defaults.items():
+            expr = None
+            if i > 0 and name == linked:
+                expr = "{0}_0".format(name)
+            parameters.add("{0}_{1}".format(name, i), value=value, expr=expr)
+
+    return data, x, parameters
+
+
+def time_calls(f, ncalls):
+    """Return the mean time in seconds taken by f() over ncalls calls."""
+    start = time.perf_counter()
+    for _ in range(ncalls):
+        f()
+    return (time.perf_counter() - start) / ncalls
+
+
+def benchmark_broadcast(model=models.two_state_equilibrium_chemical_denaturation,
+                        buffer_counts=BUFFER_COUNTS, ncalls=50):
+    """Compare one call of the objective with the model evaluated once per
+    buffer against one call with the model broadcast over all buffers."""
+    print("\nobjective: per-buffer loop vs broadcast ({0})"
+          "".format(model.__name__))
+    print("{0:>8}{1:>16}{2:>16}{3:>10}".format("buffers", "loop (ms)",
+                                               "broadcast (ms)", "speedup"))
+
+    for nbufs in buffer_counts:
+        data, x, parameters = make_global_problem(nbufs, model)
+        loop = fit.ParameterLayout(parameters, nbufs, broadcast=False)
+        bcast = fit.ParameterLayout(parameters, nbufs, broadcast=True)
+
+        t_loop = time_calls(
+            lambda: fit.objective(parameters, x, data, model, loop), ncalls)
+        t_bcast = time_calls(
+            lambda: fit.objective(parameters, x, data, model, bcast), ncalls)
+
+        print("{0:>8}{1:>16.3f}{2:>16.3f}{3:>10.1f}".format(
+            nbufs, 1000 * t_loop, 1000 * t_bcast, t_loop / t_bcast))
+
+
+def allocating_objective(parameters, x, data, model, layout):
+    """The objective as it was before fits had WorkBuffers: new arrays for
+    the residuals and for each dataset's model, then a flattened copy."""
+    values = layout.values(parameters)
+    resid = 0.0 * data[:]
+    for i in range(data.shape[0]):
+        resid[i, :] = data[i, :] - model(x, **layout.arguments(values, i))
+    return resid.flatten()
+
+
+def peak_memory(f):
+    """Return the peak memory in bytes allocated during one call of f()."""
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_work_buffers(model=models.two_state_equilibrium_chemical_denaturation,
+                           buffer_counts=(1, 5, 20), npoints=100000,
+                           ncalls=20):
+    """Compare the time and peak memory of one call of the objective that
+    allocates new arrays every call against one that uses the
+    WorkBuffers of the fit, for long (stopped-flow sized) buffers."""
+    print("\nobjective: allocating vs work buffers ({0}, {1} points per "
+          "buffer)".format(model.__name__, npoints))
+    print("{0:>8}{1:>14}{2:>14}{3:>10}{4:>14}{5:>14}".format(
+        "buffers", "alloc (ms)", "work (ms)", "speedup", "alloc (MB)",
+        "work (MB)"))
+
+    for nbufs in buffer_counts:
+        data, x, parameters = make_global_problem(nbufs, model,
+                                                  npoints=npoints)
+        layout = fit.ParameterLayout(parameters, nbufs)
+        work = fit.WorkBuffers(data, model)
+
+        def alloc():
+            return allocating_objective(parameters, x, data, model, layout)
+
+        def work_buffers():
+            return fit.objective(parameters, x, data, model, layout, work)
+
+        t_alloc = time_calls(alloc, ncalls)
+        t_work = time_calls(work_buffers, ncalls)
+        m_alloc = peak_memory(alloc)
+        m_work = peak_memory(work_buffers)
+
+        print("{0:>8}{1:>14.3f}{2:>14.3f}{3:>10.1f}{4:>14.2f}{5:>14.2f}"
+              "".format(nbufs, 1000 * t_alloc, 1000 * t_work,
+                        t_alloc / t_work, m_alloc / 1e6, m_work / 1e6))
+
+
+def benchmark_batch(model=models.gaussian_1d, buffer_counts=(10, 100, 1000),
+                    npoints=50):
+    """Compare fitting many single buffers one at a time with fit.fit
+    against fitting them all at once with batch.batch_fit."""
+    print("\nindependent fits: one at a time vs batch ({0}, {1} points per "
+          "buffer)".format(model.__name__, npoints))
+    print("{0:>8}{1:>16}{2:>16}{3:>10}".format("buffers", "one by one (s)",
+                                               "batch (s)", "speedup"))
+
+    for nbufs in buffer_counts:
+        problems = []
+        for seed in range(nbufs):
+            data, x, parameters = make_global_problem(1, model, npoints,
+                                                      seed=seed)
+            problems.append((data, x))
+        for par in parameters.values():
+            par.value *= 1.2
+
+        start = time.perf_counter()
+        for data, x in problems:
+            fit.fit(data, x, model, parameters)
+        t_single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch.batch_fit(problems, model, parameters)
+        t_batch = time.perf_counter() - start
+
+        print("{0:>8}{1:>16.3f}{2:>16.3f}{3:>10.1f}".format(
+            nbufs, t_single, t_batch, t_single / t_batch))
+
+
+def benchmark_reconvolution(model=models.two_exponential,
+                            point_counts=(1000, 4000, 16000), ncalls=20):
+    """Compare convolving a model with an instrument response directly,
+    with np.convolve, against a reconvolved model, which uses FFTs."""
+    print("\nreconvolution: direct vs FFT ({0})".format(model.__name__))
+    print("{0:>8}{1:>16}{2:>16}{3:>10}".format("points", "direct (ms)",
+                                               "fft (ms)", "speedup"))
+
+    for npoints in point_counts:
+        x = np.linspace(0.0, 50.0, npoints)
+        irf = np.exp(-0.5 * ((x - 3.0) / 0.4) ** 2)
+        irf /= irf.sum()
+        reconvolved = models.reconvolved_model(model, x, irf)
+        reconvolved(x)  # transforms the instrument response
+
+        t_direct = time_calls(
+            lambda: np.convolve(irf, model(x))[:npoints], ncalls)
+        t_fft = time_calls(lambda: reconvolved(x), ncalls)
+
+        print("{0:>8}{1:>16.3f}{2:>16.3f}{3:>10.1f}".format(
+            npoints, 1000 * t_direct, 1000 * t_fft, t_direct / t_fft))
+
+
+def benchmark_mechanism(scheme='A <=> B -> C',
+                        point_counts=(100, 1000, 10000), ncalls=20):
+    """Compare integrating the rate equations of a kinetic mechanism with
+    scipy's solve_ivp against the closed form of a mechanism model, for new
+    rate constants at every call and for the same ones, which reuse the
+    cached eigendecomposition."""
+    from scipy.integrate import solve_ivp
+    from src import kinetics
+
+    model = kinetics.mechanism_model(scheme, 'benchmark_mechanism')
+    mechanism = model.mechanism
+    rates = np.linspace(2.0, 0.5, len(mechanism.rates))
+    initial = np.zeros(len(mechanism.species))
+    initial[0] = 1.0
+    matrix = mechanism.rate_matrix(rates)
+    model(np.zeros(1))  # loads numpy's linear algebra
+    print("\nkinetic mechanism {0}: ODE vs eigendecomposition".format(
+        scheme))
+    print("{0:>8}{1:>12}{2:>12}{3:>12}{4:>10}".format(
+        "points", "ode (ms)", "new (ms)", "cached (ms)", "speedup"))
+
+    for npoints in point_counts:
+        x = np.linspace(0.0, 10.0, npoints)
+        kwargs = dict(zip(mechanism.rates, rates))
+        changes = iter(range(10 ** 9))
+
+        t_ode = time_calls(lambda: solve_ivp(
+            lambda t, c: matrix @ c, (x[0], x[-1]), initial, t_eval=x,
+            rtol=1e-8, atol=1e-10).y[1], ncalls)
+        # a different first rate constant at every call
+        t_new = time_calls(lambda: model(
+            x, **dict(kwargs, k1=rates[0] + 1e-9 * next(changes))), ncalls)
+        t_cached = time_calls(lambda: model(x, **kwargs), ncalls)
+
+        print("{0:>8}{1:>12.3f}{2:>12.3f}{3:>12.3f}{4:>10.1f}".format(
+            npoints, 1000 * t_ode, 1000 * t_new, 1000 * t_cached,
+            t_ode / t_new))
+
+
+def main():
+    benchmark_broadcast()
+    benchmark_work_buffers()
+    benchmark_batch()
+    benchmark_reconvolution()
+    benchmark_mechanism()
+
+
+if __name__ == '__main__':
+    main()
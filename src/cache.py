@@ -0,0 +1,264 @@
+"""This module contains a cache of fit results on disk, so rerunning a fit
+that has already been run (e.g. after reopening a session) returns the old
+result instead of fitting again. See fit.fit's cache option.
+
+Results are stored under a key that is a hash of everything that decides
+the outcome of a fit: the data and x values, the model function and its
+source, every setting of every parameter, and the options of the fit. Each
+result is one pickle file named after its key. When the files take up more
+than MAX_BYTES, the least recently used are deleted."""
+
+import hashlib
+import inspect
+import os
+import pickle
+
+import numpy as np
+
+# where the results are stored
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pysavuka', 'fit-cache')
+
+# how much space the results may take up, in bytes
+MAX_BYTES = 256 * 2 ** 20
+
+# change when the stored results, or how they are made, change, so that
+# results from older versions are never used.
+CACHE_VERSION = 1
+
+SUFFIX = '.pkl'
+
+
+def _update(h, obj):
+    """Feed obj into the hash h. Arrays are hashed by their dtype, shape and
+    contents, containers by their items, and objects by their attributes,
+    so equal inputs always give equal hashes."""
+    if isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        h.update("array {0} {1}".format(obj.dtype.str, obj.shape).encode())
+        h.update(obj.tobytes())
+    elif isinstance(obj, dict):
+        h.update("dict {0}".format(len(obj)).encode())
+        for key in sorted(obj, key=repr):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update("{0} {1}".format(type(obj).__name__, len(obj)).encode())
+        for item in obj:
+            _update(h, item)
+    elif callable(obj):
+        h.update(model_identity(obj).encode())
+        # e.g. the instrument response of a reconvolved model. Private
+        # attributes, like caches, don't change what the function computes.
+        if getattr(obj, '__dict__', None):
+            _update(h, {key: value for key, value in vars(obj).items()
+                        if not key.startswith('_')})
+    elif hasattr(obj, '__dict__'):
+        h.update("object {0}".format(type(obj).__name__).encode())
+        _update(h, vars(obj))
+    else:
+        h.update("{0} {1!r}".format(type(obj).__name__, obj).encode())
+
+
+def model_identity(model):
+    """Return a string naming the model function and holding its source, and
+    that of the functions and classes of its package it uses (see
+    dependencies), so that editing a model, or anything it calls, changes
+    the key of its fits."""
+    name = "{0}.{1}".format(getattr(model, '__module__', None),
+                            getattr(model, '__qualname__', repr(model)))
+    return "\n".join([name, _source(model)] +
+                      [_source(obj) for obj in dependencies(model)])
+
+
+def _source(obj):
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        code = getattr(obj, '__code__', None)
+        return repr((code.co_code, code.co_consts)) if code else ''
+
+
+def _package(obj):
+    return (getattr(obj, '__module__', None) or '').split('.')[0]
+
+
+def _names(code):
+    """Return the global and attribute names used by code and the code
+    nested in it, e.g. of lambdas."""
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names += _names(const)
+    return names
+
+
+def dependencies(model):
+    """Return the functions and classes that model uses, directly or through
+    each other, that belong to its own package: those named in its code,
+    found in its module or in modules of the package it names, and those
+    held by its closure or attributes, e.g. the base model of a reconvolved
+    model, or the classes of the objects a mechanism model keeps. In the
+    order they're found."""
+    func = inspect.unwrap(model) if inspect.isfunction(model) else model
+    packages = {_package(func)}
+    if inspect.isfunction(func):
+        packages.add(func.__globals__.get('__name__', '').split('.')[0])
+    packages.discard('')
+
+    found = []
+    seen = {id(model)}
+    stack = [func]
+    while stack:
+        obj = stack.pop()
+        referenced = []
+        if inspect.isclass(obj):
+            referenced += [value for value in vars(obj).values()
+                           if inspect.isfunction(value)]
+        elif inspect.isfunction(obj):
+            names = _names(obj.__code__)
+            scope = obj.__globals__
+            for name in names:
+                value = scope.get(name)
+                if inspect.ismodule(value):
+                    if value.__name__.split('.')[0] in packages:
+                        referenced += [getattr(value, attr) for attr in names
+                                       if hasattr(value, attr)]
+                elif value is not None:
+                    referenced.append(value)
+            for cell in obj.__closure__ or ():
+                try:
+                    referenced.append(cell.cell_contents)
+                except ValueError:  # not assigned yet
+                    pass
+            referenced += vars(obj).values()
+        else:  # an object of a class of the package
+            referenced.append(type(obj))
+            referenced += vars(obj).values()
+
+        for value in referenced:
+            if id(value) in seen:
+                continue
+            if inspect.isfunction(value) or inspect.isclass(value):
+                if _package(value) not in packages:
+                    continue
+                if not inspect.isclass(obj):  # methods are in its source
+                    found.append(value)
+            elif (not hasattr(value, '__dict__') or
+                    _package(type(value)) not in packages):
+                continue
+            seen.add(id(value))
+            stack.append(value)
+    return found
+
+
+def parameter_spec(parameters):
+    """Return the settings of each parameter that can change a fit, in
+    order: name, value, bounds, vary and expr."""
+    return [(name, par.value, par.min, par.max, par.vary, par.expr)
+            for name, par in parameters.items()]
+
+
+def fit_key(data, x, model, parameters, options):
+    """Return the key of a fit: the hex digest of a hash of the data, x
+    values, model, parameters and options (keyword arguments) of the fit."""
+    h = hashlib.sha256()
+    _update(h, CACHE_VERSION)
+    _update(h, data)
+    _update(h, x)
+    _update(h, model)
+    _update(h, parameter_spec(parameters))
+    _update(h, options)
+    return h.hexdigest()
+
+
+def path_of(key, directory=None):
+    return os.path.join(directory or CACHE_DIR, key + SUFFIX)
+
+
+def load(key, directory=None):
+    """Return the result stored under key, or None if there is none. Loading
+    a result marks it as recently used."""
+    path = path_of(key, directory)
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:  # unreadable, e.g. written by another version
+        remove(path)
+        return None
+
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return result
+
+
+def store(key, result, directory=None, max_bytes=None):
+    """Store result under key, then delete the least recently used results
+    until they all fit in max_bytes (MAX_BYTES by default)."""
+    directory = directory or CACHE_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    # write to a temporary file first, so no one reads half a result.
+    path = path_of(key, directory)
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+
+    evict(directory, MAX_BYTES if max_bytes is None else max_bytes)
+
+
+def entries(directory=None):
+    """Return a list of (key, size in bytes, time last used) of every stored
+    result, most recently used first."""
+    directory = directory or CACHE_DIR
+    found = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return found
+
+    for name in names:
+        if not name.endswith(SUFFIX):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except FileNotFoundError:  # evicted by another process
+            continue
+        found.append((name[:-len(SUFFIX)], stat.st_size, stat.st_mtime))
+    found.sort(key=lambda entry: entry[2], reverse=True)
+    return found
+
+
+def evict(directory=None, max_bytes=None):
+    """Delete the least recently used results until the rest take up no
+    more than max_bytes. Returns how many were deleted."""
+    if max_bytes is None:
+        max_bytes = MAX_BYTES
+    kept = entries(directory)
+    total = sum(size for _, size, _ in kept)
+    removed = 0
+    while kept and total > max_bytes:
+        key, size, _ = kept.pop()
+        remove(path_of(key, directory))
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear(directory=None):
+    """Delete every stored result. Returns how many were deleted."""
+    found = entries(directory)
+    for key, _, _ in found:
+        remove(path_of(key, directory))
+    return len(found)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
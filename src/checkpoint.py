@@ -0,0 +1,224 @@
+"""This module keeps checkpoints of fits on disk while they run, so a long
+fit (e.g. a global differential_evolution fit of many buffers) that is
+interrupted, by Ctrl-C, a time limit or a crash, can be continued from where
+it got to instead of starting over. See fit.fit's checkpoint option and
+fit.resume_fit.
+
+Each fit has two files, named after its key (see cache.fit_key): one holding
+what the fit was given, written once when it starts, and one holding its
+state, rewritten as it goes: the best parameters found so far, how many
+function evaluations and seconds it has taken, and, for
+differential_evolution, its population. The state is written at most every
+EVERY seconds, and never so often that writing it takes more than OVERHEAD
+of the time of the fit. The files are deleted once the fit converges."""
+
+import os
+import pickle
+import time
+
+from src import cache
+from src import models
+
+# where the checkpoints are kept
+CHECKPOINT_DIR = os.path.join(os.path.expanduser('~'), '.pysavuka',
+                              'checkpoints')
+
+# default seconds between checkpoints of a fit
+EVERY = 60.0
+
+# most of the time of a fit that may be spent writing checkpoints
+OVERHEAD = 0.01
+
+INPUTS_SUFFIX = '.inputs.pkl'
+STATE_SUFFIX = '.state.pkl'
+
+
+class Checkpoint(object):
+    """The checkpoint of one fit. Called after every call of the objective
+    as lmfit's iter_cb, in place of the FitBudget it watches (see watch),
+    and writes the state of the fit whenever it is due. Its
+    population_callback is given to differential_evolution as its callback,
+    to keep the population of each generation.
+
+    A checkpoint loaded from disk (see load) holds the inputs of the fit,
+    and what it had done when it was last written, in nfev and seconds.
+    """
+
+    def __init__(self, key, data, x, model, parameters, options,
+                 directory=None, every=None):
+        self.key = key
+        self.data = data
+        self.x = x
+        self.model = model
+        self.parameters = parameters
+        self.options = options
+        self.directory = directory or CHECKPOINT_DIR
+        self.every = EVERY if every is None else every
+
+        # the state of the fit when the checkpoint was last written
+        self.best = None  # {name: value} of each free parameter
+        self.nfev = 0
+        self.seconds = 0.0
+        self.population = None
+        self.generation = None
+        self.written = None  # time.time() it was written
+
+        # what was done before this run, if it was resumed
+        self.nfev_before = 0
+        self.seconds_before = 0.0
+        self.budget = None
+        self.began = None
+        self.due = None
+
+    def path(self, suffix):
+        return os.path.join(self.directory, self.key + suffix)
+
+    def start(self):
+        """Write the inputs of the fit."""
+        model = self.model
+        try:
+            # registered models are stored by name, so user models, which
+            # can't be pickled, can be too.
+            if models.get_models(model.__name__) is model:
+                model = model.__name__
+        except (AttributeError, IndexError):
+            pass
+        write(self.path(INPUTS_SUFFIX),
+              {'key': self.key, 'data': self.data, 'x': self.x,
+               'model': model, 'parameters': self.parameters,
+               'options': self.options, 'every': self.every})
+
+    def watch(self, budget):
+        """Start checkpointing a run of the fit, whose progress is kept by
+        budget (a fit.FitBudget)."""
+        self.budget = budget
+        self.nfev_before = self.nfev
+        self.seconds_before = self.seconds
+        self.began = time.perf_counter()
+        self.due = self.began + self.every
+
+    def __call__(self, parameters, iteration, resid, *args, **kwargs):
+        stop = self.budget(parameters, iteration, resid, *args, **kwargs)
+        if time.perf_counter() >= self.due:
+            self.save()
+        return stop
+
+    def population_callback(self, intermediate_result):
+        """The callback of differential_evolution, called after each
+        generation. Keeps a copy of the population, in the internal values
+        lmfit varies, so it can be passed back as init."""
+        self.population = intermediate_result.population.copy()
+        self.generation = intermediate_result.nit
+        if time.perf_counter() >= self.due:
+            self.save()
+
+    def save(self):
+        """Write the state of the fit now, unless it has no best parameters
+        yet. The next one is due in every seconds, or later if writing this
+        one took more than OVERHEAD of that."""
+        began = time.perf_counter()
+        if self.budget.best is None:
+            return
+        self.best = dict(self.budget.best)
+        self.nfev = self.nfev_before + self.budget.nfev
+        self.seconds = self.seconds_before + began - self.began
+        self.written = time.time()
+        write(self.path(STATE_SUFFIX),
+              {'key': self.key, 'best': self.best, 'nfev': self.nfev,
+               'seconds': self.seconds, 'population': self.population,
+               'generation': self.generation, 'written': self.written})
+        taken = time.perf_counter() - began
+        self.due = time.perf_counter() + max(self.every, taken / OVERHEAD)
+
+    def remove(self):
+        """Delete the files of the checkpoint, e.g. once the fit is done."""
+        for suffix in (STATE_SUFFIX, INPUTS_SUFFIX):
+            cache.remove(self.path(suffix))
+
+
+def write(path, obj):
+    """Pickle obj to path, through a temporary file so no one reads half of
+    it, and a crash while writing leaves the last one whole."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def entries(directory=None):
+    """Return a list of (key, nfev, seconds, time written) of every
+    checkpoint that has a state, most recently written first."""
+    directory = directory or CHECKPOINT_DIR
+    found = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return found
+
+    for name in names:
+        if not name.endswith(STATE_SUFFIX):
+            continue
+        try:
+            state = read(os.path.join(directory, name))
+        except Exception:  # removed meanwhile, or written by another version
+            continue
+        found.append((state['key'], state['nfev'], state['seconds'],
+                      state['written']))
+    found.sort(key=lambda entry: entry[3], reverse=True)
+    return found
+
+
+def load(key=None, directory=None):
+    """Return the Checkpoint stored under key, which may be the start of a
+    key, or the most recently written one if key is None. Returns None if
+    there is none.
+
+    Raises ValueError if key matches several checkpoints, or if the inputs
+    no longer give the same key, e.g. because the model was edited since.
+    """
+    directory = directory or CHECKPOINT_DIR
+    keys = [k for k, _, _, _ in entries(directory)]
+    if key is not None:
+        keys = [k for k in keys if k.startswith(str(key))]
+        if len(keys) > 1:
+            raise ValueError("{0} checkpoints start with {1}".format(
+                len(keys), key))
+    if not keys:
+        return None
+
+    key = keys[0]
+    inputs = read(os.path.join(directory, key + INPUTS_SUFFIX))
+    state = read(os.path.join(directory, key + STATE_SUFFIX))
+    model = inputs['model']
+    if isinstance(model, str):
+        model = models.get_models(model)
+    if cache.fit_key(inputs['data'], inputs['x'], model,
+                     inputs['parameters'], inputs['options']) != key:
+        raise ValueError("The checkpoint {0} doesn't match its fit anymore;"
+                         " was its model changed?".format(key[:16]))
+
+    saved = Checkpoint(key, inputs['data'], inputs['x'], model,
+                       inputs['parameters'], inputs['options'], directory,
+                       inputs['every'])
+    for name in ('best', 'nfev', 'seconds', 'population', 'generation',
+                 'written'):
+        setattr(saved, name, state[name])
+    return saved
+
+
+def clear(directory=None):
+    """Delete every checkpoint. Returns how many were deleted."""
+    directory = directory or CHECKPOINT_DIR
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        cache.remove(os.path.join(directory, name))
+    return sum(name.endswith(INPUTS_SUFFIX) for name in names)
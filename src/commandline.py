@@ -9,13 +9,15 @@ from src import svd
 from src import params
 from src.parse_funcs import library_root, json_path
 from src import fit
+from src import cache
+from src import checkpoint
 
 import cmd
 import re
 import os
 import sys
 from sys import stderr, stdout
-from time import sleep
+from time import sleep, strftime, localtime
 import matplotlib.pyplot as plt
 
 
@@ -363,6 +365,148 @@ class CommandLine(cmd.Cmd):
         """
         print("".join(models.get_helps(line)))
 
+    def do_add_model(self, line):
+        """Add a model for fitting, written as an expression of x and its
+        parameters, e.g. a*exp(-k*x)+c. The model can then be fit like any
+        other, and is kept for later sessions. Adding a model with the name
+        of one added before replaces it.
+        Usage:
+            add_model <name> <expression> -aliases <alias> <alias>...
+            add_model -remove <name>
+
+        Arguments:
+            name: str
+                The name of the model.
+            expression: str
+                Any parameter names, x, numbers, + - * / ** and the
+                   functions exp, log, log10, sqrt, abs, sin, cos, tan,
+                   sinh, cosh, tanh, erf, erfc, arctan2, hypot, max, min
+                   and the constants pi and e. Every parameter starts at
+                   1.0, in the parameters window.
+
+        Keyword arguments:
+            aliases: str, optional
+                Other names to call the model by.
+            remove: str
+                Forget the model added under this name.
+        """
+        args, kwargs = utils.parse_options(line)
+        if 'remove' in kwargs:
+            for name in kwargs['remove']:
+                if not models.remove_user_model(str(name)):
+                    print("{0} is not a model added with add_model."
+                          "".format(name))
+            return
+
+        # the expression is the rest of the line, spaces and all.
+        line = re.split(r'\s-+(?:aliases|remove)\b', line)[0].strip()
+        if len(line.split(None, 1)) != 2:
+            print(self.do_help("add_model"))
+            return
+        name, expression = line.split(None, 1)
+        try:
+            model = models.add_user_model(name, expression,
+                                          kwargs.get('aliases', []))
+        except ValueError as e:
+            print("Couldn't add the model: {0}".format(e))
+            return
+        print(model.__doc__)
+
+    def do_mechanism(self, line):
+        """Add a model of the signal of a kinetic mechanism of first-order
+        steps, e.g. for global fits of stopped-flow shots. Its
+        concentrations are worked out in closed form from the
+        eigenvalues of its rate matrix, not by integrating it, so it fits
+        as fast as a sum of exponentials. The model is kept for this
+        session.
+        Usage:
+            mechanism <name> <scheme> -aliases <alias>... -initial <species>=<c>...
+
+        Arguments:
+            name: str
+                The name of the model.
+            scheme: str
+                Steps joined by -> or, for reversible ones, <=>, separated
+                   by ; e.g. A <=> B -> C. The i-th arrow has the rate
+                   constant ki, and its reverse kmi. The model also takes
+                   amp_<species>, the signal of each species, and offset.
+
+        Keyword arguments:
+            aliases: str, optional
+                Other names to call the model by.
+            initial: str, optional
+                The concentration of species at x = 0, e.g. A=1 B=0.2.
+                   Defaults to 1 of the first species and none of the rest.
+        """
+        args, kwargs = utils.parse_options(line)
+        initial = None
+        if 'initial' in kwargs:
+            initial = {}
+            for entry in kwargs['initial']:
+                species, _, value = str(entry).partition('=')
+                try:
+                    initial[species] = float(value)
+                except ValueError:
+                    print("{0} is not <species>=<concentration>".format(
+                        entry))
+                    return
+
+        # the scheme is the rest of the line, spaces and all.
+        line = re.split(r'\s-+(?:aliases|initial)\b', line)[0].strip()
+        if len(line.split(None, 1)) != 2:
+            print(self.do_help("mechanism"))
+            return
+        name, scheme = line.split(None, 1)
+        try:
+            model = models.add_mechanism_model(
+                scheme, name, [str(alias) for alias in
+                               kwargs.get('aliases', [])], initial)
+        except ValueError as e:
+            print("Couldn't add the model: {0}".format(e))
+            return
+        print(model.__doc__)
+
+    def do_irf(self, line):
+        """Add a model that is another model convolved with the instrument
+        response (IRF) measured in a buffer, e.g. for TCSPC decays. The
+        convolution is done with FFTs, and the IRF is transformed once per
+        fit. The new model takes the parameters of the other one plus
+        shift, which moves the IRF along x, and is kept for this session.
+        Buffers fit to it need evenly spaced x values.
+        Usage:
+            irf <buffer index> <model name> -name <name> -aliases <alias>...
+
+        Arguments:
+            buffer index: int
+                The buffer holding the measured IRF. It is interpolated onto
+                   the x values of each buffer fit to the model.
+            model name: str
+                The model to convolve, e.g. exp2.
+
+        Keyword arguments:
+            name: str, optional
+                The name of the new model. Defaults to the name of the
+                   model followed by _irf.
+            aliases: str, optional
+                Other names to call the new model by.
+        """
+        args, kwargs = utils.parse_options(line)
+        if not self.length_match(args, 2, "irf"):
+            return
+        if not self.type_match((args[0], (int,), "buffer index"),
+                               (args[1], (str,), "model name")):
+            return
+
+        name = kwargs.get('name', [None])[0]
+        try:
+            model = self.savuka.add_irf_model(
+                args[0], args[1], None if name is None else str(name),
+                [str(alias) for alias in kwargs.get('aliases', [])])
+        except (IndexError, ValueError) as e:
+            print("Couldn't add the model: {0}".format(e))
+            return
+        print(model.__doc__)
+
     def do_fit(self, line):
         """Fit the data from the given buffer index to the given model. If some
         buffers are not linked in any way to others, then they should not be
@@ -374,7 +518,9 @@ class CommandLine(cmd.Cmd):
 
         Arguments:
             buffer index: int OR tuple(no spaces, e.g. (0,1,2))
-                What buffers should be fit to the model
+                What buffers should be fit to the model. Buffers don't need
+                   the same x values or number of points; each one is fit
+                   at its own x values.
             model name: string
                 The name of the model as specified in models.py
 
@@ -384,11 +530,55 @@ class CommandLine(cmd.Cmd):
                 - `'global'` (default): run the fit with all buffers
                 - `'independent'`: run a fit with one set of parameters on
                                    each buffer.
+            workers: int, optional
+                With type independent, run the fits in this many processes at
+                   once. Results are reported and plotted once all the fits
+                   are done. By default the fits are run one after another.
+                   Also sets the processes of multistart. Ignored, with a
+                   message, by any other fit.
+            batch: bool, optional
+                With type independent, fit every buffer at once with a
+                   batched Levenberg-Marquardt solver, much faster than
+                   fitting them one at a time when there are many small
+                   fits. Gives the same results as the default method.
+                   Only for models that can be evaluated for many buffers
+                   at once, with no linked parameters. Takes max_nfev, ftol
+                   and xtol. Default is False. Ignored, with a message, by
+                   any other fit.
+            incremental: int, optional
+                For a single buffer, replay it as if it were being acquired,
+                   this many points at a time, refitting it as each lot
+                   arrives from the parameters of the fit before. Every
+                   refit after the first is limited to max_nfev function
+                   evaluations (10 per parameter by default). The estimates
+                   after each refit are printed. A tuple of buffers is
+                   rejected.
+            multistart: int, optional
+                Run this many fits of the global (or single buffer) fit from
+                   starting values spread over the parameter bounds, in
+                   parallel, to find the global minimum instead of the one
+                   nearest the starting guess. A parameter without bounds is
+                   spread up to the size of its value either side of it.
+                   The best distinct minima are ranked and kept, the best
+                   one last. Use `workers` to set how many processes run.
+            sampler: str, optional
+                With multistart, how starting values are spread:
+                - `'sobol'` (default): scrambled Sobol sequence
+                - `'lhs'`: Latin hypercube
+            seed: int, optional
+                With multistart, seed of the sampler. Default is 0, so runs
+                   can be reproduced.
+            keep: int, optional
+                With multistart, how many distinct minima to keep. Default 5.
             method: str, optional
                 Name of the fitting method to use. Valid values are:
                 - `'leastsq'`: Levenberg-Marquardt (default)
                 - `'least_squares'`: Least-Squares minimization, using Trust
-                                     Region Reflective method by default
+                                     Region Reflective method by default.
+                                     Much faster for global fits of many
+                                     buffers, since only the parameters
+                                     linked between buffers affect more
+                                     than one of them.
                 - `'differential_evolution'`: differential evolution
                 - `'brute'`: brute force method
                 - '`nelder`': Nelder-Mead
@@ -404,6 +594,43 @@ class CommandLine(cmd.Cmd):
             debug: bool, optional
                 When set to True, will output parameter values at each iteration
                    of the fitting routine. Default is False.
+            sparse: bool, optional
+                With the `'least_squares'` method, use which buffers each
+                   parameter belongs to when estimating the Jacobian.
+                   Default is True.
+            varpro: bool, optional
+                Solve for the parameters the model is linear in (e.g. the
+                   baselines of two_state) exactly at each step, so only the
+                   nonlinear ones are left to the fitting method. Those
+                   parameters must vary, and have no bounds or links.
+                   Default is False.
+            max_time: float, optional
+                Stop the fit after this many seconds. Works with every
+                   method. The best parameters found so far are kept as the
+                   result of the fit, marked as not converged. Pressing
+                   Ctrl-C during a fit does the same.
+            max_nfev: int, optional
+                Stop the fit after this many function evaluations, in the
+                   same way.
+            cache: bool, optional
+                Look for the result of the exact same fit (same data,
+                   model, parameters and options) in the fit cache first,
+                   and store the result there. See the cache command.
+                   Default is False.
+            memoize: bool, optional
+                In a fit of several buffers, only evaluate the model for
+                   the buffers whose parameters changed since it was last
+                   evaluated for them. Default is True. The fit_stats
+                   command shows how many evaluations were saved.
+            checkpoint: bool, optional
+                Save the state of the fit to disk as it runs, so that if it
+                   is stopped, interrupted or crashes it can be continued
+                   with the fit_resume command. For differential_evolution
+                   the population is saved too. Default is False.
+            checkpoint_every: float, optional
+                Seconds between checkpoints. Default is 60. Checkpoints are
+                   never written so often that they take more than 1% of
+                   the time of the fit.
             scale_covar : bool, optional
                 Whether to automatically scale the covariance matrix (`leastsq` only).
             nan_policy : str, optional
@@ -441,6 +668,7 @@ class CommandLine(cmd.Cmd):
                 N positive entries that serve as a scale factors for the variables.
                 """
         args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
         if not self.length_match(args, 2, "fit"):
             return
 
@@ -462,6 +690,117 @@ class CommandLine(cmd.Cmd):
         self.savuka.fit(*args, **kwargs)
         plot_funcs.show()
 
+    def do_fit_resume(self, line):
+        """Continue a fit run with -checkpoint True from its last checkpoint,
+        after it was stopped or interrupted, or the program quit or crashed.
+        It starts from the best parameters found so far, with the same data,
+        model and options.
+        Usage:
+            fit_resume [key] -keyword <keyword value>...
+            fit_resume list
+            fit_resume clear
+
+        Arguments:
+            key: str, optional
+                The key of the checkpoint, or its first few characters, as
+                shown by fit_resume list. Defaults to the most recent one.
+            list: str, optional
+                List the checkpoints, most recent first.
+            clear: str, optional
+                Delete every checkpoint.
+
+        Keyword arguments:
+            Any option of the fit command to change, e.g. -max_time 600.
+                max_time and max_nfev count what was done before the fit
+                was interrupted, unless they are given again.
+            """
+        args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
+        if len(args) > 1:
+            print(self.do_help("fit_resume"))
+            return
+        # keys are hex, which parse_options might take for a number.
+        word = line.split()[0] if args else None
+        if word == 'list':
+            found = checkpoint.entries()
+            print("{0} checkpoints in {1}".format(len(found),
+                                                  checkpoint.CHECKPOINT_DIR))
+            for key, nfev, seconds, written in found:
+                print("    {0}  {1:>9} evaluations  {2:>9.1f} s  written "
+                      "{3}".format(key[:16], nfev, seconds,
+                                   strftime('%Y-%m-%d %H:%M',
+                                            localtime(written))))
+            return
+        if word == 'clear':
+            print("Deleted {0} checkpoints from {1}".format(
+                checkpoint.clear(), checkpoint.CHECKPOINT_DIR))
+            return
+
+        self.savuka.fit_resume(word, **kwargs)
+        plot_funcs.show()
+
+    def do_compare_models(self, line):
+        """Fit the given buffer(s) to several models at once, in parallel,
+        and rank the models by how well they fit for how many parameters
+        they have. The ranking is shown again every time a fit finishes.
+        All the fits are kept, the best one last, and the best is reported
+        and plotted.
+
+        Usage:
+            compare_models <buffer index> <model1,model2,...> -keyword <value>
+
+        Arguments:
+            buffer index: int OR tuple(no spaces, e.g. (0,1,2))
+                What buffers should be fit, globally, to each model.
+            models: str
+                Names of the models, separated by commas with no spaces.
+
+        Keyword arguments:
+            criterion: str, optional
+                What to rank the models by, lowest first:
+                - `'aic'` (default): Akaike information criterion
+                - `'bic'`: Bayesian information criterion, which penalizes
+                           parameters more
+                - `'redchi'`: reduced chi-square
+                With aic and bic the table also shows each model's weight,
+                   the relative likelihood that it is the best of them.
+            ask: bool, optional
+                Open the parameters window for each model before fitting.
+                   By default every model starts from its default values,
+                   with no parameters shared between buffers.
+            workers: int, optional
+                How many processes run fits at once. Defaults to the number
+                   of CPUs.
+            Any keyword argument of the fit command (e.g. method) is passed
+               on to every fit.
+        """
+        args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
+        if not self.length_match(args, 2, "compare_models"):
+            return
+        if not self.type_match((args[0], (int, tuple), "buffer index"),
+                               (args[1], (str,), "models")):
+            return
+
+        num_bufs = 1 if isinstance(args[0], int) else len(args[0])
+        candidates = []
+        for name in args[1].split(','):
+            try:
+                candidates.append(models.get_models(name))
+            except IndexError:
+                print("Model name invalid. You entered [{0}]. Use the models "
+                      "command for the list of supported models."
+                      "".format(name))
+                return
+
+        parameters = {}
+        if kwargs.pop('ask', False):
+            for model in candidates:
+                parameters[model.__name__] = params.main(num_bufs, model)
+        self.savuka.compare_models(args[0], candidates,
+                                   parameters=parameters, **kwargs)
+        plot_funcs.show()
+
     def do_clear(self, line):
         """Clear the screen. Equivalent to cls on Windows and clear on Unix."""
         os.system('cls' if os.name == 'nt' else 'clear')
@@ -502,6 +841,37 @@ class CommandLine(cmd.Cmd):
         """If we have run a fit, print its results"""
         self.savuka.report_result()
 
+    def do_fit_stats(self, line):
+        """Show how a fit spent its time: calls of the objective, Jacobian
+        evaluations, wall time, and the time taken by the model, by making
+        the residuals, by lmfit handling the parameters (estimated) and by
+        the minimizer itself. Shows whether a slow fit is held up by the
+        model or by overhead. The Jacobians of leastsq, worked out by
+        finite differences, are counted from the calls it makes; those of
+        minimizers that neither report nor difference them aren't counted.
+        Usage:
+            fit_stats <n>
+
+        Arguments:
+            n: int, optional
+                Which fit to show, counting from the first fit run (0), or
+                back from the last one (-1, the default).
+            """
+        args, kwargs = utils.parse_options(line)
+        if len(args) > 1:
+            print(self.do_help("fit_stats"))
+            return
+
+        n = args[0] if args else -1
+        if not self.type_match((n, (int,), "n")):
+            return
+
+        if not -self.savuka.num_results <= n < self.savuka.num_results:
+            print("There is no fit {0}. {1} fits have been run."
+                  "".format(n, self.savuka.num_results))
+            return
+        self.savuka.fit_stats(n)
+
     def do_fit_plot(self, line):
         """If we have run a fit, plot it"""
         self.savuka.plot_result()
@@ -530,9 +900,13 @@ class CommandLine(cmd.Cmd):
                 param the value should vary in the X^2 analysis.
             debug: bool
                 Whether each fit should print its results. Default False.
+            workers: int
+                How many processes to run the fits in. Defaults to the number
+                of CPUs.
 
             """
         args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
         if not self.length_match(args, 1, "chi_error"):
             return
 
@@ -543,6 +917,174 @@ class CommandLine(cmd.Cmd):
         self.savuka.plot_x2(param_name, **kwargs)
         plot_funcs.show()
 
+    def do_chi_surface(self, line):
+        """Generate a contour plot of chi-square for fits fixing the values of
+        two parameters on a grid around their best fit values, and refitting
+        the rest. Shows how the two parameters trade off against each other,
+        which the chi_error curve of each one alone hides. Every fit starts
+        from a neighbouring cell that is already fit, and the fits run in
+        parallel. Each cell is saved as it finishes, so running the same
+        command again after an interruption only fits the missing cells.
+        The cells are deleted once every one is fit.
+        Usage:
+            chi_surface <param 1> <param 2> -keyword <keyword value>...
+            chi_surface clear
+
+        Arguments:
+            param 1, param 2: str
+                Names of the parameters to be varied, according to the model
+                as defined by the models command. The only variable in the
+                models that cannot be used is x. param 1 is plot along the
+                x axis.
+            clear: str, optional
+                Delete the cells of every surface that wasn't finished.
+
+        Keyword arguments:
+            nsamples: int
+                how many values of each param to take X^2 at. Odd number
+                will include the true param values. Default 11.
+            plus_minus: float
+                fraction of their true values that the params should vary by
+                in the X^2 analysis. Default 0.2.
+            debug: bool
+                Whether each fit should print its results. Default False.
+            workers: int
+                How many processes to run the fits in. Defaults to the number
+                of CPUs.
+            directory: str
+                Where to save the cells. Defaults to
+                ~/.pysavuka/chi-surfaces.
+            keep: bool
+                Keep the cells once every one is fit. Default False.
+
+            """
+        args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
+        if args and line.split()[0] == 'clear':
+            print("Deleted {0} surfaces from {1}".format(
+                fit.clear_chi_surfaces(), fit.SURFACE_DIR))
+            return
+        if not self.length_match(args, 2, "chi_surface"):
+            return
+
+        param1, param2 = args
+        if not self.type_match((param1, (str,), "param 1"),
+                               (param2, (str,), "param 2")):
+            return
+
+        self.savuka.chi_surface(param1, param2, **kwargs)
+        plot_funcs.show()
+
+    def do_confidence(self, line):
+        """Find the confidence interval of a parameter of the last fit. The
+        parameter is fixed at values on either side of its best value while
+        the rest are refit, until chi-square rises enough that an F-test
+        rejects the fit. Needs far fewer fits than chi_error for the same
+        precision. Prints the interval and plots the chi-square profile.
+        Usage:
+            confidence <param name> -keyword <keyword value>...
+
+        Arguments:
+            param name: str
+                Name of the parameter, according to the model as defined by
+                the models command.
+
+        Keyword arguments:
+            prob: float
+                Confidence level of the interval. Default 0.6827 (1 sigma).
+            xtol: float
+                Precision of the ends of the interval, relative to the best
+                fit value. Default 0.001.
+            workers: int
+                Set to 1 to find both ends in this process. By default they
+                are found in parallel.
+            """
+        args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
+        if not self.length_match(args, 1, "confidence"):
+            return
+
+        param_name = args[0]
+        if not self.type_match((param_name, (str,), "param name")):
+            return
+
+        self.savuka.confidence_interval(param_name, **kwargs)
+        plot_funcs.show()
+
+    def do_bootstrap(self, line):
+        """Estimate the uncertainty of the parameters of the last fit by
+        refitting many synthetic datasets made from it. More reliable than
+        the standard errors of the fit report when parameters are strongly
+        correlated (e.g. deltag and m). Prints a percentile interval for
+        each free parameter and the correlations between them.
+        Usage:
+            bootstrap <replicates> -keyword <keyword value>...
+
+        Arguments:
+            replicates: int, optional
+                How many synthetic datasets to fit. Default 1000.
+
+        Keyword arguments:
+            resample: str
+                How the synthetic datasets are made from the best fit:
+                - `'residuals'` (default): add its residuals, drawn at
+                                           random from the same buffer.
+                - `'noise'`: add gaussian noise the size of its residuals.
+            prob: float
+                Confidence level of the intervals. Default 0.6827 (1 sigma).
+            seed: int
+                Seed for the synthetic datasets. Default 0.
+            workers: int
+                How many processes to fit in. Defaults to the number of CPUs.
+            method: str
+                Fitting method for the replicates, as for the fit command.
+            """
+        args, kwargs = utils.parse_options(line)
+        kwargs = utils.unpack_options(kwargs)
+        if len(args) > 1:
+            print(self.do_help("bootstrap"))
+            return
+
+        if args:
+            nreplicates = args[0]
+            if not self.type_match((nreplicates, (int,), "replicates")):
+                return
+            kwargs['nreplicates'] = nreplicates
+
+        self.savuka.bootstrap(**kwargs)
+
+    def do_cache(self, line):
+        """Show or clear the cache of fit results on disk, used by fits run
+        with -cache True. When it grows past its size limit, the least
+        recently used results are deleted.
+        Usage:
+            cache
+            cache clear
+
+        Arguments:
+            clear: str, optional
+                Delete every stored result. Without it, list them, most
+                recently used first.
+            """
+        args, kwargs = utils.parse_options(line)
+        if args == ['clear']:
+            print("Deleted {0} results from {1}".format(cache.clear(),
+                                                       cache.CACHE_DIR))
+            return
+        if args:
+            print(self.do_help("cache"))
+            return
+
+        found = cache.entries()
+        total = sum(size for _, size, _ in found)
+        print("{0} results in {1}, {2:.1f} of {3:.0f} MB".format(
+            len(found), cache.CACHE_DIR, total / 2 ** 20,
+            cache.MAX_BYTES / 2 ** 20))
+        for key, size, used in found:
+            print("    {0}  {1:>8.1f} kB  last used {2}".format(
+                key[:16], size / 2 ** 10,
+                strftime('%Y-%m-%d %H:%M', localtime(used))))
+
     #######################
     # CONVENIENCE METHODS #
     #######################
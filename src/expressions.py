@@ -0,0 +1,292 @@
+"""This module compiles models written as expressions, e.g. a*exp(-k*x)+c,
+into NumPy functions that can be used like the models in src.models. See
+models.add_user_model, which registers the result.
+
+An expression may only use numbers, x, parameter names, the arithmetic
+operators + - * / ** and the functions in FUNCTIONS. Anything else, like
+attribute access or calls of other functions, is rejected, so an expression
+can't run arbitrary code.
+
+The expression is turned into a graph of operations where identical
+subexpressions appear once, so they are calculated once. Operations that
+don't involve x only depend on the parameters, and are calculated before
+anything of the length of x. The rest are written as NumPy ufunc calls that
+write into a few temporary arrays, reused as soon as their value is no
+longer needed, and finally into out. The generated function takes out like
+the models in WRITES_OUT, and broadcasts like those in BROADCASTABLE."""
+
+import ast
+import keyword
+
+import numpy as np
+
+# change when the generated code changes, so cached models are recompiled.
+VERSION = 1
+
+# functions an expression may call, and the ufunc each one is
+FUNCTIONS = {
+    'exp': 'np.exp', 'expm1': 'np.expm1',
+    'log': 'np.log', 'ln': 'np.log', 'log10': 'np.log10',
+    'log2': 'np.log2', 'log1p': 'np.log1p',
+    'sqrt': 'np.sqrt', 'abs': 'np.absolute',
+    'sin': 'np.sin', 'cos': 'np.cos', 'tan': 'np.tan',
+    'arcsin': 'np.arcsin', 'asin': 'np.arcsin',
+    'arccos': 'np.arccos', 'acos': 'np.arccos',
+    'arctan': 'np.arctan', 'atan': 'np.arctan',
+    'sinh': 'np.sinh', 'cosh': 'np.cosh', 'tanh': 'np.tanh',
+    'erf': 'special.erf', 'erfc': 'special.erfc',
+    # two arguments
+    'arctan2': 'np.arctan2', 'atan2': 'np.arctan2', 'hypot': 'np.hypot',
+    'max': 'np.maximum', 'min': 'np.minimum', 'pow': 'np.power',
+}
+BINARY_FUNCTIONS = {'np.arctan2', 'np.hypot', 'np.maximum', 'np.minimum',
+                    'np.power'}
+
+OPERATORS = {ast.Add: 'np.add', ast.Sub: 'np.subtract',
+             ast.Mult: 'np.multiply', ast.Div: 'np.true_divide',
+             ast.Pow: 'np.power'}
+
+# the order of the arguments of these doesn't matter
+COMMUTATIVE = {'np.add', 'np.multiply', 'np.hypot', 'np.maximum',
+               'np.minimum'}
+
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+# names the generated function uses itself
+RESERVED = {'x', 'out', 'np', 'special'} | set(FUNCTIONS) | set(CONSTANTS)
+
+
+class Node(object):
+    """One operation of an expression graph. op is 'x', 'parameter',
+    'constant' or the ufunc applied to args, a tuple of Nodes."""
+
+    def __init__(self, op, args=(), value=None):
+        self.op = op
+        self.args = args
+        self.value = value  # the name of a parameter, or a constant
+        self.uses_x = op == 'x' or any(arg.uses_x for arg in args)
+
+
+class Graph(object):
+    """The operations of an expression, each distinct one created once, in
+    an order where every operation comes after its arguments."""
+
+    def __init__(self, source=''):
+        self.source = source
+        self.nodes = []
+        self.parameters = []
+        self.found = {}
+
+    def node(self, op, args=(), value=None):
+        ids = tuple(id(arg) for arg in args)
+        if op in COMMUTATIVE:
+            ids = tuple(sorted(ids))
+        key = (op, ids, value)
+        if key not in self.found:
+            self.found[key] = Node(op, args, value)
+            self.nodes.append(self.found[key])
+        return self.found[key]
+
+    def constant(self, value):
+        return self.node('constant', value=float(value))
+
+    def apply(self, op, args):
+        """Return the node for op applied to args, folding constants and
+        using cheaper ufuncs for common powers."""
+        if all(arg.op == 'constant' for arg in args):
+            func = eval(op, {'np': np, 'special': _special()})
+            with np.errstate(all='ignore'):
+                value = func(*(arg.value for arg in args))
+            if not np.isfinite(value):
+                raise ValueError("part of the expression is always {0}"
+                                 "".format(value))
+            return self.constant(value)
+        if op == 'np.power' and args[1].op == 'constant':
+            if args[1].value == 2:
+                return self.node('np.square', args[:1])
+            if args[1].value == 0.5:
+                return self.node('np.sqrt', args[:1])
+            if args[1].value == 1:
+                return args[0]
+        return self.node(op, tuple(args))
+
+    def build(self, tree):
+        """Add the operations of an ast node, returning the Node of its
+        result. Raises ValueError for anything not allowed."""
+        if isinstance(tree, ast.Expression):
+            return self.build(tree.body)
+        if isinstance(tree, ast.Constant) and type(tree.value) in (int,
+                                                                   float):
+            return self.constant(tree.value)
+        if isinstance(tree, ast.Name):
+            if tree.id == 'x':
+                return self.node('x')
+            if tree.id in CONSTANTS:
+                return self.constant(CONSTANTS[tree.id])
+            if tree.id in RESERVED or tree.id.startswith('_'):
+                raise ValueError("{0} can't be the name of a parameter"
+                                 "".format(tree.id))
+            if tree.id not in self.parameters:
+                self.parameters.append(tree.id)
+            return self.node('parameter', value=tree.id)
+        if isinstance(tree, ast.BinOp) and type(tree.op) in OPERATORS:
+            return self.apply(OPERATORS[type(tree.op)],
+                              (self.build(tree.left), self.build(tree.right)))
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, ast.USub):
+            return self.apply('np.negative', (self.build(tree.operand),))
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, ast.UAdd):
+            return self.build(tree.operand)
+        if (isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name)
+                and tree.func.id in FUNCTIONS and not tree.keywords):
+            op = FUNCTIONS[tree.func.id]
+            nargs = 2 if op in BINARY_FUNCTIONS else 1
+            if len(tree.args) != nargs:
+                raise ValueError("{0} takes {1} argument(s)".format(
+                    tree.func.id, nargs))
+            return self.apply(op, tuple(self.build(arg) for arg in tree.args))
+        raise ValueError("{0} is not allowed in a model expression".format(
+            ast.get_source_segment(self.source, tree) or
+            type(tree).__name__))
+
+
+def _special():
+    from scipy import special
+    return special
+
+
+def parse(expression):
+    """Parse the expression into a Graph of its operations. Returns the graph
+    and the Node of the result. Raises ValueError if the expression isn't
+    valid, or uses anything that isn't allowed."""
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError("{0} is not a valid expression: {1}".format(
+            expression, e.msg))
+    graph = Graph(expression.strip())
+    return graph, graph.build(tree)
+
+
+def operand(node, names):
+    """Return the code for the value of node as the argument of a ufunc."""
+    if node.op == 'constant':
+        return repr(node.value)
+    if node.op == 'parameter':
+        return node.value
+    return names[id(node)]
+
+
+def generate_body(graph, root):
+    """Return the lines of code computing root into out. Nodes not using x
+    are computed into _s variables first. Nodes using x are computed into
+    _t arrays of the full shape of the result, each reused once the value
+    it holds isn't needed by any later node."""
+    needed = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) not in needed:
+            needed.add(id(node))
+            stack.extend(node.args)
+    nodes = [node for node in graph.nodes if id(node) in needed]
+
+    # the position of the last node that uses each node
+    last_use = {}
+    for position, node in enumerate(nodes):
+        for arg in node.args:
+            last_use[id(arg)] = position
+
+    lines = []
+    names = {}
+    free = []  # temporaries whose values aren't needed anymore
+    ntemps = 0
+    nscalars = 0
+    for position, node in enumerate(nodes):
+        if node.op == 'x':
+            names[id(node)] = 'x'
+        if not node.args:
+            continue
+        args = ", ".join(operand(arg, names) for arg in node.args)
+
+        if not node.uses_x:
+            # only depends on the parameters; cheap, so no out.
+            names[id(node)] = "_s{0}".format(nscalars)
+            nscalars += 1
+            lines.append("{0} = {1}({2})".format(names[id(node)], node.op,
+                                                 args))
+            continue
+
+        # temporaries of arguments used for the last time can be reused.
+        done = []
+        for arg in node.args:
+            name = names.get(id(arg), '')
+            if (name.startswith('_t') and last_use[id(arg)] == position
+                    and name not in done):
+                done.append(name)
+
+        if node is root:
+            target = 'out'
+        elif done:
+            target = done.pop(0)
+        elif free:
+            target = free.pop()
+        else:
+            target = "_t{0}".format(ntemps)
+            ntemps += 1
+            lines.append("{0} = np.empty(_shape)".format(target))
+        free.extend(done)
+        names[id(node)] = target
+        lines.append("{0}({1}, out={2})".format(node.op, args, target))
+
+    if not root.args or not root.uses_x:
+        # the result is x, a parameter, a constant or depends on no x
+        lines.append("out[...] = {0}".format(operand(root, names)))
+    return lines
+
+
+def model_source(name, expression, aliases=()):
+    """Return the source of a Python module defining the model function
+    called name, computing expression. The module also holds the expression
+    and aliases, so it can be recompiled, and VERSION.
+
+    Raises ValueError if the expression or the name isn't valid.
+    """
+    if (not name.isidentifier() or keyword.iskeyword(name) or
+            name.startswith('_')):
+        raise ValueError("{0} can't be the name of a model".format(name))
+
+    graph, root = parse(expression)
+    args = ", ".join(["x"] + ["{0}=1.0".format(p) for p in graph.parameters]
+                     + ["out=None"])
+    shapes = ", ".join("np.shape({0})".format(p)
+                       for p in ['x'] + graph.parameters)
+    body = ["_shape = np.broadcast_shapes({0})".format(shapes),
+            "if out is None:",
+            "    out = np.empty(_shape)"]
+    body += generate_body(graph, root)
+    body.append("return out")
+
+    doc = ['"""', "{0}:".format(name),
+           "    y = {0}".format(graph.source),
+           "    Parameters",
+           "    ----------",
+           "            x : array of values (data to be fit to the model)."]
+    if graph.parameters:
+        doc.append("            {0} : float".format(
+            ", ".join(graph.parameters)))
+    doc.append('"""')
+
+    source = ['"""User model {0}, compiled by src.expressions. Delete this '
+              'file to remove it."""'.format(name),
+              "",
+              "import numpy as np",
+              "from scipy import special",
+              "",
+              "VERSION = {0!r}".format(VERSION),
+              "EXPRESSION = {0!r}".format(graph.source),
+              "ALIASES = {0!r}".format(list(aliases)),
+              "",
+              "",
+              "def {0}({1}):".format(name, args)]
+    source += ["    " + line for line in doc + body]
+    return "\n".join(source) + "\n"
@@ -1,23 +1,512 @@
+from src import cache as fit_cache
+from src import checkpoint as fit_checkpoint
 from src import models
 from src import params
-from src.utils import name_scheme_match
+from src.utils import intify
 
-import re
+import ast
+import json
+import os
+import shutil
+import time
+import traceback
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import matplotlib.pyplot as plt
-from lmfit import minimize
+from scipy.optimize import least_squares
+from scipy.stats import f as f_distribution
+from scipy.stats import qmc
+from scipy.sparse import csr_matrix, kron
+from lmfit import minimize, Minimizer, Parameters
 from lmfit.printfuncs import fit_report
 from lmfit.minimizer import MinimizerResult
 
 
-def generate_dataset(parameters, i, x, model):
+# where the cells of chi-square surfaces are kept, see generate_chi_surface
+SURFACE_DIR = os.path.join(os.path.expanduser('~'), '.pysavuka',
+                           'chi-surfaces')
+
+# fewest samples of an error landscape a worker fits one after another, see
+# generate_error_landscape
+MIN_CHAIN = 4
+
+
+class ParameterLayout(object):
+    """Which Parameters belong to which dataset, worked out once per fit.
+
+    Parameter names follow the scheme name_i, where name is the argument of
+    the model function and i is the dataset it is tied to. Parsing those
+    names with regular expressions on every objective call is far too slow
+    for global fits, so the layout stores, for each dataset, a list of
+    (model argument name, parameter slot) pairs. A slot is the position of
+    the Parameter in the (ordered) Parameters object, so the values for a
+    call can be pulled out with a single pass over the Parameters. Buffers
+    sharing a parameter can share its slot, see collapse_aliases.
+    """
+
+    def __init__(self, parameters, ndata, broadcast=False, aliases=None):
+        # names in the order lmfit will hand them back to the objective.
+        self.names = list(parameters.keys())
+        self.ndata = ndata
+
+        # parameters left out of the fit as aliases of others (see
+        # collapse_aliases) take the slot of the parameter they stand for.
+        position = {name: slot for slot, name in enumerate(self.names)}
+        for name, target in (aliases or {}).items():
+            position[name] = position[target]
+
+        # slots[i] is the list of (argument, slot) pairs for dataset i
+        self.slots = [[] for _ in range(ndata)]
+        for name, slot in position.items():
+            arg, _, idx = name.rpartition('_')
+            idx = intify(idx)
+            if arg and idx is not None and 0 <= idx < ndata:
+                self.slots[idx].append((arg, slot))
+
+        # When every dataset takes the same arguments, each argument can be
+        # gathered for all datasets at once as a column of shape (ndata, 1).
+        # matrix is a list of (argument, slots of that argument) pairs.
+        self.matrix = None
+        args = [sorted(arg for arg, slot in s) for s in self.slots]
+        if args and all(a == args[0] for a in args):
+            self.matrix = [(arg, np.asarray([[dict(s)[arg]]
+                                             for s in self.slots]))
+                           for arg in args[0]]
+
+        # evaluate the model once over all datasets instead of in a loop.
+        self.broadcast = broadcast and self.matrix is not None
+
+    def __len__(self):
+        return self.ndata
+
+    def values(self, parameters):
+        """Return the current values of parameters, ordered by slot."""
+        return np.fromiter((p.value for p in parameters.values()),
+                           dtype=np.float64, count=len(self.names))
+
+    def arguments(self, values, i):
+        """Return the keyword arguments of the model for dataset i, given the
+        values returned by self.values."""
+        return {arg: values[slot] for arg, slot in self.slots[i]}
+
+    def columns(self, values):
+        """Return the keyword arguments of the model for all datasets at
+        once. Each argument is an array of shape (ndata, 1), which numpy
+        broadcasts against x to give an array of shape (ndata, len(x))."""
+        return {arg: values[slots] for arg, slots in self.matrix}
+
+
+class RaggedData(object):
+    """Datasets that each have their own x axis, of any length, for global
+    fits of e.g. stopped-flow shots with different numbers of points.
+
+    The datasets are not padded or interpolated onto a common grid. All of
+    their x and y values are stored end to end in one pair of 1D arrays, and
+    dataset i is the segment offsets[i]:offsets[i + 1] of them. The residual
+    vector of a fit has the same layout, so it is filled in segment by
+    segment. Indexing gives the y values of one dataset, like a row of the
+    2D data array of a fit of datasets sharing one x axis.
+    """
+
+    def __init__(self, ys, xs):
+        if len(ys) != len(xs):
+            raise ValueError("{0} datasets but {1} x axes"
+                             "".format(len(ys), len(xs)))
+        counts = [len(y) for y in ys]
+        for i, (y, x) in enumerate(zip(ys, xs)):
+            if len(y) != len(x):
+                raise ValueError("dataset {0} has {1} y values but {2} x "
+                                 "values".format(i, len(y), len(x)))
+
+        self.x = np.concatenate(xs).astype(np.float64)
+        self.y = np.concatenate(ys).astype(np.float64)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(int)
+        self.counts = np.asarray(counts, dtype=int)
+        self.slices = [slice(a, b) for a, b in zip(self.offsets[:-1],
+                                                   self.offsets[1:])]
+        # index[n] is the dataset that point n belongs to
+        self.index = np.repeat(np.arange(len(counts)), counts)
+
+    def __len__(self):
+        return len(self.slices)
+
+    def __getitem__(self, i):
+        return self.y[self.slices[i]]
+
+    def __iter__(self):
+        return (self.y[s] for s in self.slices)
+
+    def xs(self, i):
+        """Return the x values of dataset i."""
+        return self.x[self.slices[i]]
+
+    def expand(self, columns):
+        """Turn arguments from ParameterLayout.columns, one value for each
+        dataset, into one value for each point, so the model can be
+        evaluated for all the datasets at once over self.x."""
+        return {arg: column.ravel()[self.index]
+                for arg, column in columns.items()}
+
+    def replace(self, y):
+        """Return RaggedData with the same x axes, holding y (1D, in the
+        same layout as self.y) instead."""
+        new = object.__new__(RaggedData)
+        new.__dict__.update(self.__dict__)
+        new.y = np.asarray(y, dtype=np.float64)
+        return new
+
+
+class FitStats(object):
+    """Performance counters of one fit, kept with its result as result.stats,
+    to tell whether a slow fit is spent in the model or in overhead. Calls
+    of the objective and of the model are timed with time.perf_counter,
+    which costs far less than the calls themselves.
+
+    lmfit sets the values of the parameters and evaluates their expr before
+    each call of the objective, out of its sight. The time that takes is
+    estimated once the fit is done, see time_parameter_handling.
+    """
+
+    def __init__(self):
+        self.ncalls = 0  # calls of the objective
+        self.objective_seconds = 0.0
+        self.model_seconds = 0.0  # inside the model function
+        # Jacobian evaluations, counted by the minimizer, or by jacobians
+        self.njev = None
+        self.jacobians = None  # JacobianCounter of a leastsq fit
+        self.parameter_seconds = 0.0  # lmfit handling values and exprs
+        self.wall_seconds = 0.0
+        # datasets whose model output was reused / calculated (see ModelMemo)
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    @property
+    def memo_hit_rate(self):
+        """Fraction of the model outputs of datasets needed by calls of the
+        objective that were reused instead of calculated, or None if they
+        weren't memoized."""
+        total = self.memo_hits + self.memo_misses
+        return self.memo_hits / total if total else None
+
+    @property
+    def assembly_seconds(self):
+        """Time in the objective besides the model: gathering the values of
+        the parameters and making the residual array."""
+        return self.objective_seconds - self.model_seconds
+
+    @property
+    def minimizer_seconds(self):
+        """Time left over for the minimizer itself."""
+        return max(0.0, self.wall_seconds - self.objective_seconds -
+                   self.parameter_seconds)
+
+    def report(self):
+        """Return the counters as lines of text to print."""
+        wall = self.wall_seconds or 1.0
+        lines = ["objective calls         {0}".format(self.ncalls),
+                 "jacobian evaluations    {0}".format(
+                     "not counted" if self.njev is None else self.njev),
+                 "wall time               {0:10.4f} s".format(
+                     self.wall_seconds)]
+        for label, seconds in (("model", self.model_seconds),
+                               ("residual assembly", self.assembly_seconds),
+                               ("lmfit parameters (est)",
+                                self.parameter_seconds),
+                               ("minimizer", self.minimizer_seconds)):
+            lines.append("{0:<24}{1:10.4f} s {2:6.1f}%".format(
+                label, seconds, 100 * seconds / wall))
+        if self.memo_hit_rate is not None:
+            lines.append("datasets reused         {0} of {1} ({2:.1f}%)".format(
+                self.memo_hits, self.memo_hits + self.memo_misses,
+                100 * self.memo_hit_rate))
+        return lines
+
+
+class JacobianCounter(object):
+    """Counts the Jacobians leastsq works out by finite differences, which
+    MINPACK doesn't report, from the calls of the objective it makes: after
+    the call at a point, one call per free parameter, in the order of
+    var_names, each stepping only that parameter, and by a small fraction
+    of it. Called with the parameters at each call of the objective.
+    """
+
+    # largest step of a finite difference, relative to the value stepped,
+    # or to 1 for values smaller than that. lmfit's leastsq steps each by
+    # 1e-5 of it (epsfcn=1e-10) in its internal, possibly bounded, values.
+    MAX_STEP = 1e-3
+
+    def __init__(self, var_names):
+        self.var_names = list(var_names)
+        self.njev = 0
+        self.base = None  # the values at the point differenced around
+        self.column = 0  # the parameter the next call should step
+
+    def __call__(self, parameters):
+        values = np.asarray([parameters[name].value
+                             for name in self.var_names])
+        if self.base is not None and self.column < len(values):
+            step = np.abs(values - self.base)
+            moved = np.flatnonzero(step)
+            if (len(moved) == 1 and moved[0] == self.column and
+                    step[self.column] <= self.MAX_STEP *
+                    max(abs(self.base[self.column]), 1.0)):
+                self.column += 1
+                if self.column == len(values):
+                    self.njev += 1
+                return
+        # a new point, e.g. a trial step
+        self.base = values
+        self.column = 0
+
+
+def time_parameter_handling(parameters, ncalls, repeats=10):
+    """Estimate the time lmfit spent over ncalls calls of the objective
+    setting the values of the varying parameters and evaluating the expr of
+    the linked ones, by timing repeats rounds of the same on a copy of
+    parameters."""
+    if not ncalls:
+        return 0.0
+    pars = params.deep_copy(parameters)
+    var_pars = [par for par in pars.values() if par.vary and not par.expr]
+
+    began = time.perf_counter()
+    for _ in range(repeats):
+        for par in var_pars:
+            par.value = par.value
+        pars.update_constraints()
+    return (time.perf_counter() - began) / repeats * ncalls
+
+
+class FitAborted(Exception):
+    """Raised from the objective to stop a minimizer that has no other way
+    of being stopped, i.e. scipy's least_squares."""
+
+
+class FitBudget(object):
+    """Limits on how long a fit may run, and the best parameters it has seen
+    so far. Called after every call of the objective as lmfit's iter_cb:
+    once the fit has run for max_time seconds or max_nfev calls, it returns
+    True, which makes lmfit stop the fit. A fit that is stopped, by its
+    budget or by Ctrl-C, then gives back the best parameters seen instead of
+    those of its last call (see keep_best).
+    """
+
+    def __init__(self, max_time=None, max_nfev=None, iter_cb=None):
+        self.max_time = max_time
+        self.max_nfev = max_nfev
+        # another iter_cb to call first, e.g. debug_fitting
+        self.iter_cb = iter_cb
+        self.began = time.perf_counter()
+        self.nfev = 0
+        self.var_names = None
+        self.best_chisqr = np.inf
+        self.best = None  # {name: value} of each free parameter
+        self.reason = None  # why the fit was stopped, if it was
+
+    def __call__(self, parameters, iteration, resid, *args, **kwargs):
+        if self.iter_cb is not None:
+            self.iter_cb(parameters, iteration, resid, *args, **kwargs)
+        self.nfev += 1
+
+        chisqr = np.dot(resid, resid)
+        if chisqr < self.best_chisqr:
+            if self.var_names is None:
+                self.var_names = [name for name, par in parameters.items()
+                                  if par.vary and not par.expr]
+            self.best_chisqr = chisqr
+            self.best = {name: parameters[name].value
+                         for name in self.var_names}
+
+        # ask to stop only once. lmfit calls the objective again to clean up.
+        if self.reason is not None:
+            return False
+        if self.max_nfev is not None and self.nfev >= self.max_nfev:
+            self.reason = "{0} function evaluations".format(self.nfev)
+        elif (self.max_time is not None and
+              time.perf_counter() - self.began >= self.max_time):
+            self.reason = "{0} seconds".format(self.max_time)
+        return self.reason is not None
+
+
+def keep_best(result, budget, fcn, args):
+    """Put the best parameters seen by the budget of a stopped fit into its
+    result, with the statistics of the fit at those parameters, and mark it
+    as not converged. Uncertainties are not estimated."""
+    for name, value in budget.best.items():
+        result.params[name].value = value
+    result.params.update_constraints()
+    set_statistics(result, fcn(result.params, *args))
+
+    for par in result.params.values():
+        par.stderr = None
+        par.correl = None
+    result.errorbars = False
+    result.success = False
+    result.aborted = True
+    result.stopped = budget.reason
+    result.message = ("Stopped after {0}, before converging. These are the "
+                      "best parameters found.".format(budget.reason))
+
+
+class WorkBuffers(object):
+    """The model-output array of a fit, allocated once and filled in by
+    every call of the objective. Models that write into an out argument
+    (see models.WRITES_OUT) are evaluated straight into it, so the only
+    new array in a call of the objective is the residual array it returns.
+    That one can't be reused: the minimizers keep residual arrays from
+    earlier calls, e.g. to take finite differences.
+    """
+
+    def __init__(self, data, model, stats=None):
+        if isinstance(data, RaggedData):
+            shape = data.y.shape
+        else:
+            shape = data.shape
+        self.writes_out = models.writes_out(model)
+        self.model = np.empty(shape)
+        # FitStats of the fit, if its calls should be counted.
+        self.stats = stats
+        # ModelMemo of the fit, if outputs of datasets are reused.
+        self.memo = None
+
+    def evaluate(self, model, x, kwargs, out):
+        """Write the result of model(x, **kwargs) into out, a view of
+        self.model."""
+        if self.stats is not None:
+            began = time.perf_counter()
+        if self.writes_out:
+            model(x, out=out, **kwargs)
+        else:
+            out[...] = model(x, **kwargs)
+        if self.stats is not None:
+            self.stats.model_seconds += time.perf_counter() - began
+
+
+class ModelMemo(object):
+    """The model outputs of each dataset of a global fit, kept by the values
+    of that dataset's arguments, so that a call of the objective only
+    evaluates the model for the datasets whose arguments changed.
+
+    Finite difference Jacobians change one parameter at a time, which for
+    most parameters of a global fit belongs to one dataset. The output of
+    every other dataset is then still in the model array of WorkBuffers
+    from the call before, and that of the dataset changed by the call
+    before is the one it had at the base point. Each dataset keeps its last
+    size outputs, least recently used dropped first, which is enough to
+    come back to the base point after stepping each of its arguments.
+    """
+
+    # most bytes of model output kept, over all the datasets of a fit
+    MAX_BYTES = 64 * 2 ** 20
+
+    def __init__(self, layout, data, work, size=None):
+        # slots of the arguments of each dataset, in one order
+        self.slots = [np.asarray([slot for _, slot in sorted(s)], dtype=int)
+                      for s in layout.slots]
+        self.matrix = None
+        if layout.matrix is not None:
+            self.matrix = np.hstack([slots for _, slots in layout.matrix])
+        if size is None:
+            nargs = max(len(s) for s in self.slots)
+            size = int(min(nargs + 2,
+                           max(1, self.MAX_BYTES // work.model.nbytes)))
+        self.size = size
+
+        # the part of the model array of WorkBuffers holding each dataset
+        if isinstance(data, RaggedData):
+            self.views = [work.model[s] for s in data.slices]
+        else:
+            self.views = list(work.model)
+        self.cache = [OrderedDict() for _ in self.slots]
+        self.last = None  # argument values of each dataset at the last call
+        self.keys = {}  # dataset -> key of the outputs to be calculated
+        self.hits = 0
+        self.misses = 0
+
+    def arguments(self, values):
+        if self.matrix is not None:
+            return values[self.matrix]
+        return [values[slots] for slots in self.slots]
+
+    def update(self, values):
+        """Bring the model array up to date for values, as far as it can be
+        without calling the model. Returns the datasets whose outputs must
+        be calculated, which should then be passed to store."""
+        current = self.arguments(values)
+        if self.last is None:
+            changed = range(len(self.slots))
+        elif self.matrix is not None:
+            changed = np.flatnonzero(np.any(current != self.last, axis=1))
+        else:
+            changed = [i for i, (a, b) in enumerate(zip(current, self.last))
+                       if np.any(a != b)]
+        self.last = current
+        self.hits += len(self.slots) - len(changed)
+
+        todo = []
+        self.keys = {}
+        for i in changed:
+            key = current[i].tobytes()
+            found = self.cache[i].get(key)
+            if found is None:
+                todo.append(i)
+                self.keys[i] = key
+            else:
+                self.cache[i].move_to_end(key)
+                self.views[i][...] = found
+                self.hits += 1
+        self.misses += len(todo)
+        return todo
+
+    def store(self, todo):
+        """Keep the outputs just calculated for the datasets in todo."""
+        for i in todo:
+            cache = self.cache[i]
+            cache[self.keys[i]] = self.views[i].copy()
+            if len(cache) > self.size:
+                cache.popitem(last=False)
+
+
+def evaluate_datasets(work, model, x, data, layout, values, todo):
+    """Evaluate the model for only the datasets in todo, into the model array
+    of work. A model that broadcasts is called once for all of them."""
+    out = work.model
+    if not len(todo):
+        return
+    if layout.broadcast and not isinstance(data, RaggedData):
+        rows = np.asarray(todo, dtype=int)
+        kwargs = {arg: values[slots[rows]] for arg, slots in layout.matrix}
+        if len(rows) == 1:
+            work.evaluate(model, x, kwargs, out[rows[0]:rows[0] + 1])
+        else:
+            part = np.empty((len(rows), out.shape[1]))
+            work.evaluate(model, x, kwargs, part)
+            out[rows] = part
+    elif isinstance(data, RaggedData):
+        for i in todo:
+            s = data.slices[i]
+            work.evaluate(model, x[s], layout.arguments(values, i), out[s])
+    else:
+        for i in todo:
+            work.evaluate(model, x, layout.arguments(values, i), out[i])
+
+
+def dataset_x(data, x, i):
+    """Return the x values of dataset i of data, as passed to fit."""
+    if isinstance(data, RaggedData):
+        return data.xs(i)
+    return x
+
+
+def generate_dataset(parameters, i, x, model, layout=None):
     """calc data from params for data set i. This function depends on the
     essential requirement that ALL Parameter names are in the form:
     name_i
     where name is the parameter name, and i is the number buffer that
-    it is tied to. This is run thousands of times. If any optimization must be
-    done, it should be here.
+    it is tied to.
 
     Parameters
     ----------
@@ -28,19 +517,20 @@ def generate_dataset(parameters, i, x, model):
             Index of dataset to have its model result calculated. Used to
             determine which Parameter objects belong to which datasets.
         x: np.ndarray (1D)
-            X-axis values that data was collected at.
+            X-axis values that dataset i was collected at (see dataset_x).
         model: function object
             The actual function used to calculate the fit.
+        layout: ParameterLayout, optional
+            The layout of parameters built for the fit. Created from
+            parameters if not given.
     """
-    # get all the parameters whose names end in the number i, and assign them
-    # to the actual parameter names of the model, then run the model.
-    parameters = {re.sub('_[0-9]*', '', k): v.value for k, v in parameters.items()
-                  if name_scheme_match(k, i)}
+    if layout is None:
+        layout = ParameterLayout(parameters, i + 1)
 
-    return model(x, **parameters)
+    return model(x, **layout.arguments(layout.values(parameters), i))
 
 
-def calc_resids(parameters, data, i, x, model):
+def calc_resids(parameters, data, i, x, model, layout=None):
     """Calculate the residuals for dataset i in data.
 
     Parameters
@@ -48,15 +538,17 @@ def calc_resids(parameters, data, i, x, model):
         parameters: lmfit.Parameters
             OrderedDict of lmfit.Parameter objects that will be passed to
             the objective function to be dispatched to the model function.
-        data: np.ndarray (multi-dimensional)
+        data: np.ndarray (multi-dimensional) or RaggedData
             Experimental data. Passed to objective to calculate residuals.
         i: int
             Index of dataset to have its model result calculated. Used to
             determine which Parameter objects belong to which datasets.
         x: np.ndarray (1D)
-            X-axis values that data was collected at.
+            X-axis values that data was collected at, as passed to fit.
         model: function object
             The actual function used to calculate the fit.
+        layout: ParameterLayout, optional
+            The layout of parameters built for the fit.
 
     Returns
     -------
@@ -64,11 +556,12 @@ def calc_resids(parameters, data, i, x, model):
         subtracting experimental y-values from calculated y-values from the
         model function using the parameters applicable to dataset i."""
     resid = 0.0 * data[i]
-    resid[:] = data[i, :] - generate_dataset(parameters, i, x, model)
+    resid[:] = data[i] - generate_dataset(parameters, i,
+                                          dataset_x(data, x, i), model, layout)
     return resid.flatten()
 
 
-def objective(parameters, x, data, model):
+def objective(parameters, x, data, model, layout, work=None):
     """Calculate total residual for fits to either a single dataset or
     multiple datasets contained in a 2D array, and fit to the model. Used by
     lmfit's minimization methods to calculate the fit. This runs thousands of
@@ -80,11 +573,17 @@ def objective(parameters, x, data, model):
             OrderedDict of lmfit.Parameter objects that will be passed to
             the objective function to be dispatched to the model function.
         x: np.ndarray (1D)
-            X-axis values that data was collected at.
-        data: np.ndarray (multi-dimensional)
+            X-axis values that data was collected at. For RaggedData, the
+            x values of all the datasets end to end, i.e. data.x.
+        data: np.ndarray (multi-dimensional) or RaggedData
             Experimental data. Passed to objective to calculate residuals.
         model: function object
             The actual function used to calculate the fit.
+        layout: ParameterLayout
+            Which parameters belong to which dataset. Built once by fit.
+        work: WorkBuffers, optional
+            Array the model is evaluated into. Built once by fit. If not
+            given, one is made for this call.
 
     Returns
     -------
@@ -92,31 +591,483 @@ def objective(parameters, x, data, model):
         subtracting experimental y-values from calculated y-values from the
         model function.
         """
-    ndata = data.shape
-    if len(data.shape) == 1:  # fit a single dataset
-        print("\n\n\n\n\nYou should never see this\n\n\n\n\n")
-        resid = 0.0 * data[:]
-        resid[:] = data[:] - generate_dataset(parameters, 0, x, model)
-        return resid.flatten()
-
-    elif len(data.shape) == 2:  # fit multiple datasets
-        resid = 0.0 * data[:]
-        # make residual per data set
-        for i in range(ndata[0]):
-            resid[i, :] = data[i, :] - generate_dataset(parameters, i, x, model)
-        # now flatten this to a 1D array, as minimize() needs
-        return resid.flatten()
-
-
-def fit(data, x, model, parameters, debug=False, **kwargs):
+    if work is None:
+        work = WorkBuffers(data, model)
+    if work.stats is not None:
+        began = time.perf_counter()
+    # one pass over the parameters, no name matching.
+    values = layout.values(parameters)
+    out = work.model
+
+    todo = None
+    if work.memo is not None:
+        todo = work.memo.update(values)
+
+    if todo is not None and len(todo) < len(data):
+        # only the datasets whose arguments changed
+        evaluate_datasets(work, model, x, data, layout, values, todo)
+        if isinstance(data, RaggedData):
+            resid = np.subtract(data.y, out)
+        else:
+            resid = np.subtract(data, out).ravel()
+
+    elif isinstance(data, RaggedData):  # datasets with their own x axes
+        if layout.broadcast:
+            work.evaluate(model, x, data.expand(layout.columns(values)), out)
+        else:
+            for i, s in enumerate(data.slices):
+                work.evaluate(model, x[s], layout.arguments(values, i),
+                              out[s])
+        resid = np.subtract(data.y, out)
+
+    else:
+        if len(data.shape) == 1:  # fit a single dataset
+            print("\n\n\n\n\nYou should never see this\n\n\n\n\n")
+            work.evaluate(model, x, layout.arguments(values, 0), out)
+
+        elif len(data.shape) == 2:  # fit multiple datasets
+            if layout.broadcast:
+                # a single call of the model calculates every dataset.
+                work.evaluate(model, x, layout.columns(values), out)
+            else:
+                # make residual per data set
+                for i in range(data.shape[0]):
+                    work.evaluate(model, x, layout.arguments(values, i),
+                                  out[i])
+
+        # minimize() needs a 1D array. The new array is contiguous, so this
+        # is a view, not a copy.
+        resid = np.subtract(data, out).ravel()
+
+    if todo:
+        work.memo.store(todo)
+    if work.stats is not None:
+        work.stats.ncalls += 1
+        if work.stats.jacobians is not None:
+            work.stats.jacobians(parameters)
+        work.stats.objective_seconds += time.perf_counter() - began
+    return resid
+
+
+def projected_arguments(parameters, layout, model):
+    """Return the arguments of the model that can be solved for by linear
+    least squares instead of by the minimizer. They must be listed in
+    models.LINEAR_PARAMETERS, and the parameter of every dataset for that
+    argument must vary freely: no expr, no bounds, not shared.
+
+    Parameters
+    ----------
+        parameters: lmfit.Parameters
+            All the parameters of the fit.
+        layout: ParameterLayout
+            Which parameters belong to which dataset. Must broadcast.
+        model: function object
+            The model function.
+
+    Returns
+    -------
+        list of the names of the projected arguments, e.g. ['slope']
+    """
+    if not layout.broadcast:
+        return []
+
+    linear = []
+    for arg, slots in layout.matrix:
+        if arg not in models.linear_parameters(model):
+            continue
+        pars = [parameters[layout.names[slot]] for slot in slots.ravel()]
+        shared = len(set(slots.ravel())) < len(pars)
+        if not shared and all(par.vary and not par.expr and
+                              par.min == -np.inf and par.max == np.inf
+                              for par in pars):
+            linear.append(arg)
+    return linear
+
+
+def solve_linear(values, x, data, model, layout, linear):
+    """For the given values of all the other parameters, find the values of
+    the linear arguments of the model that best fit each dataset. The model
+    is a linear combination of the columns of a basis (one column for each
+    linear argument, plus an offset), so the best values are found for all
+    datasets at once with a batched pseudo-inverse.
+
+    Parameters
+    ----------
+        values: np.ndarray (1D)
+            The values of all parameters, from layout.values.
+        x: np.ndarray (1D)
+            X-axis values that data was collected at.
+        data: np.ndarray (2D)
+            Experimental data.
+        model: function object
+            The model function. Must be able to broadcast.
+        layout: ParameterLayout
+            Which parameters belong to which dataset.
+        linear: list
+            The linear arguments, from projected_arguments.
+
+    Returns
+    -------
+        coefs: np.ndarray of shape (ndata, len(linear))
+            Best values of the linear arguments for each dataset.
+        resid: np.ndarray (2D)
+            Residuals of the fit with those values, same shape as data.
+    """
+    columns = layout.columns(values)
+    for arg in linear:
+        columns[arg] = np.zeros((len(layout), 1))
+    offset = np.broadcast_to(model(x, **columns), data.shape)
+
+    # the part of the model each linear argument multiplies
+    basis = np.empty(data.shape + (len(linear),))
+    for k, arg in enumerate(linear):
+        columns[arg] = np.ones((len(layout), 1))
+        basis[..., k] = model(x, **columns) - offset
+        columns[arg] = np.zeros((len(layout), 1))
+
+    target = (data - offset)[..., np.newaxis]
+    coefs = np.matmul(np.linalg.pinv(basis, rcond=1e-10), target)
+    resid = target - np.matmul(basis, coefs)
+
+    return coefs[..., 0], resid[..., 0]
+
+
+def projected_objective(parameters, x, data, model, layout, linear,
+                        stats=None):
+    """Objective for variable projection fits. The same as objective, except
+    the linear arguments of the model are solved for exactly with
+    solve_linear, so their Parameters are ignored. The minimizer only has
+    to find the values of the nonlinear parameters. Calls are counted in
+    stats, if given, but the model is not timed on its own."""
+    if stats is not None:
+        began = time.perf_counter()
+    values = layout.values(parameters)
+    resid = solve_linear(values, x, data, model, layout, linear)[1].flatten()
+    if stats is not None:
+        stats.ncalls += 1
+        if stats.jacobians is not None:
+            stats.jacobians(parameters)
+        stats.objective_seconds += time.perf_counter() - began
+    return resid
+
+
+def expression_names(expr):
+    """Return the set of names used in a constraint expression, e.g.
+    'deltag_0 * 2 + m_1' -> {'deltag_0', 'm_1'}"""
+    return {node.id for node in ast.walk(ast.parse(expr))
+            if isinstance(node, ast.Name)}
+
+
+def free_parameters(parameters, name, found=None):
+    """Return the set of names of the varying parameters that the parameter
+    with the given name depends on. That is itself if it varies freely, the
+    free parameters in its expr if it is linked to other parameters, or
+    nothing if it is fixed.
+
+    Parameters
+    ----------
+        parameters: lmfit.Parameters
+            All the parameters of the fit.
+        name: string
+            Name of the parameter.
+        found: dict, optional
+            Results of previous calls, so shared expressions are only
+            followed once.
+    """
+    if found is None:
+        found = {}
+    if name in found:
+        return found[name]
+
+    par = parameters.get(name)
+    if par is None:  # a name in an expr that isn't a parameter, e.g. 'pi'
+        roots = set()
+    elif par.expr:
+        roots = set()
+        for dep in expression_names(par.expr):
+            roots |= free_parameters(parameters, dep, found)
+    elif par.vary:
+        roots = {name}
+    else:
+        roots = set()
+
+    found[name] = roots
+    return roots
+
+
+def pure_aliases(parameters):
+    """Return {name: target} for every parameter whose expr is nothing but
+    the name of another parameter, e.g. deltag_3 = 'deltag_0', as the
+    parameters window links buffers. Chains of aliases are followed to the
+    parameter at the end. An alias with bounds of its own (other than those
+    of its target) is left out, since lmfit clips its value to them."""
+    direct = {}
+    for name, par in parameters.items():
+        expr = (par.expr or '').strip()
+        if expr in parameters and expr != name:
+            direct[name] = expr
+
+    aliases = {}
+    for name in direct:
+        target, seen = name, {name}
+        while target in direct and direct[target] not in seen:
+            target = direct[target]
+            seen.add(target)
+        if target in direct:  # a loop, which lmfit will complain about
+            continue
+        end = parameters[target]
+        if all((parameters[n].min, parameters[n].max) in
+               ((-np.inf, np.inf), (end.min, end.max))
+               for n in seen - {target}):
+            aliases[name] = target
+    return aliases
+
+
+def collapse_aliases(parameters):
+    """Split pure aliases (see pure_aliases) off the parameters, so that a fit
+    doesn't carry them, and lmfit doesn't evaluate them with asteval at
+    every step. The objective gets their values from the slot of the
+    parameter each stands for instead, see ParameterLayout. Aliases used in
+    the expr of another parameter are kept.
+
+    Returns
+    -------
+        reduced: lmfit.Parameters
+            A copy of parameters without the aliases, or parameters itself
+            if there are none.
+        aliases: dict
+            {name: target} of the aliases left out.
+    """
+    aliases = pure_aliases(parameters)
+    # keep whatever the remaining expressions refer to, until none are left
+    while True:
+        used = set()
+        for name, par in parameters.items():
+            if par.expr and name not in aliases:
+                used |= expression_names(par.expr)
+        if not used & set(aliases):
+            break
+        for name in used & set(aliases):
+            del aliases[name]
+
+    if not aliases:
+        return parameters, aliases
+
+    reduced = Parameters()
+    for name, par in parameters.items():
+        if name not in aliases:
+            reduced.add(name=par.name, value=par.value, vary=par.vary,
+                        min=par.min, max=par.max, expr=par.expr,
+                        brute_step=par.brute_step)
+    return reduced, aliases
+
+
+def expand_aliases(result, parameters, aliases):
+    """Put the aliases left out of a fit by collapse_aliases back into
+    result.params, in the order of the original parameters, each with the
+    value and uncertainty of the parameter it stands for."""
+    fitted = result.params
+    full = Parameters()
+    for name, par in parameters.items():
+        if name in aliases:
+            full.add(name=name, value=fitted[aliases[name]].value,
+                     min=par.min, max=par.max, expr=par.expr)
+        else:
+            full.add(fitted[name])
+    full.update_constraints()
+
+    for name, target in aliases.items():
+        full[name].stderr = fitted[target].stderr
+    result.params = full
+
+
+def jacobian_sparsity(parameters, layout, npoints):
+    """Work out which residuals can change when each varying parameter
+    changes. Parameters tied to one buffer only affect the residuals of that
+    buffer, and parameters linked across buffers (through expr) affect every
+    buffer they are linked to.
+
+    Parameters
+    ----------
+        parameters: lmfit.Parameters
+            All the parameters of the fit.
+        layout: ParameterLayout
+            Which parameters belong to which dataset.
+        npoints: int or np.ndarray (1D)
+            Number of points in each dataset, or, for datasets of different
+            lengths, the number of points of each one (RaggedData.counts).
+
+    Returns
+    -------
+        scipy.sparse.csr_matrix of shape (total points, nvarys), with a
+        nonzero wherever the Jacobian may be nonzero. Columns are in the
+        order lmfit gives the varying parameters to the minimizer.
+    """
+    # lmfit only hands parameters that vary freely to the minimizer
+    var_names = [name for name, par in parameters.items()
+                 if par.vary and not par.expr]
+    column = {name: j for j, name in enumerate(var_names)}
+
+    # which free parameters affect each dataset
+    found = {}
+    blocks = np.zeros((len(layout), len(var_names)), dtype=bool)
+    for i, slots in enumerate(layout.slots):
+        for arg, slot in slots:
+            for root in free_parameters(parameters, layout.names[slot], found):
+                blocks[i, column[root]] = True
+
+    # every point in a dataset depends on the same parameters
+    if np.ndim(npoints) == 0:
+        return kron(csr_matrix(blocks), csr_matrix(np.ones((npoints, 1))),
+                    format='csr')
+    return csr_matrix(blocks)[np.repeat(np.arange(len(layout)), npoints)]
+
+
+def set_statistics(result, residual):
+    """Fill in the goodness-of-fit statistics of the result, the same way
+    lmfit does, from the final residual array of the fit."""
+    result.residual = residual
+    result.ndata = len(residual)
+    result.nfree = result.ndata - result.nvarys
+    result.chisqr = max((residual ** 2).sum(), 1.e-250 * result.ndata)
+    result.redchi = result.chisqr / max(1, result.nfree)
+    neg2_log_likel = result.ndata * np.log(result.chisqr / result.ndata)
+    result.aic = neg2_log_likel + 2 * result.nvarys
+    result.bic = neg2_log_likel + np.log(result.ndata) * result.nvarys
+
+
+def set_uncertainties(result, jac, scale_covar=True):
+    """Estimate the covariance of the varying parameters of the result from
+    the Jacobian at the best fit, and set the stderr and correl of each of
+    them. Parameters linked to exactly one other parameter (as buffers
+    sharing a parameter are) get the uncertainty of that parameter. Those
+    with any other expr get it propagated through their expr, with the
+    correlations, as lmfit does (see lmfit.Parameters.create_uvars).
+
+    Parameters
+    ----------
+        result: lmfit.MinimizerResult
+            Result whose statistics are already set, see set_statistics.
+        jac: np.ndarray or scipy sparse matrix
+            Jacobian of the residuals w.r.t. result.var_names.
+        scale_covar: bool
+            Whether to scale the covariance matrix by reduced chi square.
+    """
+    hess = jac.T.dot(jac)
+    if hasattr(hess, 'toarray'):
+        hess = hess.toarray()
+    try:
+        covar = np.linalg.inv(hess)
+    except np.linalg.LinAlgError:
+        result.errorbars = False
+        return
+
+    if scale_covar:
+        covar *= result.redchi
+    result.covar = covar
+
+    stderr = np.sqrt(np.abs(np.diag(covar)))
+    for j, name in enumerate(result.var_names):
+        par = result.params[name]
+        par.stderr = stderr[j]
+        par.correl = {other: covar[j, k] / (stderr[j] * stderr[k])
+                      for k, other in enumerate(result.var_names)
+                      if k != j and stderr[j] * stderr[k] > 0}
+
+    result.errorbars = bool(np.all(stderr > 0))
+    for name, par in result.params.items():
+        if par.expr and par.expr.strip() in result.var_names:
+            par.stderr = result.params[par.expr.strip()].stderr
+        elif par.expr and result.errorbars:
+            # only worth it for a real expression; it evaluates them all.
+            result.uvars = result.params.create_uvars(covar=covar)
+            break
+
+
+def sparse_least_squares(parameters, args, jac_sparsity, fcn=objective,
+                         iter_cb=None, scale_covar=True, **kwargs):
+    """Minimize the objective with scipy's least_squares (Trust Region
+    Reflective), telling it which residuals each varying parameter can
+    change. scipy then groups parameters that affect disjoint residuals, and
+    estimates the Jacobian columns of a whole group with a single call of
+    the objective, and solves each step with sparse linear algebra.
+
+    lmfit's own least_squares method densifies or mishandles sparse
+    Jacobians, so the minimization is done here, using lmfit only to
+    prepare the Parameters.
+
+    Parameters
+    ----------
+        parameters: lmfit.Parameters
+            Starting parameters. Not changed by the fit.
+        args: tuple
+            Extra arguments to objective, i.e. (x, data, model, layout).
+        jac_sparsity: scipy sparse matrix
+            As returned by jacobian_sparsity.
+        fcn: function, optional
+            The objective function. objective by default.
+        iter_cb: function, optional
+            Called after each evaluation of the objective, like lmfit's
+            iter_cb. If it returns True, FitAborted is raised.
+        scale_covar: bool, optional
+            Whether to scale the covariance matrix by reduced chi square.
+        kwargs:
+            Passed on to scipy.optimize.least_squares.
+
+    Returns
+    -------
+        lmfit.MinimizerResult
+    """
+    minimizer = Minimizer(fcn, parameters, fcn_args=args)
+    result = minimizer.prepare_fit()
+    result.method = 'least_squares'
+    pars = result.params
+
+    var_pars = [pars[name] for name in result.var_names]
+    bounds = ([par.min for par in var_pars], [par.max for par in var_pars])
+
+    def residual(fvars, callback=True):
+        for par, val in zip(var_pars, fvars):
+            par.value = val
+        pars.update_constraints()
+        result.nfev += 1
+        resid = fcn(pars, *args)
+        if callback and iter_cb is not None:
+            # like lmfit, stop when iter_cb returns True
+            if iter_cb(pars, result.nfev, resid, *args):
+                raise FitAborted()
+        return resid
+
+    kwargs.setdefault('max_nfev', 2000 * (result.nvarys + 1))
+    ret = least_squares(residual, result.init_vals, bounds=bounds,
+                        jac_sparsity=jac_sparsity, **kwargs)
+
+    # leave the parameters at the best fit, not at the last evaluation.
+    set_statistics(result, residual(ret.x, callback=False))
+    result.nfev -= 1
+    result.success = ret.success
+    result.message = ret.message
+    result.status = ret.status
+    result.x = ret.x
+    result.njev = ret.njev
+    set_uncertainties(result, ret.jac, scale_covar)
+    return result
+
+
+def fit(data, x, model, parameters, debug=False, broadcast=True, sparse=True,
+        varpro=False, cache=False, max_time=None, max_nfev=None,
+        checkpoint=False, checkpoint_every=None, memoize=True, **kwargs):
     """Fit the data [a 1-d array] to the model with the x axis [a 1-d array].
 
     Parameters
     ----------
-        data: np.ndarray (multi-dimensional)
+        data: np.ndarray (multi-dimensional) or RaggedData
             Experimental data. Passed to objective to calculate residuals.
+            Datasets that don't share one x axis are fit as RaggedData,
+            with no interpolation.
         x: np.ndarray (1D)
-            X-axis values that data was collected at.
+            X-axis values that data was collected at. For RaggedData, the
+            x values of all the datasets end to end, i.e. data.x.
         model: string OR function object
             The model function that data should be fit to. Either the name of
             the function (or alias) defined in src.models.py, or the actual
@@ -127,6 +1078,47 @@ def fit(data, x, model, parameters, debug=False, **kwargs):
         debug: boolean
             If true, fitting routine will print its values for parameters at
             each iteration.
+        broadcast: boolean
+            If true, and the model is listed in models.BROADCASTABLE, the
+            model is evaluated once for all datasets at every iteration,
+            instead of once per dataset.
+        sparse: boolean
+            If true, and the method is 'least_squares', tell the minimizer
+            which parameters affect which datasets (see jacobian_sparsity
+            and sparse_least_squares). Its finite difference Jacobian then
+            perturbs many unlinked parameters with each evaluation of the
+            model, instead of one.
+        varpro: boolean
+            If true, solve for the arguments the model is linear in (see
+            models.LINEAR_PARAMETERS) exactly at every step, so the
+            minimizer only varies the nonlinear parameters. The model must
+            be able to broadcast, and the datasets must share one x axis.
+            Uncertainties are not estimated for the linear parameters.
+        cache: boolean
+            If true, look for the result in the fit cache on disk (see
+            src.cache) before fitting, and store it there after. A result
+            from the cache has result.cached set to True.
+        max_time: float, optional
+            Stop the fit after this many seconds.
+        max_nfev: int, optional
+            Stop the fit after this many calls of the objective.
+            A fit that is stopped, by either limit or by Ctrl-C, returns the
+            best parameters it found, with result.success False and the
+            reason in result.stopped (see FitBudget).
+        checkpoint: boolean or checkpoint.Checkpoint
+            If true, write the state of the fit to disk as it runs (see
+            src.checkpoint), so that if it is stopped or interrupted it can
+            be continued with resume_fit. The checkpoint is deleted once the
+            fit converges. result.checkpoint is the key of the checkpoint.
+            resume_fit passes the Checkpoint it continues.
+        checkpoint_every: float, optional
+            Seconds between checkpoints. Defaults to checkpoint.EVERY.
+        memoize: boolean
+            If true, and there is more than one dataset, keep the model
+            output of each dataset by the values of its arguments, and only
+            evaluate the model for the datasets whose arguments changed
+            since (see ModelMemo). The fraction reused is in
+            result.stats.memo_hit_rate.
 
     Returns
     -------
@@ -148,16 +1140,662 @@ def fit(data, x, model, parameters, debug=False, **kwargs):
     if isinstance(model, str):
         model = models.get_models(model)
 
-    if debug:
-        iter_cb = debug_fitting
+    # everything that changes the outcome of the fit, besides debug
+    options = dict(kwargs, broadcast=broadcast, sparse=sparse,
+                   varpro=varpro, max_time=max_time, max_nfev=max_nfev)
+    if cache or checkpoint is True:
+        key = fit_cache.fit_key(data, x, model, parameters, options)
+
+    if cache:
+        result = fit_cache.load(key)
+        if result is not None:
+            result.cached = True
+            return result, data, x, model
+
+    stats = FitStats()
+    began = time.perf_counter()
+
+    # keeps the best parameters, and stops the fit when it runs out
+    budget = FitBudget(max_time, max_nfev,
+                       iter_cb=debug_fitting if debug else None)
+    iter_cb = budget
+
+    saved = None
+    if checkpoint is True:
+        saved = fit_checkpoint.Checkpoint(key, data, x, model, parameters,
+                                          options, every=checkpoint_every)
+        saved.start()
+    elif checkpoint:  # continuing one, see resume_fit
+        saved = checkpoint
+        if checkpoint_every is not None:
+            saved.every = checkpoint_every
+    if saved is not None:
+        saved.watch(budget)
+        iter_cb = saved
+        if (kwargs.get('method') == 'differential_evolution' and
+                kwargs.get('callback') is None):
+            kwargs['callback'] = saved.population_callback
+
+    ragged = isinstance(data, RaggedData)
+
+    # buffers linked by an expr that just names another parameter share
+    # its slot instead, so lmfit never sees those links.
+    linked = parameters
+    parameters, aliases = collapse_aliases(parameters)
+
+    # work out which parameters belong to which dataset once, up front.
+    layout = ParameterLayout(parameters, len(data),
+                             broadcast=(broadcast and
+                                        (ragged and
+                                         not models.needs_uniform_x(model)
+                                         or not ragged and data.ndim == 2)
+                                        and models.broadcasts(model)),
+                             aliases=aliases)
+
+    fcn = objective
+    args = (x, data, model, layout)
+
+    if varpro and ragged:
+        print("Parameters can only be solved for linearly when all buffers "
+              "share the same x values. Fitting them all instead.")
+        varpro = False
+
+    memo = None
+    linear = projected_arguments(parameters, layout, model) if varpro else []
+    if linear:
+        # the minimizer only sees the nonlinear parameters.
+        outer = params.deep_copy(parameters)
+        for arg, slots in layout.matrix:
+            if arg in linear:
+                for slot in slots.ravel():
+                    outer[layout.names[slot]].vary = False
+        parameters = outer
+        fcn = projected_objective
+        args += (linear, stats)
     else:
-        iter_cb = None
+        if varpro:
+            print("No parameters of {0} can be solved for linearly. They must"
+                  " vary, and have no bounds or expr.".format(model.__name__))
+        # the model is evaluated into the same array at every call
+        work = WorkBuffers(data, model, stats)
+        if memoize and len(data) > 1:
+            work.memo = memo = ModelMemo(layout, data, work)
+        args += (work,)
+
+    jac_sparsity = None
+    if (sparse and kwargs.get('method') == 'least_squares' and
+            (ragged or data.ndim == 2) and len(data) > 1):
+        kwargs.pop('method')
+        jac_sparsity = kwargs.pop('jac_sparsity', None)
+        if jac_sparsity is None:
+            npoints = data.counts if ragged else data.shape[1]
+            jac_sparsity = jacobian_sparsity(parameters, layout, npoints)
+
+    if (jac_sparsity is None and kwargs.get('Dfun') is None and
+            kwargs.get('method', 'leastsq') == 'leastsq'):
+        stats.jacobians = JacobianCounter(
+            name for name, par in parameters.items()
+            if par.vary and not par.expr)
+
+    try:
+        if jac_sparsity is not None:
+            result = sparse_least_squares(parameters, args, jac_sparsity,
+                                          fcn=fcn, iter_cb=iter_cb, **kwargs)
+        else:
+            result = minimize(fcn, parameters, args=args, iter_cb=iter_cb,
+                              **kwargs)
+    except (FitAborted, KeyboardInterrupt):
+        if budget.best is None:  # nothing to give back
+            if checkpoint is True:
+                saved.remove()
+            raise
+        if budget.reason is None:
+            budget.reason = "being interrupted"
+        result = failed_result(parameters, "")
+        result.var_names = list(budget.best)
+        result.nvarys = len(budget.best)
+        result.nfev = budget.nfev
+
+    if budget.reason is not None:
+        keep_best(result, budget, fcn, args)
 
-    result = minimize(objective, parameters, args=(x, data, model),
-                      iter_cb=iter_cb, **kwargs)
+    if saved is not None:
+        result.checkpoint = saved.key
+        if budget.reason is not None:
+            saved.save()  # where to pick up from
+        else:
+            saved.remove()
+        result.nfev += saved.nfev_before
+
+    if linear:
+        # put the solved linear parameters back in the result.
+        coefs = solve_linear(layout.values(result.params), x, data, model,
+                             layout, linear)[0]
+        for k, arg in enumerate(linear):
+            for i, slot in enumerate(dict(layout.matrix)[arg].ravel()):
+                par = result.params[layout.names[slot]]
+                par.value = coefs[i, k]
+                par.vary = True
+        result.nvarys += coefs.size
+        set_statistics(result, result.residual)
+
+    stats.wall_seconds = time.perf_counter() - began
+    stats.njev = getattr(result, 'njev', None)
+    if stats.jacobians is not None:
+        stats.njev = stats.jacobians.njev
+        stats.jacobians = None
+    if memo is not None:
+        stats.memo_hits, stats.memo_misses = memo.hits, memo.misses
+    stats.parameter_seconds = time_parameter_handling(result.params,
+                                                      stats.ncalls)
+    result.stats = stats
+
+    if aliases:
+        expand_aliases(result, linked, aliases)
+        layout = ParameterLayout(result.params, len(data), layout.broadcast)
+
+    # keep the layout with the result so it can be reused for plotting.
+    result.layout = layout
+
+    # a stopped fit depends on when it was stopped, so don't keep it.
+    if cache and budget.reason is None:
+        fit_cache.store(key, result)
     return result, data, x, model
 
 
+def resume_fit(key=None, debug=False, **kwargs):
+    """Continue a fit that was run with checkpoint=True and didn't finish,
+    from its last checkpoint (see src.checkpoint). It starts from the best
+    parameters found so far, and a differential_evolution fit from its last
+    population. Its max_time and max_nfev count what was done before it was
+    interrupted.
+
+    Parameters
+    ----------
+        key: str, optional
+            The key of the checkpoint, or the start of it. Defaults to the
+            most recently written one.
+        debug: boolean
+            As for fit.
+        kwargs:
+            Options of the fit to change, e.g. max_time=None to let it run
+            until it converges.
+
+    Returns
+    -------
+        The same as fit. result.nfev counts the function evaluations from
+        before it was interrupted too.
+    """
+    saved = fit_checkpoint.load(key)
+    if saved is None:
+        raise ValueError("There is no checkpoint to resume{0}.".format(
+            "" if key is None else " starting with {0}".format(key)))
+
+    parameters = params.deep_copy(saved.parameters)
+    for name, value in saved.best.items():
+        if name in parameters and not parameters[name].expr:
+            parameters[name].value = value
+
+    options = dict(saved.options)
+    if options.get('max_nfev') is not None:
+        options['max_nfev'] = max(1, options['max_nfev'] - saved.nfev)
+    if options.get('max_time') is not None:
+        options['max_time'] = max(0.0, options['max_time'] - saved.seconds)
+    if saved.population is not None:
+        options['init'] = saved.population
+    options.update(kwargs)
+    return fit(saved.data, saved.x, saved.model, parameters, debug=debug,
+               checkpoint=saved, **options)
+
+
+class IncrementalFit(object):
+    """A fit of one buffer that is refit as points are appended to it, e.g.
+    while a stopped-flow trace is still being acquired.
+
+    The points are kept in arrays with room to spare, which double in size
+    when they fill up, so appending points never copies those already
+    there, and the parameter layout and model array of the fit are made
+    once. Each refit starts from the parameters of the one before and runs
+    at most max_nfev evaluations of the objective, so the estimates follow
+    the data as it arrives. A refit stopped there keeps the best parameters
+    it saw, like any fit stopped by its FitBudget. The first fit runs until
+    it converges.
+
+    Every refit is recorded in history, see series.
+    """
+
+    def __init__(self, model, parameters, max_nfev=None, capacity=1024,
+                 **kwargs):
+        """
+        Parameters
+        ----------
+            model: string OR function object
+                The model function that the data should be fit to.
+            parameters: lmfit.Parameters
+                Starting parameters of the first fit, for a single buffer.
+            max_nfev: int, optional
+                Most evaluations of the objective in each refit after the
+                first. Defaults to 10 per varying parameter.
+            capacity: int
+                How many points there is room for at first.
+            kwargs:
+                Passed on to lmfit.minimize, e.g. method.
+        """
+        if isinstance(model, str):
+            model = models.get_models(model)
+        self.model = model
+        self.parameters = params.deep_copy(parameters)
+        nvarys = sum(par.vary and not par.expr for par in
+                     self.parameters.values())
+        self.max_nfev = max_nfev or 10 * max(nvarys, 1)
+        self.kwargs = kwargs
+
+        self.layout = ParameterLayout(self.parameters, 1)
+        self.stats = FitStats()
+        self._x = np.empty(capacity)
+        self._y = np.empty((1, capacity))
+        self.work = WorkBuffers(self._y, model, self.stats)
+        self.npoints = 0
+
+        self.result = None
+        self.began = time.perf_counter()
+        # one dict per refit, see series.
+        self.history = []
+
+    @property
+    def x(self):
+        return self._x[:self.npoints]
+
+    @property
+    def data(self):
+        return self._y[:, :self.npoints]
+
+    def append(self, x, y):
+        """Append points to the buffer, without fitting it again."""
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if x.shape != y.shape:
+            raise ValueError("{0} x values but {1} y values".format(len(x),
+                                                                    len(y)))
+        n = self.npoints + len(x)
+        if n > len(self._x):
+            capacity = max(n, 2 * len(self._x))
+            self._x = np.concatenate([self.x, np.empty(capacity -
+                                                       self.npoints)])
+            self._y = np.concatenate([self.data, np.empty(
+                (1, capacity - self.npoints))], axis=1)
+            self.work.model = np.empty((1, capacity))
+        self._x[self.npoints:n] = x
+        self._y[0, self.npoints:n] = y
+        self.npoints = n
+
+    def refit(self):
+        """Fit the points appended so far, starting from the last result.
+        Returns the result, which is also kept as self.result."""
+        began = time.perf_counter()
+        kwargs = dict(self.kwargs)
+        budget = None
+        if self.result is not None:
+            budget = FitBudget(max_nfev=self.max_nfev,
+                               iter_cb=kwargs.pop('iter_cb', None))
+            kwargs['iter_cb'] = budget
+
+        # the model array of the fit is the start of the one with capacity.
+        capacity = self.work.model
+        self.work.model = capacity[:, :self.npoints]
+        args = (self.x, self.data, self.model, self.layout, self.work)
+        try:
+            result = minimize(objective, self.parameters, args=args, **kwargs)
+            if budget is not None and budget.reason is not None:
+                keep_best(result, budget, objective, args)
+        finally:
+            self.work.model = capacity
+        result.layout = self.layout
+
+        self.result = result
+        self.parameters = result.params
+        self.stats.wall_seconds += time.perf_counter() - began
+        self.history.append({
+            'npoints': self.npoints,
+            'x': self.x[-1],
+            'seconds': time.perf_counter() - self.began,
+            'nfev': result.nfev,
+            'chisqr': result.chisqr,
+            'values': {name: par.value for name, par in
+                       result.params.items()},
+            'stderrs': {name: par.stderr for name, par in
+                        result.params.items()},
+        })
+        return result
+
+    def series(self, name):
+        """Return the estimates of the parameter called name over the
+        refits, as a dict of arrays: 'npoints' (how many points had been
+        appended), 'x' (the last x value then), 'seconds' (since the fit
+        was made), 'value' and 'stderr' (nan where it wasn't estimated)."""
+        def column(key):
+            return np.asarray([step[key] for step in self.history])
+
+        stderrs = [step['stderrs'][name] for step in self.history]
+        return {'npoints': column('npoints'),
+                'x': column('x'),
+                'seconds': column('seconds'),
+                'value': np.asarray([step['values'][name]
+                                     for step in self.history]),
+                'stderr': np.asarray([np.nan if s is None else s
+                                      for s in stderrs])}
+
+
+def failed_result(parameters, message):
+    """Return a MinimizerResult standing in for a fit that could not be run,
+    holding the starting parameters and the reason it failed."""
+    result = MinimizerResult()
+    result.params = params.deep_copy(parameters)
+    result.success = False
+    result.aborted = True
+    result.errorbars = False
+    result.nfev = 0
+    result.message = message
+    return result
+
+
+def fit_worker(data, x, model, parameters, kwargs):
+    """Run fit in a worker process. Any error is caught and returned as a
+    failed result, so that one bad buffer can't stop a batch of fits."""
+    try:
+        return fit(data, x, model, parameters, **kwargs)
+    except Exception:
+        return failed_result(parameters, traceback.format_exc()), data, x, model
+
+
+def fit_pool(jobs, workers=None, **kwargs):
+    """Run many fits in a pool of worker processes.
+
+    Parameters
+    ----------
+        jobs: list
+            A list of (data, x, model, parameters) tuples, each the
+            arguments of one call to fit.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs.
+        kwargs:
+            Passed on to every fit.
+
+    Returns
+    -------
+        A list of (result, data, x, model) tuples, in the same order as
+        jobs. Fits that raised an error have a failed result (see
+        failed_result) whose message is the traceback.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fit_worker, data, x, model, parameters, kwargs)
+                   for data, x, model, parameters in jobs]
+
+        fits = []
+        for future, (data, x, model, parameters) in zip(futures, jobs):
+            try:
+                fits.append(future.result())
+            except Exception:  # the worker process itself died
+                fits.append((failed_result(parameters,
+                                           traceback.format_exc()),
+                             data, x, model))
+    return fits
+
+
+def fit_many(problems, model, parameters, workers=None, **kwargs):
+    """Fit many independent datasets to the same model with the same starting
+    parameters, in a pool of worker processes.
+
+    Parameters
+    ----------
+        problems: list
+            A list of (data, x) pairs, each fit on its own. data and x are
+            as passed to fit.
+        model: string OR function object
+            The model function that data should be fit to.
+        parameters: lmfit.Parameters
+            Starting parameters for every fit.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs.
+        kwargs:
+            Passed on to fit.
+
+    Returns
+    -------
+        A list of (result, data, x, model) tuples, in the same order as
+        problems. See fit_pool.
+    """
+    if isinstance(model, str):
+        model = models.get_models(model)
+
+    return fit_pool([(data, x, model, parameters) for data, x in problems],
+                    workers=workers, **kwargs)
+
+
+def compare_models(data, x, candidates, parameters=None, workers=None,
+                   criterion='aic', on_result=None, **kwargs):
+    """Fit the same data to each of several models, in a pool of worker
+    processes, and rank the fits by an information criterion.
+
+    Parameters
+    ----------
+        data: np.ndarray (multi-dimensional) or RaggedData
+            As passed to fit.
+        x: np.ndarray (1D)
+            As passed to fit.
+        candidates: list
+            The models to compare, names or function objects.
+        parameters: dict, optional
+            Starting parameters of some of the models, by the name of the
+            model function. The others start from their defaults, see
+            params.default_parameters.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs.
+        criterion: str
+            'aic', 'bic' or 'redchi', the lower the better. See rank_fits.
+        on_result: function, optional
+            Called with the ranking so far every time a fit finishes, e.g.
+            to show it while a long run goes on.
+        kwargs:
+            Passed on to every fit.
+
+    Returns
+    -------
+        A list of (result, data, x, model) tuples, best first. Fits that
+        failed are last, see fit_pool.
+    """
+    parameters = parameters or {}
+    jobs = []
+    for model in candidates:
+        if isinstance(model, str):
+            model = models.get_models(model)
+        pars = parameters.get(model.__name__)
+        if pars is None:
+            pars = params.default_parameters(len(data), model)
+        jobs.append((data, x, model, pars))
+
+    fits = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fit_worker, data, x, model, pars, kwargs):
+                   (data, x, model, pars)
+                   for data, x, model, pars in jobs}
+        for future in as_completed(futures):
+            data, x, model, pars = futures[future]
+            try:
+                fits.append(future.result())
+            except Exception:  # the worker process itself died
+                fits.append((failed_result(pars, traceback.format_exc()),
+                             data, x, model))
+            if on_result is not None:
+                on_result(rank_fits(fits, criterion))
+    return rank_fits(fits, criterion)
+
+
+def rank_fits(fits, criterion='aic'):
+    """Sort (result, data, x, model) tuples of fits of the same data by
+    criterion, an attribute of their results: 'aic' or 'bic' (which weigh
+    the goodness of fit against the number of parameters) or 'redchi'.
+    Lowest, i.e. best, first. Failed fits go last."""
+    if criterion not in ('aic', 'bic', 'redchi'):
+        raise ValueError("Can't rank fits by {0}. Use aic, bic or redchi."
+                         "".format(criterion))
+
+    def key(fit):
+        value = getattr(fit[0], criterion, None)
+        if getattr(fit[0], 'aborted', False) or value is None:
+            return (1, 0.0)
+        return (0, value)
+    return sorted(fits, key=key)
+
+
+def ranking_table(fits, criterion='aic'):
+    """Return the ranking of fits (as returned by rank_fits) as lines of
+    text: for each model its number of varying parameters, reduced
+    chi-square, AIC, BIC, how far its criterion is from the best, and, for
+    AIC and BIC, its weight, the relative likelihood that it is the best of
+    the models compared."""
+    ok = [f for f in fits if not getattr(f[0], 'aborted', False)]
+    best = getattr(ok[0][0], criterion) if ok else 0.0
+    weights = {}
+    if ok and criterion in ('aic', 'bic'):
+        likelihood = [np.exp(-(getattr(f[0], criterion) - best) / 2)
+                      for f in ok]
+        weights = {id(f[0]): w / sum(likelihood)
+                   for f, w in zip(ok, likelihood)}
+
+    width = max([len(f[3].__name__) for f in fits] + [5]) + 2
+    lines = ["{0:>4}  {1:<{w}}{2:>6}{3:>14}{4:>14}{5:>14}{6:>12}{7:>9}".format(
+        "rank", "model", "nvarys", "redchi", "aic", "bic",
+        "delta " + criterion, "weight", w=width)]
+    for rank, (result, data, x, model) in enumerate(fits, 1):
+        if getattr(result, 'aborted', False):
+            lines.append("{0:>4}  {1:<{w}}failed".format(
+                rank, model.__name__, w=width))
+            continue
+        weight = weights.get(id(result))
+        lines.append(
+            "{0:>4}  {1:<{w}}{2:>6}{3:>14.6g}{4:>14.6g}{5:>14.6g}{6:>12.4g}"
+            "{7:>9}".format(rank, model.__name__, result.nvarys,
+                            result.redchi, result.aic, result.bic,
+                            getattr(result, criterion) - best,
+                            "" if weight is None else
+                            "{0:.3f}".format(weight), w=width))
+    return lines
+
+
+def starting_points(parameters, nstarts, sampler='sobol', seed=0):
+    """Spread nstarts sets of starting values for the free parameters over
+    their bounds. A parameter with no bound on a side is spread up to the
+    size of its value (or 1, if it is 0) away from its value on that side.
+    The first set is always the given parameters themselves.
+
+    Parameters
+    ----------
+        parameters: lmfit.Parameters
+            Starting parameters given by the user.
+        nstarts: int
+            How many sets of starting parameters to return.
+        sampler: string
+            'sobol' for a scrambled Sobol sequence, or 'lhs' for a Latin
+            hypercube.
+        seed: int
+            Seed of the sampler. The same seed gives the same points.
+
+    Returns
+    -------
+        A list of nstarts lmfit.Parameters.
+    """
+    var_names = [name for name, par in parameters.items()
+                 if par.vary and not par.expr]
+
+    lows, highs = [], []
+    for name in var_names:
+        par = parameters[name]
+        spread = abs(par.value) or 1.0
+        lows.append(par.min if np.isfinite(par.min) else par.value - spread)
+        highs.append(par.max if np.isfinite(par.max) else par.value + spread)
+
+    if sampler == 'sobol':
+        engine = qmc.Sobol(len(var_names), scramble=True, seed=seed)
+    elif sampler == 'lhs':
+        engine = qmc.LatinHypercube(len(var_names), seed=seed)
+    else:
+        raise ValueError("Unknown sampler [{0}]. Use 'sobol' or 'lhs'."
+                         "".format(sampler))
+
+    with warnings.catch_warnings():
+        # Sobol prefers powers of 2, but any number of points is fine here.
+        warnings.simplefilter('ignore')
+        points = qmc.scale(engine.random(max(nstarts - 1, 1)), lows, highs)
+
+    starts = [params.deep_copy(parameters)]
+    for point in points[:nstarts - 1]:
+        start = params.deep_copy(parameters)
+        for name, value in zip(var_names, point):
+            start[name].value = value
+        starts.append(start)
+    return starts
+
+
+def distinct_results(results, rtol=1e-3):
+    """Return the results sorted by X^2, without any result whose free
+    parameters all lie within rtol (relative) of a better result's, i.e.
+    fits that converged to the same minimum."""
+    kept = []
+    for result in sorted(results, key=lambda r: r.chisqr):
+        values = np.asarray([result.params[name].value
+                             for name in result.var_names])
+        duplicate = any(
+            np.all(np.abs(values - other) <=
+                   rtol * np.maximum(np.abs(values), np.abs(other)) + 1e-12)
+            for other, _ in kept)
+        if not duplicate:
+            kept.append((values, result))
+    return [result for _, result in kept]
+
+
+def multistart(data, x, model, parameters, nstarts=16, sampler='sobol',
+               seed=0, keep=5, workers=None, **kwargs):
+    """Fit the data from many starting points spread over the bounds of the
+    parameters (see starting_points), in parallel worker processes, to
+    find the global minimum rather than the one nearest the starting guess.
+
+    Parameters
+    ----------
+        data, x, model, parameters:
+            As passed to fit.
+        nstarts: int
+            How many fits to run.
+        sampler: string
+            'sobol' or 'lhs'. How the starting points are spread.
+        seed: int
+            Seed of the sampler, so runs can be reproduced.
+        keep: int
+            How many of the best distinct minima to return.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs.
+        kwargs:
+            Passed on to fit.
+
+    Returns
+    -------
+        A list of up to keep (result, data, x, model) tuples, best (lowest
+        X^2) first. Fits that failed, and fits that converged to the same
+        minimum as a better one, are dropped.
+    """
+    if isinstance(model, str):
+        model = models.get_models(model)
+
+    starts = starting_points(parameters, nstarts, sampler, seed)
+    fits = fit_pool([(data, x, model, start) for start in starts],
+                    workers=workers, **kwargs)
+
+    results = [result for result, _, _, _ in fits
+               if not getattr(result, 'aborted', False)]
+    return [(result, data, x, model)
+            for result in distinct_results(results)[:keep]]
+
+
 def debug_fitting(params, nfev, out, *args, **kwargs):
     """Function to be called after each iteration of the minimization method
     used by lmfit. Should reveal information about how parameter values are
@@ -168,13 +1806,86 @@ def debug_fitting(params, nfev, out, *args, **kwargs):
         print("{0}\t{1}".format(name, param.value))
 
 
+def fix_parameter(parameters, param_name, values):
+    """Set the parameter param_name of each dataset i to values[i], and stop
+    it from varying. Parameters linked to another dataset's parameter follow
+    that parameter instead."""
+    for i, value in enumerate(values):
+        param_i = parameters["{0}_{1}".format(param_name, i)]
+        # X^2 analysis doesn't make sense if parameter can vary from what we set it.
+        param_i.vary = False
+        param_i.value = value
+
+
+def error_landscape_chain(data, x, model, parameters, param_name, samples,
+                          debug=False, kwargs=None):
+    """Run the fits for a run of neighbouring samples of an error landscape,
+    one after another. Each fit starts from the converged parameters of the
+    fit before it, which is much closer to its own minimum than the
+    original best fit is.
+
+    Parameters
+    ----------
+        data, x, model:
+            As passed to fit.
+        parameters: lmfit.Parameters
+            Starting parameters for the first fit in the chain.
+        param_name: string
+            Name of the parameter (w/o underscore and int) being fixed.
+        samples: list
+            (index, values) pairs, in the order they should be fit. values
+            holds the value of the parameter for each dataset.
+        debug: bool
+            Whether each fit should print its results.
+        kwargs: dict, optional
+            Passed on to fit.
+
+    Returns
+    -------
+        A list of (index, reduced X^2, nfev, seconds taken) for each sample.
+    """
+    out = []
+    start = params.deep_copy(parameters)
+    for index, values in samples:
+        fix_parameter(start, param_name, values)
+
+        began = time.perf_counter()
+        new_result = fit(data, x, model, start, **(kwargs or {}))[0]
+        seconds = time.perf_counter() - began
+
+        out.append((index, new_result.redchi, new_result.nfev, seconds))
+        if debug:  # print out each fit result
+            report_result(new_result)
+
+        # warm start the next fit from this one.
+        start = params.deep_copy(new_result.params)
+    return out
+
+
+def run_chains(chain_function, chains, workers):
+    """Call chain_function(*arguments) for the arguments of each chain, in a pool of worker
+    processes, or in this process if workers is 1. Returns their results in
+    the order of chains."""
+    if workers == 1:
+        return [chain_function(*chain) for chain in chains]
+    with ProcessPoolExecutor(max_workers=min(workers, len(chains))) as pool:
+        futures = [pool.submit(chain_function, *chain) for chain in chains]
+        return [future.result() for future in futures]
+
+
 def generate_error_landscape(result, data, x, model, param_name, nsamples=15,
-                             plus_minus=0.2, debug=False, **kwargs):
+                             plus_minus=0.2, debug=False, workers=None,
+                             **kwargs):
     """Create a chi sq landscape of the result fit. Set the parameter for each
     dataset to a values between the true value plus or minus plus_minus, and
     redo the fit with the new fixed parameters. Should work for both
     linked(global) and unlinked parameters.
 
+    Samples are fit outwards from the best fit in each direction, each fit
+    starting from its neighbour's converged parameters. Each direction is
+    cut into runs of neighbouring samples (see error_landscape_chain),
+    which are fit in parallel worker processes.
+
     Parameters
     ----------
         result: lmfit.MinimizerResult
@@ -196,6 +1907,11 @@ def generate_error_landscape(result, data, x, model, param_name, nsamples=15,
             you should vary in the X^2 analysis.
         debug: bool
             Whether each fit should print its results. Default False.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs. With
+            1, the fits are run in this process.
+        kwargs:
+            Passed on to fit.
 
     Returns
     -------
@@ -204,13 +1920,16 @@ def generate_error_landscape(result, data, x, model, param_name, nsamples=15,
         all_chis: np.ndarray (1D)
             Array of X^2 values for the fits with parameter values sampled
             at those specified in param_axis.
+        nfevs: np.ndarray (1D)
+            Number of function evaluations taken by each fit.
+        seconds: np.ndarray (1D)
+            Time taken by each fit.
         """
 
     # perturb fitted values to not create false minima.
     # default_params = params.create_params_without_window(len(data), model)
     default_params = params.deep_copy(result.params)
 
-
     sample_spaces = []
     # loop through all the fitted data and generate parameter values to
     # sample X^2 at
@@ -225,30 +1944,614 @@ def generate_error_landscape(result, data, x, model, param_name, nsamples=15,
                                    num=nsamples)
         sample_spaces.append(sample_space)
 
-    all_chis = []
-    # create fits for each parameter value
-    for a in range(nsamples):
-        # change all the values of the parameters
-        for i, sample_space in enumerate(sample_spaces):
-            param_i = default_params["{0}_{1}".format(param_name, i)]
-            # X^2 analysis doesn't make sense if parameter can vary from what we set it.
-            param_i.vary = False
-            param_i.value = sample_space[a]
+    # relative distance away from true fit X^2
+    param_axis = np.linspace(-plus_minus, plus_minus, nsamples)
 
-        # fit the data
-        new_result, new_data, new_x, new_model = fit(data, x, model,
-                                                     default_params)
+    # walk away from the sample closest to the best fit in both directions
+    center = int(np.argmin(np.abs(param_axis)))
+    directions = [range(center, nsamples), range(center - 1, -1, -1)]
 
-        all_chis.append(new_result.redchi)
+    # cut each direction into runs of neighbours, enough to keep the pool
+    # busy, but each at least MIN_CHAIN long, so most fits start warm
+    # however many workers there are.
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chains = []
+    for direction in directions:
+        nchains = min(-(-workers // 2), max(1, len(direction) // MIN_CHAIN))
+        for run in np.array_split(list(direction), nchains):
+            if len(run):
+                chain = [(a, [space[a] for space in sample_spaces])
+                         for a in run]
+                chains.append((data, x, model, default_params, param_name,
+                               chain, debug, kwargs))
+    outs = run_chains(error_landscape_chain, chains, workers)
 
-        if debug:  # print out each fit result
-            report_result(new_result)
-
-    # relative distance away from true fit X^2
-    param_axis = np.linspace(-plus_minus, plus_minus, nsamples)
+    all_chis = np.empty(nsamples)
+    nfevs = np.empty(nsamples, dtype=int)
+    seconds = np.empty(nsamples)
+    for out in outs:
+        for a, chi, nfev, taken in out:
+            all_chis[a] = chi
+            nfevs[a] = nfev
+            seconds[a] = taken
 
     # x and y values to plot
-    return param_axis, all_chis
+    return param_axis, all_chis, nfevs, seconds
+
+
+def surface_cell_path(directory, index):
+    return os.path.join(directory, "cell_{0}_{1}.json".format(*index))
+
+
+def load_surface_cell(directory, index):
+    """Return the record of a finished cell of a chi-square surface, or None
+    if it hasn't been fit yet."""
+    try:
+        with open(surface_cell_path(directory, index)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_surface_cell(directory, index, record):
+    """Write the record of a finished cell, through a temporary file so an
+    interrupted run never leaves half a record."""
+    path = surface_cell_path(directory, index)
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temp, 'w') as f:
+        json.dump(record, f)
+    os.replace(temp, path)
+
+
+def seeded_parameters(parameters, record):
+    """Return a copy of parameters starting from the values found for a
+    cell of a chi-square surface."""
+    start = params.deep_copy(parameters)
+    for name, value in record['values'].items():
+        if name in start and not start[name].expr:
+            start[name].value = value
+    return start
+
+
+def chi_surface_chain(data, x, model, parameters, names, samples, directory,
+                      debug=False, kwargs=None):
+    """Run the fits for a run of neighbouring cells of a chi-square surface,
+    one after another, each starting from the parameters of the one before.
+    Like error_landscape_chain, but with two parameters fixed. Each cell is
+    saved in directory as soon as it is fit, and cells found there already
+    are not fit again.
+
+    Parameters
+    ----------
+        data, x, model:
+            As passed to fit.
+        parameters: lmfit.Parameters
+            Starting parameters for the first fit in the chain.
+        names: tuple
+            The two parameter names (w/o underscore and int) being fixed.
+        samples: list
+            (index, values) pairs, in the order they should be fit. index
+            is the (i, j) of the cell, and values holds, for each name, the
+            value of the parameter for each dataset.
+        directory: str
+            Where the cells of the surface are saved.
+        debug: bool
+            Whether each fit should print its results.
+        kwargs: dict, optional
+            Passed on to fit.
+
+    Returns
+    -------
+        A list of the records of the cells, dicts of 'index', 'redchi',
+        'nfev', 'seconds' and the 'values' of every parameter.
+    """
+    out = []
+    start = params.deep_copy(parameters)
+    for index, values in samples:
+        record = load_surface_cell(directory, index)
+        if record is None:
+            for name, vals in zip(names, values):
+                fix_parameter(start, name, vals)
+
+            began = time.perf_counter()
+            new_result = fit(data, x, model, start, **(kwargs or {}))[0]
+            record = {'index': list(index),
+                      'redchi': new_result.redchi,
+                      'nfev': new_result.nfev,
+                      'seconds': time.perf_counter() - began,
+                      'values': {name: par.value for name, par
+                                 in new_result.params.items()}}
+            save_surface_cell(directory, index, record)
+            if debug:  # print out each fit result
+                report_result(new_result)
+        out.append(record)
+
+        # warm start the next fit from this one.
+        start = seeded_parameters(parameters, record)
+    return out
+
+
+def generate_chi_surface(result, data, x, model, param1, param2, nsamples=11,
+                         plus_minus=0.2, debug=False, workers=None,
+                         directory=None, keep=False, **kwargs):
+    """Create a two-parameter chi-square surface of the result fit, for
+    parameters that are correlated, where the profile of each one alone
+    hides the shape of the minimum. Both parameters of every dataset are
+    fixed at values on a nsamples by nsamples grid around their best fit
+    values, and the rest are refit for each cell of the grid.
+
+    Every cell starts from the parameters of a neighbour that has already
+    been fit. First the row of cells through the best fit is fit outwards
+    in both directions, then each column outwards from that row. The
+    columns are fit in parallel worker processes.
+
+    Each cell is saved as soon as it is fit, under a directory named after
+    the fit and the grid, so a run that is interrupted picks up where it
+    left off when it is run again. Once every cell is fit the directory is
+    deleted, unless keep is true. Those of interrupted runs that are never
+    run again are deleted by clear_chi_surfaces.
+
+    Parameters
+    ----------
+        result: lmfit.MinimizerResult
+            result of the fit
+        data, x, model:
+            As passed to fit.
+        param1, param2: string
+            names of the parameters (w/o underscore and int) for the x and
+            y axes of the surface.
+        nsamples: int
+            how many values of each parameter to take X^2 at. Odd number
+            will include the best fit values.
+        plus_minus: float
+            fraction of their best fit values that the parameters are
+            moved away from them, at most.
+        debug: bool
+            Whether each fit should print its results. Default False.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs. With
+            1, the fits are run in this process.
+        directory: str, optional
+            Where to keep the cells of surfaces. SURFACE_DIR by default.
+        keep: bool
+            Whether to keep the cells once every one is fit. Default False.
+        kwargs:
+            Passed on to fit.
+
+    Returns
+    -------
+        axis: np.ndarray (1D)
+            Relative distance from the best fit values of the samples of
+            both parameters.
+        chis: np.ndarray (2D)
+            Reduced X^2 of each cell, chis[i, j] with param1 at axis[i] and
+            param2 at axis[j].
+        nfevs: np.ndarray (2D)
+            Number of function evaluations taken by the fit of each cell.
+        seconds: np.ndarray (2D)
+            Time taken by each fit, 0 for cells loaded from disk.
+        directory: str or None
+            Where the cells were saved, if they were kept.
+    """
+    start = params.deep_copy(result.params)
+    names = (param1, param2)
+    axis = np.linspace(-plus_minus, plus_minus, nsamples)
+    best = [[result.params["{0}_{1}".format(name, i)].value
+             for i in range(len(data))] for name in names]
+
+    def cell(i, j):
+        return ((i, j), [[v * (1 + axis[i]) for v in best[0]],
+                         [v * (1 + axis[j]) for v in best[1]]])
+
+    # everything that decides the values of the cells names the directory.
+    key = fit_cache.fit_key(data, x, model, result.params,
+                            dict(kwargs, surface=names, nsamples=nsamples,
+                                 plus_minus=plus_minus))
+    directory = os.path.join(directory or SURFACE_DIR, key)
+    os.makedirs(directory, exist_ok=True)
+    found = {tuple(r['index']) for r in
+             (load_surface_cell(directory, (i, j)) for i in range(nsamples)
+              for j in range(nsamples)) if r is not None}
+    if found:
+        print("Resuming: {0} of {1} cells were already fit.".format(
+            len(found), nsamples ** 2))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    center = int(np.argmin(np.abs(axis)))
+
+    # the row through the best fit, outwards both ways from it
+    rows = [range(center, nsamples), range(center - 1, -1, -1)]
+    chains = [(data, x, model, start, names, [cell(i, center) for i in run],
+               directory, debug, kwargs) for run in rows if len(run)]
+    records = [r for out in run_chains(chi_surface_chain, chains, workers)
+               for r in out]
+
+    # then each column, outwards from its cell in that row
+    seeds = {r['index'][0]: r for r in records}
+    chains = []
+    for i in range(nsamples):
+        seed = seeded_parameters(start, seeds[i])
+        for run in (range(center + 1, nsamples), range(center - 1, -1, -1)):
+            if len(run):
+                chains.append((data, x, model, seed, names,
+                               [cell(i, j) for j in run], directory, debug,
+                               kwargs))
+    records += [r for out in run_chains(chi_surface_chain, chains, workers)
+                for r in out]
+
+    chis = np.empty((nsamples, nsamples))
+    nfevs = np.zeros((nsamples, nsamples), dtype=int)
+    seconds = np.zeros((nsamples, nsamples))
+    for r in records:
+        i, j = r['index']
+        chis[i, j] = r['redchi']
+        if (i, j) not in found:
+            nfevs[i, j] = r['nfev']
+            seconds[i, j] = r['seconds']
+
+    # every cell is fit, so there's nothing to resume.
+    if not keep:
+        shutil.rmtree(directory, ignore_errors=True)
+        directory = None
+    return axis, chis, nfevs, seconds, directory
+
+
+def clear_chi_surfaces(directory=None):
+    """Delete the cells of every chi-square surface kept, e.g. those of
+    runs that were interrupted and never finished. Returns how many
+    surfaces were deleted."""
+    directory = directory or SURFACE_DIR
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return len(names)
+
+
+def profile_side(data, x, model, parameters, param_name, origin, scales,
+                 chi_best, chi_target, step, known=(), xtol=1e-3,
+                 max_expand=10, max_iter=30, kwargs=None):
+    """Find where the profile of X^2 crosses chi_target on one side of the
+    best fit. Samples are relative offsets delta from the best fit, i.e.
+    param_name of dataset i is fixed at origin[i] + delta * scales[i].
+
+    The crossing is first bracketed by doubling the step until X^2 reaches
+    chi_target, then narrowed down by false position on
+    sqrt(X^2 - X^2 best), which is close to linear in delta, falling back
+    to bisection (Illinois method). Every fit starts from the converged
+    parameters of the closest fit inside the interval.
+
+    Parameters
+    ----------
+        data, x, model:
+            As passed to fit.
+        parameters: lmfit.Parameters
+            Parameters of the best fit.
+        param_name: string
+            Name of the parameter (w/o underscore and int) being profiled.
+        origin, scales: np.ndarray (1D)
+            Best fit value of the parameter for each dataset, and the size
+            of a unit of delta for each dataset.
+        chi_best, chi_target: float
+            X^2 of the best fit, and the X^2 at the edge of the interval.
+        step: float
+            First delta to try. Its sign gives the side.
+        known: list, optional
+            (delta, X^2) pairs already sampled, used to start the bracket.
+        xtol: float
+            How precisely to find delta.
+        max_expand, max_iter: int
+            Limits on the number of bracketing and narrowing fits.
+        kwargs: dict, optional
+            Passed on to fit.
+
+    Returns
+    -------
+        delta: float or None
+            Where X^2 crosses chi_target, or None if it never did.
+        profile: list
+            (delta, X^2) pairs of the new fits.
+    """
+    profile = []
+
+    def sample(delta, start):
+        p = params.deep_copy(start)
+        fix_parameter(p, param_name, origin + delta * scales)
+        new_result = fit(data, x, model, p, **(kwargs or {}))[0]
+        profile.append((delta, new_result.chisqr))
+        return new_result.chisqr, new_result.params
+
+    def g(chi):
+        return np.sqrt(max(chi - chi_best, 0.0)) - np.sqrt(chi_target - chi_best)
+
+    # start from what is already known on this side, if anything.
+    side = np.sign(step)
+    lo, chi_lo, start = 0.0, chi_best, parameters
+    hi = chi_hi = None
+    for delta, chi in sorted(known, key=lambda k: abs(k[0])):
+        if np.sign(delta) != side:
+            continue
+        if chi >= chi_target:
+            hi, chi_hi = delta, chi
+            break
+        lo, chi_lo = delta, chi
+
+    # bracket the crossing
+    delta = lo + step
+    for _ in range(max_expand):
+        if hi is not None:
+            break
+        chi, pars = sample(delta, start)
+        if chi >= chi_target:
+            hi, chi_hi = delta, chi
+        else:
+            lo, chi_lo, start = delta, chi, pars
+            delta = 2 * delta
+    if hi is None:
+        return None, profile
+
+    # narrow it down
+    g_lo, g_hi = g(chi_lo), g(chi_hi)
+    kept = 0  # which end was kept last time, for the Illinois method
+    for _ in range(max_iter):
+        if abs(hi - lo) <= xtol:
+            break
+        mid = hi - g_hi * (hi - lo) / (g_hi - g_lo)
+        if not min(lo, hi) < mid < max(lo, hi):
+            mid = (lo + hi) / 2
+        chi, pars = sample(mid, start)
+        g_mid = g(chi)
+        if abs(g_mid) <= 1e-8 * abs(g_hi - g_lo):
+            return mid, profile
+        if g_mid < 0:
+            lo, g_lo, start = mid, g_mid, pars
+            if kept == 1:
+                g_hi /= 2
+            kept = 1
+        else:
+            hi, g_hi = mid, g_mid
+            if kept == -1:
+                g_lo /= 2
+            kept = -1
+
+    return hi - g_hi * (hi - lo) / (g_hi - g_lo), profile
+
+
+def confidence_interval(result, data, x, model, param_name, prob=0.6827,
+                        xtol=1e-3, known=None, workers=None, **kwargs):
+    """Find the confidence interval of a parameter from its X^2 profile:
+    the parameter is fixed at values away from the best fit, the rest of
+    the parameters are refit, and the interval ends where X^2 has risen
+    enough that an F-test rejects the fit with probability prob. As in
+    generate_error_landscape, the parameter of every dataset is moved by
+    the same relative amount, so it works for both linked (global) and
+    unlinked parameters. See profile_side for how each end is found.
+
+    Parameters
+    ----------
+        result: lmfit.MinimizerResult
+            result of the fit
+        data: np.ndarray (multi-dimensional)
+            actual data values used to calc residuals in fit
+        x: np.ndarray (1D)
+            the x values that data was collected at
+        model: funtion object
+            the model used to calculate the fit
+        param_name: string
+            name of the parameter (w/o underscore and int)
+        prob: float
+            Confidence level. 0.6827 (one sigma) by default.
+        xtol: float
+            How precisely to find each end, relative to the best fit value.
+        known: list, optional
+            (relative offset, X^2) pairs from an earlier profile of the same
+            result and parameter, which will not be fit again.
+        workers: int, optional
+            Processes to use. The two ends are found in parallel unless
+            workers is 1.
+        kwargs:
+            Passed on to fit.
+
+    Returns
+    -------
+        interval: tuple
+            (lower, upper) relative offsets from the best fit, i.e. the
+            parameter of dataset i ranges from value_i * (1 + lower) to
+            value_i * (1 + upper). An end is None if X^2 never got high
+            enough.
+        profile: tuple
+            (offsets, X^2) arrays of every point sampled, in order,
+            including the best fit and the known points.
+        nfits: int
+            How many new fits were run.
+    """
+    names = ["{0}_{1}".format(param_name, i) for i in range(len(data))]
+    origin = np.asarray([result.params[name].value for name in names])
+    scales = np.where(origin != 0, origin, 1.0)
+
+    # how many free parameters are removed from the fit by fixing it
+    found = {}
+    nfix = len(set().union(*(free_parameters(result.params, name, found)
+                             for name in names)))
+    if nfix == 0:
+        raise ValueError("{0} does not vary in the fit".format(param_name))
+
+    chi_best = result.chisqr
+    nfree = result.nfree
+    chi_target = chi_best * (1 + nfix / nfree *
+                             f_distribution.ppf(prob, nfix, nfree))
+
+    # first step: one standard error if lmfit could estimate it
+    stderr = result.params[names[0]].stderr
+    step = abs(stderr / scales[0]) if stderr else 0.1
+
+    known = list(known or [])
+    jobs = [(data, x, model, result.params, param_name, origin, scales,
+             chi_best, chi_target, side * step, known, xtol)
+            for side in (-1, 1)]
+    if workers == 1:
+        sides = [profile_side(*job, kwargs=kwargs) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers or 2, 2)) as pool:
+            futures = [pool.submit(profile_side, *job, kwargs=kwargs)
+                       for job in jobs]
+            sides = [future.result() for future in futures]
+
+    (lower, lower_profile), (upper, upper_profile) = sides
+    sampled = sorted(set([(0.0, chi_best)] + known + lower_profile +
+                         upper_profile))
+    offsets, chis = (np.asarray(a) for a in zip(*sampled))
+
+    return (lower, upper), (offsets, chis), len(lower_profile) + len(upper_profile)
+
+
+def bootstrap_replicates(result, data, nreplicates, resample='residuals',
+                         seed=0):
+    """Make nreplicates synthetic copies of data from the best fit, as one
+    stacked array.
+
+    Parameters
+    ----------
+        result: lmfit.MinimizerResult
+            The best fit of data.
+        data: np.ndarray (2D) or RaggedData
+            The data that was fit.
+        nreplicates: int
+            How many copies to make.
+        resample: string
+            'residuals' to add residuals of the best fit drawn at random
+            (with replacement) from the same dataset, or 'noise' to add
+            gaussian noise with the size of the residuals.
+        seed: int
+            Seed for the random numbers, so runs can be reproduced.
+
+    Returns
+    -------
+        np.ndarray of shape (nreplicates,) + data.shape. For RaggedData,
+        of shape (nreplicates, len(data.y)): each row is a copy of data.y.
+    """
+    rng = np.random.RandomState(seed)
+    if isinstance(data, RaggedData):
+        residual = np.asarray(result.residual)
+        best = data.y - residual
+        shape = (nreplicates, len(best))
+    else:
+        residual = np.reshape(result.residual, data.shape)
+        # the objective is data - model
+        best = data - residual
+        shape = (nreplicates,) + data.shape
+
+    if resample == 'residuals':
+        if isinstance(data, RaggedData):
+            # draw within the segment of the point's own dataset
+            picks = (data.offsets[data.index] +
+                     rng.randint(0, data.counts[data.index], shape))
+            return best + residual[picks]
+        picks = rng.randint(0, data.shape[1], shape)
+        rows = np.arange(data.shape[0])[:, np.newaxis]
+        return best + residual[rows, picks]
+    elif resample == 'noise':
+        return best + rng.normal(0.0, np.sqrt(result.redchi), shape)
+    raise ValueError("Unknown resample [{0}]. Use 'residuals' or 'noise'."
+                     "".format(resample))
+
+
+def bootstrap_chunk(replicates, x, model, parameters, names, kwargs=None,
+                    ragged=None):
+    """Fit each replicate dataset, starting from parameters, and return the
+    values of the parameters in names for each fit as a 2D array with one
+    row per replicate. The row of a fit that fails is nan. If the data is
+    RaggedData, it is passed as ragged, and each replicate is a copy of its
+    y values."""
+    values = np.full((len(replicates), len(names)), np.nan)
+    for n, replicate in enumerate(replicates):
+        if ragged is not None:
+            replicate = ragged.replace(replicate)
+        try:
+            new_result = fit(replicate, x, model, parameters,
+                             **(kwargs or {}))[0]
+        except Exception:
+            continue
+        if new_result.success:
+            values[n] = [new_result.params[name].value for name in names]
+    return values
+
+
+def bootstrap(result, data, x, model, nreplicates=1000, resample='residuals',
+              seed=0, workers=None, **kwargs):
+    """Estimate the distribution of the free parameters of a fit by refitting
+    many synthetic datasets made from the best fit (see
+    bootstrap_replicates). Unlike the covariance estimate of the fit, this
+    holds up for strongly correlated parameters. Every refit starts from
+    the best fit.
+
+    Parameters
+    ----------
+        result: lmfit.MinimizerResult
+            The best fit.
+        data, x, model:
+            As passed to fit.
+        nreplicates: int
+            How many synthetic datasets to fit.
+        resample: string
+            'residuals' or 'noise'. See bootstrap_replicates.
+        seed: int
+            Seed for the synthetic datasets.
+        workers: int, optional
+            How many processes to use. Defaults to the number of CPUs. With
+            1, the fits are run in this process.
+        kwargs:
+            Passed on to fit.
+
+    Returns
+    -------
+        names: list
+            Names of the free parameters.
+        samples: np.ndarray (2D)
+            Value of each free parameter (columns) in each replicate fit
+            (rows). Rows of failed fits are removed.
+        seconds: float
+            Time taken by all the fits.
+    """
+    if isinstance(model, str):
+        model = models.get_models(model)
+
+    names = [name for name, par in result.params.items()
+             if par.vary and not par.expr]
+    replicates = bootstrap_replicates(result, data, nreplicates, resample,
+                                      seed)
+    ragged = data if isinstance(data, RaggedData) else None
+
+    began = time.perf_counter()
+    if workers == 1:
+        samples = bootstrap_chunk(replicates, x, model, result.params, names,
+                                  kwargs, ragged)
+    else:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        # a few chunks per worker keeps them all busy to the end, without
+        # sending every replicate to a process on its own.
+        chunks = np.array_split(replicates, min(nreplicates, 4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(bootstrap_chunk, chunk, x, model,
+                                   result.params, names, kwargs, ragged)
+                       for chunk in chunks]
+            samples = np.concatenate([future.result() for future in futures])
+    seconds = time.perf_counter() - began
+
+    return names, samples[~np.isnan(samples).any(axis=1)], seconds
+
+
+def percentile_intervals(samples, prob=0.6827):
+    """Return the lower and upper ends of the central interval holding prob
+    of the samples of each parameter (columns of samples)."""
+    tail = 50 * (1 - prob)
+    return (np.percentile(samples, tail, axis=0),
+            np.percentile(samples, 100 - tail, axis=0))
 
 
 def report_result(result):
@@ -0,0 +1,375 @@
+"""This module turns kinetic mechanisms, schemes of first-order steps such as
+A -> B -> C or A <=> B -> C, into model functions that can be used like the
+models in src.models. See models.add_mechanism_model, which registers the
+result.
+
+The concentrations c of the species of a mechanism of first-order steps
+follow dc/dt = K c, where K is its rate matrix. With the eigendecomposition
+K = V diag(w) V^-1 they are, for any time t,
+
+    c(t) = V diag(exp(w t)) V^-1 c(0)
+
+so no ODE has to be integrated: the signal, a sum over the species of an
+amplitude times its concentration, is a sum of exponentials of x, evaluated
+at every x at once. Decompositions are kept by the values of the rate
+constants (see Decompositions), so while a fit varies anything else, like
+the amplitudes, none is worked out again.
+
+Where two eigenvalues (nearly) coincide, e.g. A -> B -> C with k1 == k2,
+the eigenvectors are (nearly) parallel and the sum of exponentials is lost
+to cancellation; its limit, t exp(-k t), is not a sum of exponentials at
+all. For those rate constants c(t) = expm(K t) c(0) is worked out with
+scipy's matrix exponential instead, which is smooth through them, so a fit
+can pass through or start from equal rate constants."""
+
+import inspect
+import re
+from collections import OrderedDict
+
+import numpy as np
+from scipy.linalg import expm
+
+from src import models
+
+# arrows between the species of a step, and whether the step is reversible
+ARROWS = {'->': False, '<=>': True, '<->': True}
+
+# eigenvalues of a rate matrix closer than this, relative to its largest
+# rate, count as equal. The error of the sum of exponentials grows as the
+# machine epsilon over their gap, so at the gap it is about 1e-13 relative,
+# and the matrix exponential used below it agrees to that.
+MIN_GAP = 1e-3
+
+# condition number of the eigenvectors above which the sum of exponentials
+# isn't used either, whatever the gaps of the eigenvalues
+MAX_CONDITION = 1e8
+
+
+class Mechanism(object):
+    """A scheme of first-order steps between species. species is the list of
+    their names, in the order they first appear, and steps a list of
+    (reactant, product, rate) of each step, with the indices of its species
+    and the name of its rate constant. Steps are numbered in the order of the
+    arrows of the scheme: the forward step of the i-th arrow has the rate
+    constant ki, and the reverse step of a reversible one kmi (k-i)."""
+
+    def __init__(self, scheme, species, steps):
+        self.scheme = scheme
+        self.species = species
+        self.steps = steps
+        self.rates = [rate for _, _, rate in steps]
+
+    def rate_matrix(self, rates):
+        """Return the rate matrices K for the rate constants, an array whose
+        last axis holds them in the order of self.rates, stacked along its
+        other axes."""
+        rates = np.asarray(rates, dtype=np.float64)
+        n = len(self.species)
+        matrix = np.zeros(rates.shape[:-1] + (n, n))
+        for column, (reactant, product, _) in enumerate(self.steps):
+            matrix[..., product, reactant] += rates[..., column]
+            matrix[..., reactant, reactant] -= rates[..., column]
+        return matrix
+
+
+def parse(scheme):
+    """Parse a scheme of first-order steps into a Mechanism. Steps are
+    separated by ; or , and a step may be a chain, A -> B <=> C. Species are
+    named like Python variables.
+
+    Raises ValueError if the scheme isn't valid, e.g. a step goes from a
+    species to itself, or the same step appears twice.
+    """
+    species = []
+    steps = []
+    seen = set()
+    pattern = '|'.join(re.escape(arrow) for arrow in
+                       sorted(ARROWS, key=len, reverse=True))
+    narrows = 0
+    for part in re.split('[;,]', scheme):
+        if not part.strip():
+            continue
+        tokens = [token.strip() for token in
+                  re.split('({0})'.format(pattern), part)]
+        names, arrows = tokens[::2], tokens[1::2]
+        if not arrows:
+            raise ValueError("{0} has no arrow; steps look like A -> B or "
+                             "A <=> B".format(part.strip()))
+        for name in names:
+            if not name.isidentifier():
+                raise ValueError("{0!r} can't be the name of a species in "
+                                 "{1}".format(name, part.strip()))
+            if name not in species:
+                species.append(name)
+
+        for reactant, arrow, product in zip(names, arrows, names[1:]):
+            if reactant == product:
+                raise ValueError("{0} {1} {0} goes nowhere".format(reactant,
+                                                                   arrow))
+            narrows += 1
+            pairs = [(reactant, product, 'k{0}'.format(narrows))]
+            if ARROWS[arrow]:
+                pairs.append((product, reactant, 'km{0}'.format(narrows)))
+            for a, b, rate in pairs:
+                if (a, b) in seen:
+                    raise ValueError("The step {0} -> {1} appears twice"
+                                     "".format(a, b))
+                seen.add((a, b))
+                steps.append((species.index(a), species.index(b), rate))
+
+    if not steps:
+        raise ValueError("{0!r} has no steps".format(scheme))
+    return Mechanism(scheme.strip(), species, steps)
+
+
+class Decompositions(object):
+    """The eigenvalues of the rate matrix of a mechanism, and the
+    contribution of each eigenvalue to the concentration of each species,
+    for each set of rate constants it was asked for, the size most recently
+    used kept.
+
+    Each decomposition holds w, the eigenvalues, and P, where
+    P[s, j] = V[s, j] (V^-1 c(0))[j], so that the concentration of species s
+    is sum_j P[s, j] exp(w[j] t). They are real unless the mechanism has a
+    cycle that makes them complex. Rate constants whose eigenvalues are
+    nearly equal are confluent: their w and P are zeros, and their
+    concentrations come from evolve instead.
+    """
+
+    def __init__(self, mechanism, initial, size=256):
+        self.mechanism = mechanism
+        self.initial = np.asarray(initial, dtype=np.float64)
+        self.size = size
+        self.found = OrderedDict()  # rate constants -> (w, P, confluent)
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, rates):
+        """Return the eigenvalues and contributions for the rate constants,
+        an array of shape (m, number of rate constants): arrays of shapes
+        (m, n) and (m, n, n), for n species, and whether each row is
+        confluent, an array of shape (m,)."""
+        keys = [row.tobytes() for row in rates]
+        missing = [i for i, key in enumerate(keys) if key not in self.found]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            w, P, confluent = self.decompose(rates[missing])
+            for i, w_i, P_i, c_i in zip(missing, w, P, confluent):
+                self.found[keys[i]] = (w_i, P_i, c_i)
+
+        found = []
+        for key in keys:
+            self.found.move_to_end(key)
+            found.append(self.found[key])
+        while len(self.found) > max(self.size, len(keys)):
+            self.found.popitem(last=False)
+        if len(found) == 1:
+            w, P, confluent = found[0]
+            return w[np.newaxis], P[np.newaxis], np.asarray([confluent])
+        w = np.asarray([w_i for w_i, _, _ in found])
+        P = np.asarray([P_i for _, P_i, _ in found])
+        confluent = np.asarray([c_i for _, _, c_i in found])
+        return w, P, confluent
+
+    def decompose(self, rates):
+        """Decompose the rate matrices of the rows of rates, all at once.
+        Returns w, P and whether each row is confluent."""
+        matrix = self.mechanism.rate_matrix(rates)
+        w, V = np.linalg.eig(matrix)
+        n = w.shape[-1]
+        gaps = np.abs(w[:, :, np.newaxis] - w[:, np.newaxis, :])
+        gaps[:, np.arange(n), np.arange(n)] = np.inf
+        scale = np.abs(matrix).max(axis=(-2, -1))
+        confluent = ((gaps.min(axis=(-2, -1)) < MIN_GAP * scale) |
+                     (np.linalg.cond(V) > MAX_CONDITION))
+        # nothing for the sum of exponentials to add for confluent rows
+        V[confluent] = np.eye(n)
+
+        a = np.linalg.solve(V, np.broadcast_to(
+            self.initial, w.shape).astype(V.dtype)[..., np.newaxis])
+        P = V * a[..., 0][:, np.newaxis, :]
+        w[confluent], P[confluent] = 0.0, 0.0
+        if np.iscomplexobj(w) and not np.any(w.imag) and not np.any(P.imag):
+            w, P = w.real, P.real
+        return w, P, confluent
+
+    def evolve(self, rates, t):
+        """Return the concentrations of the species at the times t, an array
+        of shape (n,) for n species, for one row of rate constants, from the
+        matrix exponential of its rate matrix: an array of shape (len(t),
+        n). Used for confluent rate constants."""
+        matrix = self.mechanism.rate_matrix(rates)
+        t = np.asarray(t, dtype=np.float64)
+        return expm(matrix * t[:, np.newaxis, np.newaxis]) @ self.initial
+
+
+def concentrations(mechanism, x, rates, initial):
+    """Return the concentration of each species of the mechanism at x, for
+    the rate constants rates, in the order of mechanism.rates, and the
+    initial concentrations. Useful to check or plot a mechanism; model
+    functions use Decompositions directly."""
+    decompositions = Decompositions(mechanism, initial)
+    rates = np.asarray(rates, dtype=np.float64)
+    w, P, confluent = decompositions(rates[np.newaxis])
+    if confluent[0]:
+        return decompositions.evolve(rates, np.ravel(x)).T.reshape(
+            (len(mechanism.species),) + np.shape(x))
+    terms = np.exp(np.multiply.outer(np.asarray(x, dtype=np.float64), w[0]))
+    return (terms @ P[0].T).real.T
+
+
+class MechanismModel(models.SessionModel):
+    """A model function of the signal of a mechanism (a Mechanism, or a
+    scheme to parse), called name. It takes x, the times, then the rate
+    constants, an amplitude amp_<species> of each species, the signal of a
+    unit of its concentration, and an offset, and returns
+
+        y = sum(amp_<species> * concentration of the species at x) + offset
+
+    Its signal is linear in the amplitudes and offset, and its rate
+    constants can't be negative. initial is a dict of
+    the initial concentration of each species, 1 of the first species and
+    none of any other by default.
+
+    Every argument may be an array that broadcasts against x, as in a
+    global fit. The eigendecomposition of the rate matrix is only worked out
+    for each distinct set of rate constants, and the last size are kept.
+    Pickled as its scheme, name and initial concentrations (see
+    models.SessionModel).
+    """
+
+    def __init__(self, mechanism, name, initial=None, size=256):
+        if isinstance(mechanism, str):
+            mechanism = parse(mechanism)
+        if not name.isidentifier() or name.startswith('_'):
+            raise ValueError("{0} can't be the name of a model".format(name))
+        species = mechanism.species
+        if initial is None:
+            initial = {species[0]: 1.0}
+        unknown = set(initial) - set(species)
+        if unknown:
+            raise ValueError("{0} is not a species of {1}".format(
+                unknown.pop(), mechanism.scheme))
+        initial = [float(initial.get(s, 0.0)) for s in species]
+
+        rates = mechanism.rates
+        amps = ['amp_{0}'.format(s) for s in species]
+        self._rates = rates
+        self._amps = amps
+        self._decompositions = Decompositions(mechanism, initial, size)
+        self.linear = amps + ['offset']
+        # a negative rate constant makes concentrations grow without bound
+        self.bounds = {rate: (0.0, np.inf) for rate in rates}
+
+        # distinct defaults, so the default mechanism can be diagonalized.
+        defaults = OrderedDict()
+        for rate in rates:
+            number = int(rate.lstrip('km'))
+            defaults[rate] = (0.1 if rate.startswith('km') else 1.0) / number
+        for k, amp in enumerate(amps):
+            defaults[amp] = 1.0 if k == 0 else 0.0
+        defaults['offset'] = 0.0
+        self._defaults = defaults
+
+        kind = inspect.Parameter.POSITIONAL_OR_KEYWORD
+        arguments = [inspect.Parameter('x', kind)]
+        arguments += [inspect.Parameter(arg, kind, default=value)
+                      for arg, value in defaults.items()]
+        arguments.append(inspect.Parameter('out', kind, default=None))
+        self.__signature__ = inspect.Signature(arguments)
+        self.__name__ = self.__qualname__ = name
+        self.__doc__ = "\n".join([
+            "",
+            "    {0}:".format(name),
+            "        the signal of the mechanism {0}".format(mechanism.scheme),
+            "        y = {0} + offset".format(" + ".join(
+                "amp_{0} * [{0}](x)".format(s) for s in species)),
+            "        starting from {0}".format(", ".join(
+                "[{0}] = {1:g}".format(s, c)
+                for s, c in zip(species, initial))),
+            "        Parameters",
+            "        ----------",
+            "                x : array of values (times, e.g. of a "
+            "stopped-flow trace).",
+            "                {0} : float".format(", ".join(rates)),
+            "                    rate constants of the steps {0}, in the "
+            "inverse units of x.".format(", ".join(
+                "{0} -> {1}".format(species[a], species[b])
+                for a, b, _ in mechanism.steps)),
+            "                {0} : float".format(", ".join(amps)),
+            "                    signal of a unit of each species.",
+            "                offset : float",
+            "                    baseline of the signal.",
+            ""])
+        # what the model is besides its code, for the fit cache; the
+        # decompositions are private, as they change as it's used.
+        self.scheme = mechanism.scheme
+        self.initial = tuple(initial)
+        self.mechanism = mechanism
+
+    def recipe(self):
+        return (self.scheme, self.__name__,
+                dict(zip(self.mechanism.species, self.initial)),
+                self._decompositions.size)
+
+    def register(self, aliases=()):
+        super().register(aliases)
+        models.MECHANISM_MODELS.add(self.__name__)
+
+    def __call__(self, x, out=None, **kwargs):
+        defaults = self._defaults
+        for arg in kwargs:
+            if arg not in defaults:
+                raise TypeError("{0}() got an unexpected keyword argument "
+                                "{1!r}".format(self.__name__, arg))
+        values = [kwargs.get(rate, defaults[rate]) for rate in self._rates]
+        stacked = np.stack(np.broadcast_arrays(
+            *(np.asarray(v, dtype=np.float64) for v in values)), axis=-1)
+        lead = stacked.shape[:-1]
+        flat = stacked.reshape(-1, len(self._rates))
+        inverse = np.zeros(lead, dtype=int)
+        if len(flat) > 1:
+            # e.g. one row per point of RaggedData, but few distinct ones.
+            flat, inverse = np.unique(flat, axis=0, return_inverse=True)
+            inverse = inverse.reshape(lead)
+        w, P, confluent = self._decompositions(flat)
+        if len(flat) < int(np.prod(lead, dtype=int)):
+            w, P = w[inverse.ravel()], P[inverse.ravel()]
+        w = w.reshape(lead + w.shape[-1:])
+        P = P.reshape(lead + P.shape[-2:])
+
+        # the contribution of each eigenvalue to the signal
+        coefficients = 0.0
+        for k, amp in enumerate(self._amps):
+            a = np.asarray(kwargs.get(amp, defaults[amp]), dtype=np.float64)
+            coefficients = coefficients + a[..., np.newaxis] * P[..., k, :]
+
+        offset = kwargs.get('offset', defaults['offset'])
+        shape = np.broadcast_shapes(np.shape(x), np.shape(offset),
+                                    np.shape(coefficients)[:-1], lead)
+        if out is None:
+            out = np.empty(shape)
+        out[...] = offset
+        term = np.empty(shape, dtype=w.dtype)
+        for j in range(w.shape[-1]):
+            np.multiply(x, w[..., j], out=term)
+            np.exp(term, out=term)
+            term *= coefficients[..., j]
+            out += term.real
+
+        # confluent rate constants have nothing in the sum above.
+        for row in np.flatnonzero(confluent):
+            where = np.broadcast_to(inverse, shape) == row
+            c = self._decompositions.evolve(
+                flat[row], np.broadcast_to(x, shape)[where])
+            for k, amp in enumerate(self._amps):
+                a = np.asarray(kwargs.get(amp, defaults[amp]))
+                out[where] += np.broadcast_to(a, shape)[where] * c[:, k]
+        return out
+
+
+def mechanism_model(mechanism, name, initial=None, size=256):
+    """Return a model function of the signal of the mechanism, called name
+    (see MechanismModel)."""
+    return MechanismModel(mechanism, name, initial, size)
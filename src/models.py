@@ -1,10 +1,21 @@
 """This module should contain all models to be used by the fitting routines.
 The default parameters of the functions will be used as starting guesses to
-the parameter if the user doesn't provide them."""
+the parameter if the user doesn't provide them.
+
+Besides the models defined here, models are found in plugins: Python modules
+in PLUGIN_DIR, and functions that installed packages list under the
+ENTRY_POINT_GROUP entry point group. They are found the first time a model
+is looked up, and a plugin is only imported once one of its models is used,
+so startup doesn't depend on how many are installed. Every model's name and
+aliases are kept in MODELS, and each alias maps to its model in ALIASES."""
 
 import numpy as np
 
+import abc
+import ast
+import importlib.util
 import inspect
+import os
 import sys
 
 # All the models currently implemented
@@ -12,9 +23,98 @@ import sys
 #   exact_name_of_function: [list of aliases the user can use]
 MODELS = {'linear': ['linear', 'line'],
           'gaussian_1d': ['gaussian_1d', 'gauss', 'gaussian', '1dgauss'],
-          'two_state_equilibrium_chemical_denaturation': ['two_state',]
+          'two_state_equilibrium_chemical_denaturation': ['two_state',],
+          'one_exponential': ['one_exponential', 'exp1', 'single_exp'],
+          'two_exponential': ['two_exponential', 'exp2', 'double_exp'],
+          'three_exponential': ['three_exponential', 'exp3', 'triple_exp'],
 }
 
+# Models written purely in numpy expressions, which give the right answer
+# when their parameters are arrays of shape (n_datasets, 1) instead of floats.
+# These are evaluated once for all datasets in a global fit.
+BROADCASTABLE = {'linear',
+                 'gaussian_1d',
+                 'two_state_equilibrium_chemical_denaturation',
+                 'one_exponential',
+                 'two_exponential',
+                 'three_exponential'}
+
+# Arguments of each model that only ever multiply a term of the model, i.e.
+# the model is a linear combination of them. With the varpro option of
+# fit.fit these are solved for exactly at each step, instead of being left to
+# the minimizer.
+LINEAR_PARAMETERS = {
+    'linear': ['intercept', 'slope'],
+    'two_state_equilibrium_chemical_denaturation': ['nativeyint',
+                                                    'nativeyslope',
+                                                    'unfoldedyint',
+                                                    'unfoldedyslope'],
+    'one_exponential': ['amp1', 'offset'],
+    'two_exponential': ['amp1', 'amp2', 'offset'],
+    'three_exponential': ['amp1', 'amp2', 'amp3', 'offset'],
+}
+
+# Bounds of arguments of each model outside of which it makes no sense, e.g.
+# rate constants, which can't be negative: {argument: (min, max)} of each
+# model. The default parameters of the model start with them (see
+# params.create_default_params).
+PARAMETER_BOUNDS = {}
+
+# Models that can write their result into an array passed as out, instead of
+# returning a new one. A fit passes them the same array at every iteration.
+WRITES_OUT = {'linear',
+              'gaussian_1d',
+              'two_state_equilibrium_chemical_denaturation',
+              'one_exponential',
+              'two_exponential',
+              'three_exponential'}
+
+# Models that treat the x values they are given as one evenly spaced grid,
+# e.g. those convolved with an instrument response (see reconvolved_model).
+# They can't be evaluated for the datasets of RaggedData all at once, where
+# x holds the x values of every dataset end to end.
+UNIFORM_X = set()
+
+# Most x grids a reconvolved model keeps the transformed instrument
+# response for. Each dataset of RaggedData may have its own.
+MAX_GRIDS = 64
+
+# Models of kinetic mechanisms added with add_mechanism_model for this
+# session (see src.kinetics).
+MECHANISM_MODELS = set()
+
+# Models added from expressions with add_user_model are kept here, one
+# Python file per model (see src.expressions), and loaded at import. Their
+# names are in USER_MODELS.
+USER_MODELS = set()
+USER_MODELS_DIR = os.path.join(os.path.expanduser('~'), '.pysavuka',
+                               'models')
+
+# Modules holding models, one Python file each, like this one: they define
+# MODELS in the same format, as a literal dict, and may define BROADCASTABLE,
+# LINEAR_PARAMETERS and WRITES_OUT for their own models.
+PLUGIN_DIR = os.path.join(os.path.expanduser('~'), '.pysavuka', 'plugins')
+
+# Installed packages can add models as entry points of this group, e.g.
+#   entry_points={'pysavuka.models': ['kinetics = mypackage.models:kinetics']}
+# The name of each entry point is an alias of the model. The module of the
+# function may define BROADCASTABLE, LINEAR_PARAMETERS and WRITES_OUT.
+ENTRY_POINT_GROUP = 'pysavuka.models'
+
+# alias -> name of every model
+ALIASES = {alias: name for name, aliases in MODELS.items()
+           for alias in aliases}
+
+# name -> function that imports the model, of each model found in a plugin
+# that hasn't been used yet. See load_model.
+LOADERS = {}
+
+# name -> inspect.Signature of each model that has been loaded
+SIGNATURES = {}
+
+# whether the plugins and user models have been looked for yet
+DISCOVERED = False
+
 #  look to lmfit.lineshapes for a sampling of models
 
 
@@ -23,30 +123,363 @@ GAS_CONSTANT_KCAL = 1.9872036
 
 
 def get_models(name=None):
-    """Return a list of all the model functions in this module."""
-    funcs = inspect.getmembers(sys.modules[__name__], inspect.isfunction)
+    """Return the model function with the name or alias name, or a list of
+    all the model functions if name is None. Raises IndexError if there is
+    no such model.
 
+    Listing all the models imports every plugin that holds one."""
+    discover()
     if not name:
-        # return the functions from all models in the list
-        fit_models = [f[1] for f in funcs if f[0] in MODELS]
-    else:
-        # return the function if it is in fact a model function and the
-        # provided name matches one of the aliases.
-        fit_models = [f[1] for f in funcs if f[0] in MODELS.keys()
-                      and name in MODELS[f[0]]]
-        # if you provide a name, you expect one function
-        return fit_models[0]
-    # otherwise, you expect a list of function objects.
-    return fit_models
+        return [load_model(model) for model in list(MODELS)]
+    try:
+        return load_model(ALIASES[name])
+    except KeyError:
+        raise IndexError("There is no model called {0}".format(name))
+
+
+def load_model(name):
+    """Return the model function called name, importing its plugin if it
+    hasn't been used yet."""
+    func = globals().get(name)
+    if func is None:
+        func = LOADERS.pop(name)()
+    return func
+
+
+def __getattr__(name):
+    # models of plugins become attributes of this module once they are
+    # loaded, which is how they are pickled (e.g. for worker processes).
+    if not name.startswith('__'):
+        discover()
+        if name in LOADERS:
+            return load_model(name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(
+        __name__, name))
+
+
+def discover():
+    """Look for the models of plugins (see load_plugins and
+    load_entry_points) and users (see load_user_models), the first time it
+    is called."""
+    global DISCOVERED
+    if DISCOVERED:
+        return
+    DISCOVERED = True
+    load_user_models()
+    load_plugins()
+    load_entry_points()
+
+
+def broadcasts(model):
+    """True if the model function can be evaluated for many datasets at once
+    by passing it arrays of parameter values."""
+    return getattr(model, '__name__', None) in BROADCASTABLE
+
+
+def linear_parameters(model):
+    """Return the list of arguments that the model function is linear in, as
+    listed in LINEAR_PARAMETERS."""
+    return LINEAR_PARAMETERS.get(getattr(model, '__name__', None), [])
+
+
+def parameter_bounds(model):
+    """Return a dictionary of the (min, max) of each argument of the model
+    function that is bounded, as listed in PARAMETER_BOUNDS."""
+    return PARAMETER_BOUNDS.get(getattr(model, '__name__', None), {})
+
+
+def writes_out(model):
+    """True if the model function takes an out argument to write its result
+    into, as listed in WRITES_OUT."""
+    return getattr(model, '__name__', None) in WRITES_OUT
+
+
+def signature(model):
+    """Return the inspect.Signature of the model function. Those of
+    registered models are worked out once, when they are loaded."""
+    name = getattr(model, '__name__', None)
+    if name in SIGNATURES and globals().get(name) is model:
+        return SIGNATURES[name]
+    return inspect.signature(model)
+
+
+def needs_uniform_x(model):
+    """True if the model function needs the x values of each dataset to be
+    one evenly spaced grid, as listed in UNIFORM_X."""
+    return getattr(model, '__name__', None) in UNIFORM_X
+
+
+def default_values(model):
+    """Return a dictionary of the default value of each parameter of the model
+    function, i.e. every argument besides x and out."""
+    return {name: p.default for name, p
+            in signature(model).parameters.items()
+            if p.default is not inspect.Parameter.empty and name != 'out'}
+
+
+def add_aliases(name, aliases):
+    """List the model called name under its name and aliases in MODELS and
+    ALIASES. Aliases of other models are left to them."""
+    aliases = [name] + [alias for alias in aliases if alias != name]
+    for alias in MODELS.pop(name, []):
+        del ALIASES[alias]
+    MODELS[name] = []
+    for alias in aliases:
+        if ALIASES.setdefault(alias, name) == name:
+            MODELS[name].append(alias)
+        else:
+            print("{0} already names the model {1}".format(alias,
+                                                           ALIASES[alias]))
+
+
+def install_model(func):
+    """Make func an attribute of this module, so that it's found by
+    get_models and pickled as one of these models, and work out its
+    signature."""
+    name = func.__name__
+    func.__module__ = __name__
+    func.__qualname__ = name
+    globals()[name] = func
+    SIGNATURES[name] = inspect.signature(func)
+
+
+def register_model(func, aliases=()):
+    """Make the model function available under its name and aliases, like
+    the models defined in this module. It must broadcast and take out, as
+    models compiled from expressions do."""
+    name = func.__name__
+    add_aliases(name, aliases)
+    install_model(func)
+    BROADCASTABLE.add(name)
+    WRITES_OUT.add(name)
+
+
+def unregister_model(name):
+    """Forget the model called name, loaded or not."""
+    for alias in MODELS.pop(name, []):
+        del ALIASES[alias]
+    BROADCASTABLE.discard(name)
+    WRITES_OUT.discard(name)
+    UNIFORM_X.discard(name)
+    MECHANISM_MODELS.discard(name)
+    LINEAR_PARAMETERS.pop(name, None)
+    PARAMETER_BOUNDS.pop(name, None)
+    LOADERS.pop(name, None)
+    SIGNATURES.pop(name, None)
+    globals().pop(name, None)
+
+
+def register_lazy_model(name, aliases, loader):
+    """List a model under its name and aliases without importing it yet.
+    loader is called with no arguments the first time the model is used, and
+    must return its function. Returns False, without registering it, if name
+    is already the name of a model."""
+    if name in MODELS or name in globals():
+        print("{0} is already a model; skipping the plugin's.".format(name))
+        return False
+    add_aliases(name, aliases)
+    LOADERS[name] = loader
+    return True
+
+
+def install_plugin_model(func, module):
+    """Install the model function func from the plugin module, with the
+    BROADCASTABLE, LINEAR_PARAMETERS and WRITES_OUT that module gives it."""
+    name = func.__name__
+    install_model(func)
+    if name in getattr(module, 'BROADCASTABLE', ()):
+        BROADCASTABLE.add(name)
+    if name in getattr(module, 'WRITES_OUT', ()):
+        WRITES_OUT.add(name)
+    if name in getattr(module, 'LINEAR_PARAMETERS', {}):
+        LINEAR_PARAMETERS[name] = list(module.LINEAR_PARAMETERS[name])
+    return func
+
+
+def literal_assignments(path, names):
+    """Return the values of the top level assignments of literals to names
+    in the Python file at path, without running it."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    found = {}
+    for statement in tree.body:
+        if (isinstance(statement, ast.Assign) and
+                len(statement.targets) == 1 and
+                isinstance(statement.targets[0], ast.Name) and
+                statement.targets[0].id in names):
+            found[statement.targets[0].id] = ast.literal_eval(statement.value)
+    return found
+
+
+def import_plugin(path):
+    """Import the plugin module in the file at path, once."""
+    module_name = "pysavuka_plugin_{0}".format(
+        os.path.splitext(os.path.basename(path))[0])
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[module_name]
+            raise
+    return sys.modules[module_name]
+
+
+def load_plugins(directory=None):
+    """List the models of every plugin module in directory (PLUGIN_DIR by
+    default), read from its MODELS without importing it. A plugin that can't
+    be read is skipped with a message."""
+    directory = directory or PLUGIN_DIR
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+    for filename in names:
+        if not filename.endswith('.py'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            found = literal_assignments(path, {'MODELS'}).get('MODELS', {})
+        except (SyntaxError, ValueError) as e:
+            print("Couldn't read the models in {0}: {1}".format(filename, e))
+            continue
+
+        for name, aliases in found.items():
+            def loader(path=path, name=name):
+                module = import_plugin(path)
+                return install_plugin_model(getattr(module, name), module)
+            register_lazy_model(name, aliases, loader)
+
+
+def load_entry_points(group=None):
+    """List the models that installed packages give as entry points of group
+    (ENTRY_POINT_GROUP by default), without importing them."""
+    from importlib import metadata
+    try:
+        points = metadata.entry_points(group=group or ENTRY_POINT_GROUP)
+    except TypeError:  # before Python 3.10
+        points = metadata.entry_points().get(group or ENTRY_POINT_GROUP, [])
+
+    # entry points naming the same function are aliases of one model.
+    found = {}
+    for point in points:
+        found.setdefault(point.value, []).append(point)
+    for value, same in found.items():
+        module_name, _, name = value.partition(':')
+
+        def loader(point=same[0], module_name=module_name):
+            return install_plugin_model(point.load(),
+                                        sys.modules[module_name])
+        register_lazy_model(name, [point.name for point in same], loader)
+
+
+def load_user_model(path):
+    """Load and register the user model in the file at path, recompiling it
+    first if it was compiled by an older version of src.expressions."""
+    with open(path) as f:
+        source = f.read()
+    namespace = {}
+    exec(compile(source, path, 'exec'), namespace)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    from src import expressions
+    if namespace.get('VERSION') != expressions.VERSION:
+        return add_user_model(name, namespace['EXPRESSION'],
+                              namespace['ALIASES'], os.path.dirname(path))
+
+    register_model(namespace[name], namespace['ALIASES'])
+    USER_MODELS.add(name)
+    return namespace[name]
+
+
+def load_user_models(directory=None):
+    """List every user model in directory (USER_MODELS_DIR by default), to
+    be loaded the first time it's used. A model that can't be read is
+    skipped with a message."""
+    directory = directory or USER_MODELS_DIR
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+    for filename in names:
+        if not filename.endswith('.py'):
+            continue
+        path = os.path.join(directory, filename)
+        name = os.path.splitext(filename)[0]
+        try:
+            aliases = literal_assignments(path, {'ALIASES'})['ALIASES']
+        except (SyntaxError, ValueError, KeyError) as e:
+            print("Couldn't load the model in {0}: {1}".format(filename, e))
+            continue
+        if register_lazy_model(name, aliases,
+                               lambda path=path: load_user_model(path)):
+            USER_MODELS.add(name)
+
+
+def user_model_path(name, directory=None):
+    return os.path.join(directory or USER_MODELS_DIR, name + '.py')
+
+
+def add_user_model(name, expression, aliases=(), directory=None):
+    """Compile the expression into a model function called name (see
+    src.expressions), save it in directory (USER_MODELS_DIR by default) so
+    it's loaded in every later session, and register it. A user model with
+    the same name is replaced. Returns the model function.
+
+    Raises ValueError if the expression isn't valid, or the name or an
+    alias is taken by another model.
+    """
+    from src import expressions
+    discover()
+    aliases = [str(alias) for alias in aliases]
+    for other, taken in MODELS.items():
+        if other == name:
+            continue
+        clash = {name, *aliases} & set(taken)
+        if clash:
+            raise ValueError("{0} already names the model {1}".format(
+                clash.pop(), other))
+    if name in MODELS and name not in USER_MODELS:
+        raise ValueError("{0} is already a built-in model".format(name))
+    if name not in MODELS and name in globals():
+        raise ValueError("{0} can't be the name of a model".format(name))
+
+    source = expressions.model_source(name, expression, aliases)
+    directory = directory or USER_MODELS_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = user_model_path(name, directory)
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temp, 'w') as f:
+        f.write(source)
+    os.replace(temp, path)
+    return load_user_model(path)
+
+
+def remove_user_model(name, directory=None):
+    """Forget the user model called name, and delete its file. Returns False
+    if there was no such user model."""
+    discover()
+    if name not in USER_MODELS:
+        return False
+    try:
+        os.remove(user_model_path(name, directory))
+    except FileNotFoundError:
+        pass
+    unregister_model(name)
+    USER_MODELS.discard(name)
+    return True
 
 
 def get_helps(name=None):
     """Return the list of help texts from the model functions (__doc__ aka the
     triple-quoted lines below the fucntion definition."""
-    return [m.__doc__ for m in get_models(name)]
+    found = get_models(name) if not name else [get_models(name)]
+    return [m.__doc__ for m in found]
 
 
-def linear(x, intercept=0.0, slope=1.0):
+def linear(x, intercept=0.0, slope=1.0, out=None):
     """
     linear:
         Parameters
@@ -58,10 +491,15 @@ def linear(x, intercept=0.0, slope=1.0):
                     y-intercept of fitted linear model.
 
             """
-    return slope * x + intercept
+    if out is None:
+        return slope * x + intercept
 
+    np.multiply(slope, x, out=out)
+    out += intercept
+    return out
 
-def gaussian_1d(x, amp=1.0, cen=1.0, wid=1.0):
+
+def gaussian_1d(x, amp=1.0, cen=1.0, wid=1.0, out=None):
     """
     gaussian (1-d):
         Parameters
@@ -75,13 +513,20 @@ def gaussian_1d(x, amp=1.0, cen=1.0, wid=1.0):
                     standard deviation
 
                     """
+    if out is None:
+        return (amp/(np.sqrt(2*np.pi)*wid)) * np.exp(-(x-cen)**2/(2*wid**2))
 
-    return (amp/(np.sqrt(2*np.pi)*wid)) * np.exp(-(x-cen)**2/(2*wid**2))
+    np.subtract(x, cen, out=out)
+    np.square(out, out=out)
+    out /= -2*wid**2
+    np.exp(out, out=out)
+    out *= amp/(np.sqrt(2*np.pi)*wid)
+    return out
 
 
 def two_state_equilibrium_chemical_denaturation(
         x, deltag=5.0, m=1.8, nativeyint=0.0, unfoldedyint=250000.0,
-        nativeyslope=1000, unfoldedyslope=2.0, temperature=298.15):
+        nativeyslope=1000, unfoldedyslope=2.0, temperature=298.15, out=None):
     """
     two state equilibrium (chemical denaturation):
         Parameters
@@ -91,6 +536,20 @@ def two_state_equilibrium_chemical_denaturation(
 
 
     """
+    if out is not None:
+        # unfolded fraction K / (1 + K) is 1 / (1 + exp(deltag_at_conc / RT))
+        np.multiply(m, x, out=out)
+        out += deltag
+        out /= GAS_CONSTANT_KCAL*temperature
+        np.exp(out, out=out)
+        out += 1
+        np.reciprocal(out, out=out)
+
+        # native y + unfolded fraction * (unfolded y - native y)
+        out *= (unfoldedyint - nativeyint) + (unfoldedyslope - nativeyslope) * x
+        out += nativeyint + nativeyslope * x
+        return out
+
     delta_g_at_concentration = deltag + m * x
     equilibrium_constant = np.exp(-delta_g_at_concentration/(GAS_CONSTANT_KCAL*temperature))
     unfolded_fraction = equilibrium_constant / (1 + equilibrium_constant)
@@ -101,3 +560,343 @@ def two_state_equilibrium_chemical_denaturation(
     return unfolded_fraction*unfolded_y_at_concentration + (1-unfolded_fraction)*native_y_at_concentration
 
 
+
+def exponentials(x, taus, amps, offset, out=None):
+    """Write offset + sum(amp * exp(-x / tau)) over the pairs of taus and
+    amps into out, or a new array, which is returned. Every argument may be
+    an array that broadcasts against x."""
+    shape = np.broadcast_shapes(np.shape(x), np.shape(offset),
+                                *(np.shape(p) for p in taus + amps))
+    if out is None:
+        out = np.empty(shape)
+    term = np.empty(shape) if len(taus) > 1 else None
+    for k, (tau, amp) in enumerate(zip(taus, amps)):
+        target = out if k == 0 else term
+        np.multiply(x, -1.0 / np.asarray(tau, dtype=np.float64), out=target)
+        np.exp(target, out=target)
+        target *= amp
+        if k:
+            out += term
+    out += offset
+    return out
+
+
+def one_exponential(x, tau1=1.0, amp1=1.0, offset=0.0, out=None):
+    """
+    single exponential decay:
+        y = amp1 * exp(-x / tau1) + offset
+        Parameters
+        ----------
+                x : array of values (times, e.g. of a stopped-flow trace).
+                tau1 : float
+                    lifetime of the decay, in the units of x.
+                amp1 : float
+                    amplitude of the decay at x = 0.
+                offset : float
+                    baseline the decay ends at.
+
+    """
+    return exponentials(x, (tau1,), (amp1,), offset, out)
+
+
+def two_exponential(x, tau1=1.0, tau2=4.0, amp1=1.0, amp2=1.0, offset=0.0,
+                    out=None):
+    """
+    double exponential decay:
+        y = amp1 * exp(-x / tau1) + amp2 * exp(-x / tau2) + offset
+        Parameters
+        ----------
+                x : array of values (times, e.g. of a stopped-flow trace).
+                tau1, tau2 : float
+                    lifetimes of the two phases, in the units of x.
+                amp1, amp2 : float
+                    amplitudes of the two phases at x = 0.
+                offset : float
+                    baseline the decay ends at.
+
+    """
+    return exponentials(x, (tau1, tau2), (amp1, amp2), offset, out)
+
+
+def three_exponential(x, tau1=1.0, tau2=4.0, tau3=16.0, amp1=1.0, amp2=1.0,
+                      amp3=1.0, offset=0.0, out=None):
+    """
+    triple exponential decay:
+        y = amp1 * exp(-x / tau1) + amp2 * exp(-x / tau2)
+            + amp3 * exp(-x / tau3) + offset
+        Parameters
+        ----------
+                x : array of values (times, e.g. of a stopped-flow trace).
+                tau1, tau2, tau3 : float
+                    lifetimes of the three phases, in the units of x.
+                amp1, amp2, amp3 : float
+                    amplitudes of the three phases at x = 0.
+                offset : float
+                    baseline the decay ends at.
+
+    """
+    return exponentials(x, (tau1, tau2, tau3), (amp1, amp2, amp3), offset,
+                        out)
+
+
+class Reconvolution(object):
+    """An instrument response on one evenly spaced x grid, transformed once,
+    and the arrays used to convolve models with it, reused by every call.
+
+    Convolving n points directly takes O(n^2) operations. Here the model is
+    evaluated into the start of a zero padded array of a length good for
+    FFTs, at least 2n - 1 so the convolution doesn't wrap around, and
+    multiplied by the transform of the instrument response, which takes
+    O(n log n). The instrument response is interpolated onto the grid and
+    normalized to sum to 1, so the amplitudes of the model keep their
+    meaning.
+    """
+
+    def __init__(self, x, irf_x, irf_y):
+        from scipy import fft
+        self.fft = fft
+        x = np.asarray(x, dtype=np.float64)
+        self.npoints = n = len(x)
+        self.dx = (x[-1] - x[0]) / (n - 1) if n > 1 else 1.0
+        if n > 1 and not np.allclose(np.diff(x), self.dx, rtol=1e-6,
+                                     atol=0):
+            raise ValueError("Convolving with an instrument response needs "
+                             "evenly spaced x values.")
+        # time since the start of the grid, which the model is evaluated at
+        self.t = x - x[0]
+
+        irf = np.interp(x, irf_x, irf_y, left=0.0, right=0.0)
+        if not irf.sum():
+            raise ValueError("The instrument response doesn't overlap the "
+                             "x values of the data.")
+        self.nfft = fft.next_fast_len(2 * n - 1, real=True)
+        self.irf = fft.rfft(irf / irf.sum(), self.nfft)
+        self.freqs = np.fft.rfftfreq(self.nfft, self.dx)
+        self.padded = {}  # leading shape -> zero padded array for the model
+
+    def convolve(self, model, kwargs, shift=0.0, offset=0.0, out=None):
+        """Write model(t, **kwargs) convolved with the instrument response,
+        shifted later by shift, plus offset, into out (or a new array)."""
+        n = self.npoints
+        shape = np.broadcast_shapes(self.t.shape, np.shape(shift),
+                                    np.shape(offset),
+                                    *(np.shape(v) for v in kwargs.values()))
+        lead = shape[:-1]
+        padded = self.padded.get(lead)
+        if padded is None:
+            padded = self.padded[lead] = np.zeros(lead + (self.nfft,))
+        if writes_out(model):
+            model(self.t, out=padded[..., :n], **kwargs)
+        else:
+            padded[..., :n] = model(self.t, **kwargs)
+
+        spectrum = self.fft.rfft(padded, axis=-1)
+        spectrum *= self.irf
+        if np.any(shift):
+            spectrum *= np.exp(-2j * np.pi * self.freqs *
+                               np.asarray(shift, dtype=np.float64))
+        convolved = self.fft.irfft(spectrum, self.nfft, axis=-1,
+                                   overwrite_x=True)
+
+        if out is None:
+            out = np.empty(shape)
+        np.add(convolved[..., :n], offset, out=out)
+        return out
+
+
+class SessionModel(abc.ABC):
+    """Base of the model functions made during a session from a recipe, such
+    as a measured instrument response, instead of being defined in a module.
+    Worker processes started by spawn (the default on Windows and macOS)
+    don't have them, so they are pickled as their recipe, and rebuilt, and
+    registered if they were, when unpickled (see rebuild_model).
+
+    Subclasses define recipe, and set what register needs to list them like
+    the models of this module: uniform_x, broadcastable, linear and bounds.
+    """
+
+    # whether the model needs the x values of each dataset to be one evenly
+    # spaced grid (see UNIFORM_X), whether it broadcasts (see BROADCASTABLE),
+    # the arguments it's linear in (see LINEAR_PARAMETERS), and the bounds
+    # of its arguments (see PARAMETER_BOUNDS).
+    uniform_x = False
+    broadcastable = True
+    linear = ()
+    bounds = {}
+
+    @abc.abstractmethod
+    def recipe(self):
+        """Return the arguments the class is called with to make the same
+        model again."""
+
+    def __reduce__(self):
+        name = self.__name__
+        aliases = MODELS.get(name) if globals().get(name) is self else None
+        return rebuild_model, (type(self), self.recipe(), aliases)
+
+    def register(self, aliases=()):
+        """Make the model available under its name and aliases, replacing
+        any model of the session with the same name."""
+        name = self.__name__
+        unregister_model(name)
+        add_aliases(name, aliases)
+        install_model(self)
+        WRITES_OUT.add(name)
+        if self.uniform_x:
+            UNIFORM_X.add(name)
+        if self.broadcastable:
+            BROADCASTABLE.add(name)
+        if self.linear:
+            LINEAR_PARAMETERS[name] = list(self.linear)
+        if self.bounds:
+            PARAMETER_BOUNDS[name] = dict(self.bounds)
+
+
+def same_recipe(a, b):
+    """True if the recipes a and b (see SessionModel.recipe) are equal,
+    comparing arrays by their values."""
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return (len(a) == len(b) and
+                all(same_recipe(c, d) for c, d in zip(a, b)))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return (sorted(a) == sorted(b) and
+                all(same_recipe(a[key], b[key]) for key in a))
+    return a is b or a == b
+
+
+def rebuild_model(cls, recipe, aliases):
+    """Unpickle a SessionModel: the model of the same name if it was made
+    from the same recipe, or else a new one, registered under aliases
+    unless those are None or its name is taken, e.g. in a worker process."""
+    model = cls(*recipe)
+    name = model.__name__
+    existing = globals().get(name)
+    if (type(existing) is cls and
+            same_recipe(existing.recipe(), model.recipe())):
+        return existing
+    if aliases is not None:
+        discover()
+        if name not in MODELS:
+            model.register(aliases)
+    return model
+
+
+class ReconvolvedModel(SessionModel):
+    """A model convolved with an instrument response irf_y measured at
+    irf_x, e.g. for TCSPC decays. It takes the arguments of the base model,
+    plus shift, which moves the instrument response later along x. An offset
+    argument of the base model is added after convolving, as a background.
+
+    The x values of each dataset must be evenly spaced. The transform of the
+    instrument response on each x grid is worked out the first time the
+    model is called with that grid, and kept (see Reconvolution), so a fit
+    only does it once. It broadcasts if the base model does.
+    """
+
+    uniform_x = True
+
+    def __init__(self, base, irf_x, irf_y, name=None):
+        self._base = base
+        # (len(x), x[0], x[-1]) -> Reconvolution, oldest first
+        self._grids = {}
+        self._has_offset = 'offset' in signature(base).parameters
+        self._defaults = default_values(base)
+        self.broadcastable = broadcasts(base)
+        self.linear = list(linear_parameters(base))
+
+        arguments = [p for p in signature(base).parameters.values()
+                     if p.name != 'out']
+        arguments.append(inspect.Parameter(
+            'shift', inspect.Parameter.POSITIONAL_OR_KEYWORD, default=0.0))
+        arguments.append(inspect.Parameter(
+            'out', inspect.Parameter.POSITIONAL_OR_KEYWORD, default=None))
+        self.__signature__ = inspect.Signature(arguments)
+        self.__name__ = self.__qualname__ = (name or
+                                             "{0}_irf".format(base.__name__))
+        self.__doc__ = (
+            "\n    {0}:\n        {1} convolved with an instrument response, "
+            "moved later along x by shift.{2}".format(self.__name__,
+                                                      base.__name__,
+                                                      base.__doc__ or "\n"))
+        # what the model is besides its code, for the fit cache
+        self.base = base.__name__
+        self.irf = (np.asarray(irf_x, dtype=np.float64),
+                    np.asarray(irf_y, dtype=np.float64))
+
+    def recipe(self):
+        return self._base, self.irf[0], self.irf[1], self.__name__
+
+    def __call__(self, x, shift=0.0, out=None, **kwargs):
+        grids = self._grids
+        key = (len(x), x[0], x[-1])
+        grid = grids.pop(key, None)
+        if grid is None:
+            grid = Reconvolution(x, *self.irf)
+        grids[key] = grid  # most recently used last
+        while len(grids) > MAX_GRIDS:
+            del grids[next(iter(grids))]
+
+        offset = 0.0
+        if self._has_offset:
+            offset = kwargs.get('offset', self._defaults['offset'])
+            kwargs['offset'] = 0.0
+        for arg, value in self._defaults.items():
+            kwargs.setdefault(arg, value)
+        return grid.convolve(self._base, kwargs, shift, offset, out)
+
+
+def reconvolved_model(model, irf_x, irf_y, name=None):
+    """Return a model function computing model convolved with an instrument
+    response irf_y measured at irf_x (see ReconvolvedModel), called name, or
+    the name of model followed by _irf."""
+    return ReconvolvedModel(model, irf_x, irf_y, name)
+
+
+def add_reconvolved_model(model, irf_x, irf_y, name=None, aliases=()):
+    """Make a model of model convolved with the instrument response irf_y at
+    irf_x (see reconvolved_model) available by name for this session, to be
+    fit like any other. It can be evaluated for many datasets at once and
+    solved for linearly in the same arguments as model. Returns the new
+    model function.
+
+    Raises ValueError if name is already the name of a model that isn't a
+    reconvolved one.
+    """
+    if isinstance(model, str):
+        model = get_models(model)
+    func = reconvolved_model(model, irf_x, irf_y, name)
+    name = func.__name__
+    discover()
+    if name in MODELS and name not in UNIFORM_X:
+        raise ValueError("{0} is already a model".format(name))
+    func.register(aliases)
+    return func
+
+
+def add_mechanism_model(scheme, name, aliases=(), initial=None):
+    """Make a model of the signal of the kinetic mechanism scheme, e.g.
+    'A -> B -> C' or 'A <=> B -> C', available by name for this session, to
+    be fit like any other (see kinetics.mechanism_model). It can be
+    evaluated for many datasets at once, and solved for linearly in the
+    amplitudes of the species and the offset. A mechanism model with the
+    same name is replaced. Returns the new model function.
+
+    Raises ValueError if the scheme isn't valid, or name is already the
+    name of a model that isn't a mechanism.
+    """
+    from src import kinetics
+    discover()
+    if name in MODELS and name not in MECHANISM_MODELS:
+        raise ValueError("{0} is already a model".format(name))
+    if name not in MODELS and name in globals():
+        raise ValueError("{0} can't be the name of a model".format(name))
+    func = kinetics.mechanism_model(scheme, name, initial)
+    func.register(aliases)
+    return func
+
+
+# the built-in models are loaded, so their signatures are known already.
+SIGNATURES.update((name, inspect.signature(globals()[name]))
+                  for name in MODELS)
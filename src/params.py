@@ -3,6 +3,7 @@ their parameters that will be used to fit whatever data they wish to the
 model specified."""
 
 
+from src import models
 from src.utils import eval_string, name_scheme_match
 
 import inspect
@@ -276,14 +277,31 @@ class ChangeDialog(QMainWindow):
 
 
 def create_default_params(model):
-    """Create a set of parameters for the given model."""
+    """Create a set of parameters for the given model, bounded as listed in
+    models.PARAMETER_BOUNDS."""
 
     m = Model(model)  # leverage lmfit's builtin Model class
     pars = m.make_params()
+    for name, (lower, upper) in models.parameter_bounds(model).items():
+        pars[name].set(min=lower, max=upper)
 
     return pars
 
 
+def default_parameters(num_bufs, model):
+    """Create parameters for fitting num_bufs buffers to the model, as the
+    parameters window would with none of its values changed: the defaults
+    of the model for each buffer, named name_i for buffer i, with nothing
+    shared between buffers."""
+    defaults = create_default_params(model)
+    parameters = Parameters()
+    for buf in range(num_bufs):
+        for name, par in defaults.items():
+            parameters.add("{0}_{1}".format(name, buf), value=par.value,
+                           vary=par.vary, min=par.min, max=par.max)
+    return parameters
+
+
 def create_params_without_window(num_bufs, model):
     app = QApplication(sys.argv)
     ex = App(num_bufs, model)
@@ -48,6 +48,34 @@ def plot_xy(x, y, x_label='x', y_label='y'):
     return fig
 
 
+def plot_contour(x, y, z, x_label='x', y_label='y', levels=12):
+    """Plot a filled contour map of z over the grid of x and y values, with
+    the contour lines drawn over it.
+    Parameters
+    ----------
+        x: np.ndarray (1D)
+            x values of the columns of z
+        y: np.ndarray (1D)
+            y values of the rows of z
+        z: np.ndarray (2D)
+            values to be plot, z[i, j] at x[j] and y[i]
+        x_label: string
+            label for x axis
+        y_label: string
+            label for y axis
+        levels: int
+            how many contour levels to draw
+            """
+    fig = plt.figure(get_fig_number())
+    filled = plt.contourf(x, y, z, levels=levels)
+    plt.contour(x, y, z, levels=filled.levels, colors='k', linewidths=0.5)
+    plt.colorbar(filled)
+    plt.xlabel(x_label)
+    plt.ylabel(y_label)
+
+    return fig
+
+
 
 def plot_buffer(buf):
     """Plots the x and y data of the buffer in the subplot of given idx.
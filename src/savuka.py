@@ -4,11 +4,23 @@ user, and methods to analyze that data."""
 
 from src import parse_funcs
 from src import plot_funcs
+from src import batch
 from src import fit
+from src import models
 from src import params
 import numpy as np
 
 import matplotlib.pyplot as plt
+
+
+def ignore_option(name, value, applies):
+    """Tell the user an option given to a fit is ignored, if it was given
+    and isn't False, since it only applies to the kinds of fit described by
+    applies."""
+    if value is not None and value is not False:
+        print("-{0} only applies to {1}; ignoring it.".format(name, applies))
+
+
 def update_buffer(f):
     """Mutates the data in self.data according to buffer index/name and
     axis returned by the decorated function. The first argument after self
@@ -78,6 +90,10 @@ class Savuka:
         # in order: results, data, x arrays, models
         self.fit_results = ([], [], [], [])
 
+        # incremental fits of buffers still being acquired, by buffer index.
+        # See append_points.
+        self.incremental_fits = {}
+
     def read(self, filepath, formstyle):
         """Parses the given file of the given format and adds its data to
         self.data while recording the metadata in self.attributes"""
@@ -241,18 +257,49 @@ class Savuka:
     def fit(self, idx, model, **kwargs):
         """Fit the data from the buffer at idx to the model specified by the
         model argument."""
-        # TODO make x a 2D array or dictionary for each data set.
+        # 'global' (the default) or 'independent'. Not an option of the fit.
+        fit_type = kwargs.pop('type', 'global')
+        # options of how the fit is run, not of the fit itself: they're taken
+        # out here, so one that doesn't apply never reaches the minimizer
+        workers = kwargs.pop('workers', None)
+        batched = kwargs.pop('batch', False)
+        incremental = kwargs.pop('incremental', None)
         if isinstance(idx, int):
+            ignore_option('batch', batched, "independent fits of buffers")
+            if incremental is not None:
+                ignore_option('workers', workers,
+                              "independent fits and multistart")
+                self.fit_incremental(idx, model, incremental=incremental,
+                                     **kwargs)
+                return
             # wrap the y in another array, to replicate shape of multi-dataset array
+            if kwargs.get('multistart') is not None:
+                self.fit_multistart(np.asarray([self.get_ys(idx)]),
+                                    self.get_xs(idx), model, workers=workers,
+                                    **kwargs)
+                return
+            ignore_option('workers', workers, "independent fits and multistart")
             result, data, x, model = fit.fit(np.asarray([self.get_ys(idx)]),
                                              self.get_xs(idx),
                                              model, **kwargs)
             self.append_results(result, data, x, model)
             self.fit_result()
-            self.fit_plot()
+            self.plot_nth_fit()
         elif isinstance(idx, tuple):
+            if incremental is not None:
+                print("-incremental only applies to a single buffer. Fit "
+                      "each buffer on its own to replay it.")
+                return
             # a series of non-global fits
-            if 'type' in kwargs and kwargs['type'] == 'independent':
+            if fit_type == 'independent':
+                if batched:
+                    ignore_option('workers', workers, "unbatched fits")
+                    self.fit_batch(idx, model, **kwargs)
+                    return
+                if workers is not None:
+                    self.fit_independent(idx, model, workers=workers,
+                                         **kwargs)
+                    return
                 # keep track of how many new fits, for plotting.
                 for i in idx:
                     x = self.get_xs(i)
@@ -260,25 +307,15 @@ class Savuka:
                     result, data, x, model = fit.fit(y, x, model, **kwargs)
                     self.append_results(result, data, x, model)
                     self.fit_result()
-                    self.fit_plot()
+                    self.plot_nth_fit()
                 return
 
-            x1 = self.get_xs(idx[0])  # only use 1 set of x values
-            data = []
-            for i in idx:
-                xs = self.get_xs(i)
-                ys = self.get_ys(i)
-                if len(xs) != len(x1):
-                    ok = input("Interpolating y values. X arrays do not match."
-                               "Continue? [y/n]: ")
-                    if ok not in {'y', 'Y', 'yes', 'Yes', 'YES'}:
-                        return
-                    # linear interpolation of data sampled at proper x values.
-                    ys = np.interp(x1, xs, ys)
-                data.append(ys)
-
-            data = np.asarray(data)
-
+            ignore_option('batch', batched, "independent fits of buffers")
+            data, x1 = self.fit_data(idx)
+            if kwargs.get('multistart') is not None:
+                self.fit_multistart(data, x1, model, workers=workers, **kwargs)
+                return
+            ignore_option('workers', workers, "independent fits and multistart")
             result, data, x, model = fit.fit(data, x1, model, **kwargs)
 
             # save it all for further analysis
@@ -286,6 +323,208 @@ class Savuka:
             self.fit_result()
             self.plot_nth_fit()
 
+    def fit_resume(self, key=None, **kwargs):
+        """Continue a fit from its last checkpoint (see fit.resume_fit), and
+        report and plot its result like any other fit."""
+        try:
+            result, data, x, model = fit.resume_fit(key, **kwargs)
+        except ValueError as e:
+            print(e)
+            return
+        self.append_results(result, data, x, model)
+        self.fit_result()
+        self.plot_nth_fit()
+
+    def add_irf_model(self, idx, model, name=None, aliases=()):
+        """Add a model of model convolved with the instrument response in
+        the buffer at idx, for this session (see
+        models.add_reconvolved_model). Returns the new model function."""
+        return models.add_reconvolved_model(model, self.get_xs(idx),
+                                            self.get_ys(idx), name, aliases)
+
+    def fit_data(self, idx):
+        """Return the data and x values of a fit of the buffer(s) at idx, as
+        passed to fit.fit."""
+        if isinstance(idx, int):
+            # wrap the y in another array, to replicate shape of multi-dataset array
+            return np.asarray([self.get_ys(idx)]), self.get_xs(idx)
+
+        xs = [self.get_xs(i) for i in idx]
+        ys = [self.get_ys(i) for i in idx]
+        if all(np.array_equal(x, xs[0]) for x in xs):
+            # every buffer shares one set of x values
+            return np.asarray(ys), xs[0]
+        # fit each buffer at its own x values, without interpolating
+        data = fit.RaggedData(ys, xs)
+        return data, data.x
+
+    def compare_models(self, idx, candidates, parameters=None,
+                       criterion='aic', workers=None, **kwargs):
+        """Fit the buffer(s) at idx to each of the candidate models in
+        parallel, and rank the fits by criterion (see fit.compare_models).
+        The ranking is printed again as each fit finishes. Every fit is
+        added to self.fit_results, worst first, so the best is the most
+        recent result, which is then reported and plotted."""
+        data, x = self.fit_data(idx)
+
+        def show(ranking):
+            print("\n{0} of {1} fits done, ranked by {2}:".format(
+                len(ranking), len(candidates), criterion))
+            for line in fit.ranking_table(ranking, criterion):
+                print(line)
+
+        fits = fit.compare_models(data, x, candidates, parameters=parameters,
+                                  workers=workers, criterion=criterion,
+                                  on_result=show, **kwargs)
+        for result, data, x, model in reversed(fits):
+            self.append_results(result, data, x, model)
+
+        if getattr(fits[0][0], 'aborted', False):
+            print("Every fit failed.")
+            return
+        print("\nbest: {0}".format(fits[0][3].__name__))
+        self.fit_result()
+        self.plot_nth_fit()
+
+    def fit_independent(self, idx, model, parameters, workers=None, **kwargs):
+        """Fit each buffer in idx on its own, in parallel worker processes.
+        Results are added to self.fit_results in the order of idx, and are
+        only reported and plotted once every fit has finished. A buffer
+        whose fit fails is reported, but doesn't stop the others."""
+        problems = [(np.asarray([self.get_ys(i)]), self.get_xs(i))
+                    for i in idx]
+
+        fits = fit.fit_many(problems, model, parameters, workers=workers,
+                            **kwargs)
+
+        for result, data, x, model in fits:
+            self.append_results(result, data, x, model)
+
+        for n, i in zip(range(-len(fits), 0), idx):
+            result = self.get_nth_result(n)[0]
+            print("\nbuffer {0}:".format(i))
+            if getattr(result, 'aborted', False):
+                print("The fit failed:\n{0}".format(result.message))
+                continue
+            self.fit_result(n)
+            self.plot_nth_fit(n)
+
+    def fit_batch(self, idx, model, parameters, max_nfev=None,
+                  ftol=1.5e-8, xtol=1.5e-8, **kwargs):
+        """Fit each buffer in idx on its own, all at once with the batched
+        Levenberg-Marquardt solver (see batch.batch_fit). Falls back to
+        fitting them one after another if the model can't be fit in a batch,
+        or options the batch solver doesn't have are given."""
+        if kwargs or not batch.batchable(model, parameters):
+            print("These fits can't be run in a batch. Only models that "
+                  "broadcast, with no linked parameters and no other "
+                  "options, can be. Fitting one buffer at a time instead.")
+            if max_nfev is not None:
+                kwargs['max_nfev'] = max_nfev
+            self.fit(idx, model, parameters=parameters, type='independent',
+                     **kwargs)
+            return
+
+        problems = [(np.asarray([self.get_ys(i)]), self.get_xs(i))
+                    for i in idx]
+        fits = batch.batch_fit(problems, model, parameters,
+                               max_nfev=max_nfev, ftol=ftol, xtol=xtol)
+
+        for result, data, x, model in fits:
+            self.append_results(result, data, x, model)
+
+        for n, i in zip(range(-len(fits), 0), idx):
+            print("\nbuffer {0}:".format(i))
+            result = self.get_nth_result(n)[0]
+            if not result.success:
+                print(result.message)
+            self.fit_result(n)
+            self.plot_nth_fit(n)
+
+    def start_incremental_fit(self, idx, model, parameters, max_nfev=None,
+                              **kwargs):
+        """Fit the buffer at idx, and refit it every time points are
+        appended to it with append_points (see fit.IncrementalFit). Returns
+        the IncrementalFit."""
+        incremental = fit.IncrementalFit(model, parameters, max_nfev=max_nfev,
+                                         **kwargs)
+        self.incremental_fits[idx] = incremental
+        if len(self.get_xs(idx)):
+            incremental.append(self.get_xs(idx), self.get_ys(idx))
+            incremental.refit()
+        return incremental
+
+    def append_points(self, idx, xs, ys):
+        """Append points to the buffer at idx, e.g. as they are acquired. If
+        the buffer has an incremental fit, it is refit from where it was,
+        and its newest result is returned."""
+        buffer = self.data[idx]
+        buffer.update_x(np.append(buffer.get_xs(), xs))
+        buffer.update_y(np.append(self.get_ys(idx), ys))
+
+        incremental = self.incremental_fits.get(idx)
+        if incremental is not None:
+            incremental.append(xs, ys)
+            return incremental.refit()
+
+    def fit_incremental(self, idx, model, parameters, incremental,
+                        max_nfev=None, **kwargs):
+        """Replay the buffer at idx as if it were being acquired, incremental
+        points at a time, refitting it as each lot arrives. The estimates of
+        the parameters after each refit are printed, and the final fit is
+        added to self.fit_results."""
+        xs, ys = self.get_xs(idx), self.get_ys(idx)
+        chunk = int(incremental)
+        replay = fit.IncrementalFit(model, parameters, max_nfev=max_nfev,
+                                    **kwargs)
+        for start in range(0, len(xs), chunk):
+            replay.append(xs[start:start + chunk], ys[start:start + chunk])
+            replay.refit()
+
+        names = [name for name, par in replay.result.params.items()
+                 if par.vary]
+        print("\n{0:>8}{1:>6}".format("points", "nfev") +
+              "".join("{0:>16}".format(name) for name in names))
+        for step in replay.history:
+            print("{0:>8}{1:>6}".format(step['npoints'], step['nfev']) +
+                  "".join("{0:>16.6g}".format(step['values'][name])
+                          for name in names))
+
+        self.append_results(replay.result, replay.data.copy(),
+                            replay.x.copy(), replay.model)
+        self.fit_result()
+        self.plot_nth_fit()
+
+    def fit_multistart(self, data, x, model, parameters, multistart,
+                       sampler='sobol', seed=0, keep=5, workers=None,
+                       **kwargs):
+        """Fit data from multistart starting points spread over the parameter
+        bounds, in parallel worker processes (see fit.multistart). The best
+        distinct minima are added to self.fit_results worst first, so the
+        best fit is the most recent result. A ranking of them is printed,
+        then the best is reported and plotted."""
+        fits = fit.multistart(data, x, model, parameters,
+                              nstarts=int(multistart), sampler=sampler,
+                              seed=int(seed), keep=int(keep),
+                              workers=workers, **kwargs)
+        if not fits:
+            print("Every fit failed.")
+            return
+
+        for result, data, x, model in reversed(fits):
+            self.append_results(result, data, x, model)
+
+        print("\n{0} distinct minima from {1} starts:".format(len(fits),
+                                                            multistart))
+        print("{0:>6}{1:>16}{2:>16}{3:>8}".format("rank", "chi-square",
+                                                  "reduced", "nfev"))
+        for rank, (result, _, _, _) in enumerate(fits, 1):
+            print("{0:>6}{1:>16.6g}{2:>16.6g}{3:>8}".format(
+                rank, result.chisqr, result.redchi, result.nfev))
+
+        self.fit_result()
+        self.plot_nth_fit()
+
     def append_results(self, result, data, x, model):
         """Add the new results to self.fit_results."""
         self.fit_results[0].append(result)
@@ -315,21 +554,53 @@ class Savuka:
         result, data, x, model = self.get_nth_result(n)
 
         if result:
+            # reuse the parameter layout from the fit if there is one.
+            layout = getattr(result, 'layout', None)
+            if layout is None:
+                layout = fit.ParameterLayout(result.params, len(data))
+
             for i, y in enumerate(data):
-                plot_funcs.plot_with_residuals(x, y,
+                xi = fit.dataset_x(data, x, i)
+                plot_funcs.plot_with_residuals(xi, y,
                     # recalc model ys
-                    fit.generate_dataset(result.params, i, x, model),
+                    fit.generate_dataset(result.params, i, xi, model, layout),
                     # calc residuals (result.resid doesn't work)
-                    fit.calc_resids(result.params, data, i, x, model))
+                    fit.calc_resids(result.params, data, i, x, model, layout))
 
 
     def fit_result(self, n=-1):
         """Print out the results from the last fit. Defaults to last one."""
         result, data, x, model = self.get_nth_result(n)
         if result:  # Doesn't do anything if empty list.
+            if getattr(result, 'cached', False):
+                print("Loaded from the fit cache.")
+            if getattr(result, 'stopped', None):
+                print(result.message)
+                if getattr(result, 'checkpoint', None):
+                    print("Continue it with: fit_resume {0}".format(
+                        result.checkpoint[:16]))
             # report the very newest fit result.
             fit.report_result(result)
 
+    def fit_stats(self, n=-1):
+        """Print the performance counters of the nth fit (see fit.FitStats).
+        Defaults to the last one."""
+        result, data, x, model = self.get_nth_result(n)
+        if result is None:
+            print("You must fit some data first to see its stats")
+            return
+
+        stats = getattr(result, 'stats', None)
+        if stats is None:
+            print("There are no stats for this fit.")
+            return
+        if getattr(result, 'cached', False):
+            print("Loaded from the fit cache. These are the stats of the "
+                  "fit that was stored.")
+        print("[[Fit stats]]")
+        for line in stats.report():
+            print("    " + line)
+
     def plot_x2(self, param_name, **kwargs):
         if self.fit_results is None:
             print("You must fit some data first to analyze Chi^2")
@@ -338,8 +609,106 @@ class Savuka:
         result, data, x, model = self.get_nth_result()
 
         # generate the graph for the globally-fit data
-        param_space, chis = fit.generate_error_landscape(result, data, x,
-            model, param_name, **kwargs)
+        param_space, chis, nfevs, seconds = fit.generate_error_landscape(
+            result, data, x, model, param_name, **kwargs)
+
+        print("{0} fits, {1} function evaluations, {2:.2f} seconds of "
+              "fitting".format(len(chis), nfevs.sum(), seconds.sum()))
 
         plot_funcs.plot_xy(param_space, chis)
 
+    def chi_surface(self, param1, param2, **kwargs):
+        """Compute and plot the X^2 surface of the last fit over param1 and
+        param2, see fit.generate_chi_surface."""
+        if self.fit_results is None:
+            print("You must fit some data first to analyze Chi^2")
+            return
+
+        result, data, x, model = self.get_nth_result()
+        axis, chis, nfevs, seconds, directory = fit.generate_chi_surface(
+            result, data, x, model, param1, param2, **kwargs)
+
+        print("{0} new fits, {1} function evaluations, {2:.2f} seconds of "
+              "fitting".format(np.count_nonzero(nfevs), nfevs.sum(),
+                               seconds.sum()))
+        if directory is not None:
+            print("Cells saved in {0}".format(directory))
+
+        # chis[i, j] has param1 at axis[i]; contours want it along columns.
+        plot_funcs.plot_contour(axis, axis, chis.T, param1, param2)
+
+    def confidence_interval(self, param_name, **kwargs):
+        """Find, print and plot the confidence interval of param_name in the
+        last fit, from its X^2 profile. Profiles are kept with the result,
+        by the parameter and the options of their fits, so asking again
+        with the same options (e.g. at another confidence level) reuses the
+        fits that were already run."""
+        result, data, x, model = self.get_nth_result()
+        if result is None:
+            print("You must fit some data first to find confidence intervals")
+            return
+
+        if not hasattr(result, 'profiles'):
+            result.profiles = {}
+        # options that change the X^2 of the fits of the profile, i.e. all
+        # but those of finding the interval from it.
+        key = (param_name, tuple(sorted(
+            (option, repr(value)) for option, value in kwargs.items()
+            if option not in ('prob', 'xtol', 'workers'))))
+        known = result.profiles.get(key)
+        if known is not None:
+            known = list(zip(*known))
+
+        (lower, upper), profile, nfits = fit.confidence_interval(
+            result, data, x, model, param_name, known=known, **kwargs)
+        result.profiles[key] = profile
+
+        print("{0} new fits".format(nfits))
+        for i in range(len(data)):
+            name = "{0}_{1}".format(param_name, i)
+            value = result.params[name].value
+            scale = value if value != 0 else 1.0
+            ends = [value + d * scale if d is not None else None
+                    for d in (lower, upper)]
+            if None not in ends:
+                ends.sort()
+            print("{0}: {1} [{2}, {3}]".format(name, value, *ends))
+
+        plot_funcs.plot_xy(*profile)
+
+    def bootstrap(self, nreplicates=1000, prob=0.6827, min_correl=0.3,
+                  **kwargs):
+        """Refit nreplicates synthetic datasets made from the last fit, and
+        print a percentile interval for each free parameter, the
+        correlations between them, and how many replicates were fit per
+        second. The samples are kept with the result as result.bootstrap."""
+        result, data, x, model = self.get_nth_result()
+        if result is None:
+            print("You must fit some data first to bootstrap it")
+            return
+
+        names, samples, seconds = fit.bootstrap(result, data, x, model,
+                                                nreplicates=int(nreplicates),
+                                                **kwargs)
+        result.bootstrap = (names, samples)
+
+        print("{0} of {1} replicates fit in {2:.2f} s ({3:.1f} per second)"
+              "".format(len(samples), nreplicates, seconds,
+                        nreplicates / seconds))
+        if len(samples) < 2:
+            return
+
+        lower, upper = fit.percentile_intervals(samples, prob)
+        print("[[{0:g}% intervals]]".format(100 * prob))
+        for name, low, high in zip(names, lower, upper):
+            print("    {0}: {1} [{2}, {3}]".format(
+                name, result.params[name].value, low, high))
+
+        correl = np.corrcoef(samples, rowvar=False)
+        pairs = [(abs(correl[i, j]), names[i], names[j], correl[i, j])
+                 for i in range(len(names)) for j in range(i + 1, len(names))
+                 if abs(correl[i, j]) > min_correl]
+        print("[[Correlations]] (unreported correlations are < {0})"
+              "".format(min_correl))
+        for _, first, second, r in sorted(pairs, reverse=True):
+            print("    C({0}, {1}) = {2:.3f}".format(first, second, r))
@@ -18,6 +18,9 @@ from src import plot_funcs
 from src import utils
 from src import buffer
 from src import params
+from src import fit
+from src import models
+from src import cache
 
 
 class TestPysavuka(unittest.TestCase):
@@ -183,6 +186,12 @@ class TestPysavuka(unittest.TestCase):
         self.assertEqual(current_args, ['arg1', 'arg2'])
         self.assertEqual(current_kwargs, {'option': [0, 1.0], 'option2': []})
 
+    def test_unpack_options(self):
+        args, kwargs = utils.parse_options('0 gauss -method nelder -debug '
+                                           '-range 0 1')
+        self.assertEqual(utils.unpack_options(kwargs),
+                         {'method': 'nelder', 'debug': True, 'range': [0, 1]})
+
     def test_deep_copy(self):
         from lmfit import Parameter, Parameters
 
@@ -211,6 +220,994 @@ class TestPysavuka(unittest.TestCase):
 
         test_params_equal(p, p3)
 
+    def test_parameter_layout(self):
+        from lmfit import Parameters
+        import numpy as np
+
+        p = Parameters()
+        for i in range(12):
+            p.add('amp_{0}'.format(i), 1.0 + i)
+            p.add('cen_{0}'.format(i), 0.5)
+            p.add('wid_{0}'.format(i), 2.0)
+
+        layout = fit.ParameterLayout(p, 12)
+        values = layout.values(p)
+
+        # amp_1 must not be confused with amp_10 or amp_11
+        self.assertEqual(layout.arguments(values, 1),
+                         {'amp': 2.0, 'cen': 0.5, 'wid': 2.0})
+        self.assertEqual(layout.arguments(values, 10)['amp'], 11.0)
+
+        x = np.linspace(-5, 5, 11)
+        self.assertTrue(np.allclose(
+            fit.generate_dataset(p, 3, x, models.gaussian_1d, layout),
+            models.gaussian_1d(x, amp=4.0, cen=0.5, wid=2.0)))
+
+    def test_broadcast_objective(self):
+        from src import benchmarks
+        import numpy as np
+
+        # broadcasting the model over all datasets must match the loop.
+        for model in models.get_models():
+            data, x, p = benchmarks.make_global_problem(4, model, npoints=20)
+            loop = fit.ParameterLayout(p, 4, broadcast=False)
+            bcast = fit.ParameterLayout(p, 4, broadcast=True)
+            self.assertTrue(bcast.broadcast)
+            self.assertTrue(np.allclose(fit.objective(p, x, data, model, loop),
+                                        fit.objective(p, x, data, model, bcast)))
+
+    def test_work_buffers(self):
+        from src import benchmarks
+        import numpy as np
+
+        for model in models.get_models():
+            data, x, p = benchmarks.make_global_problem(3, model, npoints=20)
+            defaults = models.default_values(model)
+            self.assertNotIn('out', defaults)
+            out = np.empty_like(x)
+            self.assertTrue(np.allclose(model(x, out=out, **defaults),
+                                        model(x, **defaults)))
+
+            for broadcast in (False, True):
+                layout = fit.ParameterLayout(p, 3, broadcast=broadcast)
+                work = fit.WorkBuffers(data, model)
+                first = fit.objective(p, x, data, model, layout, work)
+                self.assertTrue(np.allclose(
+                    first, benchmarks.allocating_objective(p, x, data, model,
+                                                           layout)))
+                # minimizers keep the residuals of earlier calls, so each
+                # call returns a new array.
+                model_out = work.model
+                again = fit.objective(p, x, data, model, layout, work)
+                self.assertFalse(np.shares_memory(first, again))
+                self.assertIs(work.model, model_out)
+
+    def test_ragged_data(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(3, model, npoints=40)
+
+        # the same datasets as RaggedData fit the same as the 2D array
+        same = fit.RaggedData(list(data), [x] * 3)
+        full = fit.fit(data, x, model, p)[0]
+        ragged = fit.fit(same, same.x, model, p)[0]
+        self.assertAlmostEqual(ragged.chisqr / full.chisqr, 1.0, places=6)
+
+        # datasets of different lengths, each at its own x values
+        keep = [slice(None), slice(0, 25), slice(None, None, 3)]
+        rag = fit.RaggedData([y[k] for y, k in zip(data, keep)],
+                             [x[k] for k in keep])
+        self.assertEqual(list(rag.counts), [40, 25, 14])
+        self.assertTrue(np.array_equal(rag[1], data[1, :25]))
+        self.assertTrue(np.array_equal(rag.xs(2), x[::3]))
+
+        loop = fit.ParameterLayout(p, 3, broadcast=False)
+        bcast = fit.ParameterLayout(p, 3, broadcast=True)
+        resid = fit.objective(p, rag.x, rag, model, loop)
+        self.assertEqual(resid.shape, (79,))
+        self.assertTrue(np.allclose(
+            resid, fit.objective(p, rag.x, rag, model, bcast)))
+        self.assertTrue(np.allclose(resid[40:65],
+                                    fit.calc_resids(p, rag, 1, rag.x, model)))
+
+        dense = fit.fit(rag, rag.x, model, p, method='least_squares',
+                        sparse=False)[0]
+        sparse = fit.fit(rag, rag.x, model, p, method='least_squares')[0]
+        self.assertAlmostEqual(sparse.chisqr / dense.chisqr, 1.0, places=3)
+
+        replicates = fit.bootstrap_replicates(sparse, rag, 4, seed=3)
+        self.assertEqual(replicates.shape, (4, 79))
+
+    def test_model_memo(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(4, model, npoints=30)
+        rag = fit.RaggedData(list(data), [x] * 4)
+        for d, dx in ((data, x), (rag, rag.x)):
+            for broadcast in (False, True):
+                layout = fit.ParameterLayout(p, 4, broadcast=broadcast)
+                work = fit.WorkBuffers(d, model)
+                work.memo = fit.ModelMemo(layout, d, work)
+                q = params.deep_copy(p)
+                fit.objective(q, dx, d, model, layout, work)
+                self.assertEqual(work.memo.misses, 4)
+
+                # stepping a parameter of one buffer only evaluates it,
+                # and stepping back evaluates none.
+                cen = q['cen_2'].value
+                q['cen_2'].value = cen + 1e-3
+                stepped = fit.objective(q, dx, d, model, layout, work)
+                self.assertEqual(work.memo.misses, 5)
+                self.assertTrue(np.array_equal(
+                    stepped, fit.objective(q, dx, d, model, layout)))
+                q['cen_2'].value = cen
+                base = fit.objective(q, dx, d, model, layout, work)
+                self.assertEqual(work.memo.misses, 5)
+                self.assertTrue(np.array_equal(
+                    base, fit.objective(q, dx, d, model, layout)))
+
+        plain = fit.fit(data, x, model, p, memoize=False)[0]
+        memo = fit.fit(data, x, model, p)[0]
+        self.assertEqual(memo.chisqr, plain.chisqr)
+        self.assertIsNone(plain.stats.memo_hit_rate)
+        self.assertGreater(memo.stats.memo_hit_rate, 0.5)
+        self.assertLess(memo.stats.memo_misses, plain.stats.ncalls * 4)
+
+    def test_jacobian_sparsity(self):
+        from src import benchmarks
+        import numpy as np
+
+        # 'amp' is linked across the three buffers, the rest are local.
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(3, model, npoints=30)
+        layout = fit.ParameterLayout(p, 3)
+        pattern = fit.jacobian_sparsity(p, layout, 30).toarray()
+
+        var_names = [n for n, par in p.items() if par.vary and not par.expr]
+        self.assertEqual(pattern.shape, (90, len(var_names)))
+        self.assertTrue(pattern[:, var_names.index('amp_0')].all())
+        cen_1 = pattern[:, var_names.index('cen_1')]
+        self.assertTrue(cen_1[30:60].all())
+        self.assertFalse(cen_1[:30].any() or cen_1[60:].any())
+
+        # the sparse fit must agree with lmfit's dense one
+        dense = fit.fit(data, x, model, p, method='least_squares',
+                        sparse=False)[0]
+        sparse = fit.fit(data, x, model, p, method='least_squares')[0]
+        self.assertAlmostEqual(sparse.chisqr / dense.chisqr, 1.0, places=3)
+        self.assertAlmostEqual(sparse.params['amp_0'].value,
+                               dense.params['amp_0'].value, places=3)
+
+        # uncertainties are propagated through exprs that aren't aliases
+        p['wid_2'].expr = '2*wid_1'
+        dense = fit.fit(data, x, model, p, method='least_squares',
+                        sparse=False)[0]
+        sparse = fit.fit(data, x, model, p, method='least_squares')[0]
+        for name in ('wid_1', 'wid_2', 'amp_2'):
+            self.assertIsNotNone(sparse.params[name].stderr)
+            self.assertAlmostEqual(sparse.params[name].stderr /
+                                   dense.params[name].stderr, 1.0, places=2)
+
+    def test_variable_projection(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.two_state_equilibrium_chemical_denaturation
+        data, x, p = benchmarks.make_global_problem(3, model, npoints=40)
+        p['temperature_0'].vary = False
+
+        layout = fit.ParameterLayout(p, 3, broadcast=True)
+        self.assertEqual(sorted(fit.projected_arguments(p, layout, model)),
+                         sorted(models.linear_parameters(model)))
+
+        full = fit.fit(data, x, model, p)[0]
+        varpro = fit.fit(data, x, model, p, varpro=True)[0]
+        self.assertLess(varpro.nfev, full.nfev)
+        self.assertEqual(varpro.nvarys, full.nvarys)
+        # solving exactly for the baselines can only do better
+        self.assertLessEqual(varpro.chisqr, full.chisqr * (1 + 1e-6))
+
+    def test_fit_many(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, _ = benchmarks.make_global_problem(3, model, npoints=30)
+        p = benchmarks.make_global_problem(1, model, npoints=30)[2]
+        bad = np.full((1, 30), np.nan)
+        problems = [(data[[0]], x), (bad, x), (data[[2]], x)]
+
+        fits = fit.fit_many(problems, model, p, workers=2)
+        self.assertEqual(len(fits), 3)
+        self.assertTrue(fits[0][0].success)
+        self.assertTrue(fits[1][0].aborted)
+        self.assertTrue(fits[2][0].success)
+        self.assertTrue(np.array_equal(fits[2][1], data[[2]]))
+
+    def test_multistart(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(1, model, npoints=30)
+        # start far from the peak, where the local fit gets stuck
+        p['cen_0'].set(value=7.0, min=0.0, max=8.0)
+        p['wid_0'].set(value=0.1, min=0.05, max=3.0)
+        local = fit.fit(data, x, model, p)[0]
+
+        starts = fit.starting_points(p, 8, seed=1)
+        again = fit.starting_points(p, 8, seed=1)
+        self.assertEqual(len(starts), 8)
+        self.assertEqual(starts[0]['cen_0'].value, 7.0)
+        self.assertEqual([s['cen_0'].value for s in starts],
+                         [s['cen_0'].value for s in again])
+        self.assertTrue(all(0.0 <= s['cen_0'].value <= 8.0 for s in starts))
+
+        fits = fit.multistart(data, x, model, p, nstarts=8, seed=1,
+                              workers=2)
+        chis = [result.chisqr for result, _, _, _ in fits]
+        self.assertEqual(chis, sorted(chis))
+        self.assertLess(chis[0], local.chisqr)
+        self.assertAlmostEqual(fits[0][0].params['cen_0'].value, 1.0,
+                               places=1)
+
+    def test_error_landscape(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(2, model, npoints=30)
+        result = fit.fit(data, x, model, p)[0]
+
+        serial = fit.generate_error_landscape(result, data, x, model, 'cen',
+                                              nsamples=7, workers=1)
+        pooled = fit.generate_error_landscape(result, data, x, model, 'cen',
+                                              nsamples=7, workers=2)
+        axis, chis, nfevs, seconds = serial
+        self.assertEqual(len(chis), 7)
+        self.assertEqual(len(nfevs), 7)
+        # the middle sample is the best fit
+        self.assertEqual(int(np.argmin(chis)), 3)
+        self.assertTrue(np.allclose(chis, pooled[1], rtol=1e-4))
+
+        # however many workers, most fits start from their neighbour's
+        nsamples = 15
+        pooled = fit.generate_error_landscape(result, data, x, model, 'cen',
+                                              nsamples=nsamples, workers=16)
+        cold = 0
+        for a, values in enumerate(np.linspace(
+                [result.params['cen_{0}'.format(i)].value * 0.8
+                 for i in range(2)],
+                [result.params['cen_{0}'.format(i)].value * 1.2
+                 for i in range(2)], nsamples)):
+            cold += fit.error_landscape_chain(data, x, model, result.params,
+                                              'cen', [(a, values)])[0][2]
+        self.assertLess(pooled[2].sum(), cold)
+
+    def test_chi_surface(self):
+        from src import benchmarks
+        import numpy as np
+        import os
+        import tempfile
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(2, model, npoints=30)
+        result = fit.fit(data, x, model, p)[0]
+        directory = tempfile.mkdtemp()
+
+        axis, chis, nfevs, seconds, run = fit.generate_chi_surface(
+            result, data, x, model, 'cen', 'wid', nsamples=5, workers=2,
+            directory=directory, keep=True)
+        self.assertEqual(chis.shape, (5, 5))
+        self.assertTrue(np.all(nfevs > 0))
+        # the middle cell is the best fit
+        self.assertEqual(np.unravel_index(np.argmin(chis), chis.shape),
+                         (2, 2))
+        self.assertEqual(len(os.listdir(run)), 25)
+
+        # an interrupted run only fits the cells that are missing
+        os.remove(fit.surface_cell_path(run, (0, 4)))
+        again = fit.generate_chi_surface(result, data, x, model, 'cen',
+                                         'wid', nsamples=5, workers=1,
+                                         directory=directory)
+        self.assertEqual(np.count_nonzero(again[2]), 1)
+        self.assertGreater(again[2][0, 4], 0)
+        self.assertTrue(np.allclose(again[1], chis, rtol=1e-4))
+        # finished, so its cells are deleted
+        self.assertIsNone(again[4])
+        self.assertFalse(os.path.exists(run))
+
+        # those of unfinished surfaces are deleted by clear_chi_surfaces
+        os.makedirs(run)
+        fit.save_surface_cell(run, (0, 0), {'redchi': 1.0})
+        self.assertEqual(fit.clear_chi_surfaces(directory), 1)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_confidence_interval(self):
+        from src import benchmarks
+        import numpy as np
+
+        # X^2 of a linear model is exactly quadratic in its parameters, so
+        # the one sigma interval must match the standard error.
+        model = models.linear
+        data, x, p = benchmarks.make_global_problem(1, model, npoints=50)
+        result = fit.fit(data, x, model, p)[0]
+        slope = result.params['slope_0']
+
+        (lower, upper), profile, nfits = fit.confidence_interval(
+            result, data, x, model, 'slope', workers=1)
+        self.assertAlmostEqual(-lower * slope.value / slope.stderr, 1.0,
+                               places=1)
+        self.assertAlmostEqual(upper * slope.value / slope.stderr, 1.0,
+                               places=1)
+        self.assertLess(nfits, 15)
+        self.assertEqual(len(profile[0]), nfits + 1)
+
+        # known points are not fit again
+        known = list(zip(*profile))
+        again = fit.confidence_interval(result, data, x, model, 'slope',
+                                        known=known, workers=1)
+        self.assertLessEqual(again[2], 2)
+
+        # the session keeps profiles by the options of their fits, and only
+        # reuses those fit the same way
+        s = savuka.Savuka()
+        s.data.append(buffer.Buffer({'dim0': buffer.Dimension(x),
+                                     'dim1': buffer.Dimension(data[0])}))
+        s.fit(0, model, parameters=p)
+        s.confidence_interval('slope', workers=1)
+        s.confidence_interval('slope', workers=1, prob=0.9)
+        s.confidence_interval('slope', workers=1, method='least_squares')
+        profiles = s.get_nth_result(-1)[0].profiles
+        self.assertEqual(sorted(key for key, _ in profiles),
+                         ['slope', 'slope'])
+        self.assertEqual(len(profiles), 2)
+
+    def test_bootstrap(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.linear
+        data, x, p = benchmarks.make_global_problem(2, model, npoints=50)
+        result = fit.fit(data, x, model, p)[0]
+
+        replicates = fit.bootstrap_replicates(result, data, 4, seed=3)
+        self.assertEqual(replicates.shape, (4,) + data.shape)
+        self.assertTrue(np.array_equal(
+            replicates, fit.bootstrap_replicates(result, data, 4, seed=3)))
+
+        # for a linear model the spread of the replicates matches the
+        # standard errors of the fit
+        names, samples, seconds = fit.bootstrap(result, data, x, model,
+                                                nreplicates=200,
+                                                resample='noise', workers=2)
+        self.assertEqual(samples.shape, (200, len(names)))
+        spread = samples.std(axis=0)
+        stderr = [result.params[name].stderr for name in names]
+        self.assertTrue(np.allclose(spread, stderr, rtol=0.25))
+
+        lower, upper = fit.percentile_intervals(samples)
+        values = [result.params[name].value for name in names]
+        self.assertTrue(np.all((lower < values) & (values < upper)))
+
+    def test_fit_stats(self):
+        from src import benchmarks
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(3, model, npoints=30)
+        result = fit.fit(data, x, model, p)[0]
+        stats = result.stats
+        self.assertGreaterEqual(stats.ncalls, result.nfev)
+        # leastsq's finite difference Jacobians, one call per free parameter
+        self.assertGreater(stats.njev, 0)
+        self.assertGreater(stats.ncalls, stats.njev * result.nvarys)
+        self.assertIsNone(stats.jacobians)
+        self.assertTrue(0 < stats.model_seconds < stats.objective_seconds
+                        < stats.wall_seconds)
+        self.assertGreater(stats.parameter_seconds, 0)
+        self.assertEqual(len(stats.report()), 8)
+        self.assertTrue(stats.report()[-1].startswith('datasets reused'))
+
+        sparse = fit.fit(data, x, model, p, method='least_squares')[0]
+        self.assertGreater(sparse.stats.njev, 0)
+
+    def test_fit_budget(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(3, model, npoints=30)
+        full = fit.fit(data, x, model, p)[0]
+        self.assertIsNone(getattr(full, 'stopped', None))
+
+        for method in ('leastsq', 'nelder', 'least_squares'):
+            result = fit.fit(data, x, model, p, method=method, max_nfev=5)[0]
+            self.assertFalse(result.success)
+            self.assertIn('5 function evaluations', result.stopped)
+            # the statistics are those of the parameters kept
+            resid = fit.objective(result.params, x, data, model,
+                                  fit.ParameterLayout(result.params, 3))
+            self.assertAlmostEqual(result.chisqr, np.dot(resid, resid))
+            self.assertGreater(result.chisqr, full.chisqr)
+
+        bounded = benchmarks.make_global_problem(1, model, npoints=30)[2]
+        for par in bounded.values():
+            par.set(min=0.1, max=5.0)
+        result = fit.fit(data[[0]], x, model, bounded,
+                         method='differential_evolution', max_time=0.01)[0]
+        self.assertEqual(result.stopped, '0.01 seconds')
+
+        # Ctrl-C keeps the best parameters found before it
+        calls = []
+
+        def interrupted(x, amp=1.0, cen=1.0, wid=1.0):
+            calls.append(1)
+            if len(calls) == 40:
+                raise KeyboardInterrupt
+            return model(x, amp, cen, wid)
+
+        # every call of the objective calls the model for every buffer
+        result = fit.fit(data, x, interrupted, p, memoize=False)[0]
+        self.assertEqual(result.stopped, 'being interrupted')
+        self.assertLess(result.chisqr, fit.fit(data, x, model, p,
+                                               max_nfev=1)[0].chisqr)
+
+    def test_fit_cache(self):
+        from src import benchmarks
+        import tempfile
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(2, model, npoints=30)
+        directory = tempfile.mkdtemp()
+        old_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = directory
+        try:
+            first = fit.fit(data, x, model, p, cache=True)[0]
+            self.assertFalse(getattr(first, 'cached', False))
+            again = fit.fit(data, x, model, p, cache=True)[0]
+            self.assertTrue(again.cached)
+            self.assertEqual(again.chisqr, first.chisqr)
+            self.assertEqual(len(cache.entries()), 1)
+
+            # any change to the parameters, data or options is a new fit
+            key = cache.fit_key(data, x, model, p, {})
+            p['wid_1'].max = 10.0
+            self.assertNotEqual(key, cache.fit_key(data, x, model, p, {}))
+            self.assertNotEqual(key, cache.fit_key(data + 1, x, model, p, {}))
+            fit.fit(data, x, model, p, cache=True, method='least_squares')
+            self.assertEqual(len(cache.entries()), 2)
+
+            # the least recently used result goes first
+            size = cache.entries()[0][1]
+            self.assertEqual(cache.evict(max_bytes=size), 1)
+            self.assertTrue(fit.fit(data, x, model, p, cache=True,
+                                    method='least_squares')[0].cached)
+            self.assertEqual(cache.clear(), 1)
+        finally:
+            cache.CACHE_DIR = old_dir
+
+        # so is any change to the code the model calls
+        self.assertIn(models.exponentials,
+                      cache.dependencies(models.two_exponential))
+        import importlib.util
+        import linecache
+        import os
+        path = os.path.join(directory, 'cache_test_model.py')
+
+        def load(helper):
+            with open(path, 'w') as f:
+                f.write("def helper(x):\n    return {0}\n\n\n"
+                        "def model(x, a=1.0):\n    return a * helper(x)\n"
+                        "".format(helper))
+            spec = importlib.util.spec_from_file_location('cache_test_model',
+                                                          path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            return module.model
+
+        key = cache.fit_key(data, x, load('x'), p, {})
+        linecache.clearcache()
+        self.assertNotEqual(key, cache.fit_key(data, x, load('2 * x'), p, {}))
+
+    def test_fit_checkpoint(self):
+        from src import benchmarks
+        from src import checkpoint
+        import tempfile
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(2, model, npoints=30)
+        full = fit.fit(data, x, model, p)[0]
+        old_dir = checkpoint.CHECKPOINT_DIR
+        checkpoint.CHECKPOINT_DIR = tempfile.mkdtemp()
+        try:
+            stopped = fit.fit(data, x, model, p, checkpoint=True,
+                              checkpoint_every=0, max_nfev=15)[0]
+            self.assertTrue(stopped.stopped)
+            saved = checkpoint.load(stopped.checkpoint[:8])
+            self.assertEqual(saved.key, stopped.checkpoint)
+            self.assertGreaterEqual(saved.nfev, 15)
+
+            # picks up from the best parameters, and cleans up once done
+            result = fit.resume_fit(max_nfev=None)[0]
+            self.assertTrue(result.success)
+            self.assertAlmostEqual(result.chisqr / full.chisqr, 1.0)
+            self.assertGreater(result.nfev, saved.nfev)
+            self.assertEqual(checkpoint.entries(), [])
+            self.assertRaises(ValueError, fit.resume_fit)
+
+            # differential_evolution continues from its population
+            for par in p.values():
+                par.set(min=-5.0, max=5.0)
+            fit.fit(data, x, model, p, method='differential_evolution',
+                    seed=0, checkpoint=True, checkpoint_every=0,
+                    max_nfev=200)
+            saved = checkpoint.load()
+            self.assertEqual(saved.population.shape[1], len(saved.best))
+            result = fit.resume_fit(max_nfev=None)[0]
+            self.assertLess(result.redchi, 1.1 * full.redchi)
+        finally:
+            checkpoint.CHECKPOINT_DIR = old_dir
+
+    def test_batch_fit(self):
+        from src import batch
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        problems = []
+        for seed in range(12):
+            # two lengths of buffer, fit in two stacks
+            npoints = 30 if seed % 2 else 40
+            data, x, p = benchmarks.make_global_problem(1, model, npoints,
+                                                        seed=seed)
+            problems.append((data * (1 + 0.05 * seed), x))
+        for par in p.values():
+            par.value *= 1.3
+        p['wid_0'].min = 0.05
+        p['cen_0'].vary = False
+
+        fits = batch.batch_fit(problems, model, p)
+        self.assertEqual(len(fits), len(problems))
+        for (result, data, x, _), (y, xi) in zip(fits, problems):
+            self.assertIs(data, y)
+            single = fit.fit(y, xi, model, p)[0]
+            self.assertTrue(result.success)
+            self.assertEqual(result.var_names, single.var_names)
+            for name in p:
+                self.assertAlmostEqual(result.params[name].value,
+                                       single.params[name].value, places=5)
+            self.assertAlmostEqual(result.params['amp_0'].stderr,
+                                   single.params['amp_0'].stderr, places=5)
+            self.assertAlmostEqual(result.chisqr, single.chisqr)
+
+        # linked parameters can't be fit in a batch
+        linked = benchmarks.make_global_problem(2, model)[2]
+        self.assertFalse(batch.batchable(model, linked))
+        self.assertRaises(ValueError, batch.batch_fit, problems, model,
+                          linked)
+
+    def test_incremental_fit(self):
+        from src import benchmarks
+        import numpy as np
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(1, model, npoints=300)
+        for par in p.values():
+            par.value *= 1.2
+        full = fit.fit(data, x, model, p)[0]
+
+        incremental = fit.IncrementalFit(model, p, capacity=16)
+        for start in range(0, 300, 60):
+            incremental.append(x[start:start + 60], data[0, start:start + 60])
+            result = incremental.refit()
+            self.assertEqual(result.ndata, start + 60)
+            if start:  # later refits start from the last, so are short
+                self.assertLessEqual(result.nfev,
+                                     incremental.max_nfev + 1)
+        np.testing.assert_array_equal(incremental.x, x)
+        for name in p:
+            self.assertAlmostEqual(result.params[name].value,
+                                   full.params[name].value, places=4)
+
+        # a refit stopped by max_nfev keeps the best parameters it saw, so
+        # it never ends worse than where it started
+        capped = fit.IncrementalFit(model, p, max_nfev=6)
+        for start in range(0, 300, 60):
+            capped.append(x[start:start + 60], data[0, start:start + 60])
+            before = np.sum(fit.objective(params.deep_copy(capped.parameters),
+                                          capped.x, capped.data, model,
+                                          capped.layout) ** 2)
+            refit = capped.refit()
+            if start:
+                self.assertEqual(refit.stopped, "6 function evaluations")
+                self.assertLessEqual(refit.chisqr, before)
+
+        series = incremental.series('cen_0')
+        np.testing.assert_array_equal(series['npoints'],
+                                      [60, 120, 180, 240, 300])
+        self.assertEqual(series['value'][-1], result.params['cen_0'].value)
+        self.assertEqual(series['x'][-1], x[-1])
+
+        # points appended to a buffer refit its incremental fit
+        s = savuka.Savuka()
+        s.data.append(buffer.Buffer({'dim0': buffer.Dimension(x[:100]),
+                                     'dim1': buffer.Dimension(data[0, :100])}))
+        s.start_incremental_fit(0, model, p)
+        result = s.append_points(0, x[100:], data[0, 100:])
+        self.assertEqual(len(s.get_xs(0)), 300)
+        self.assertEqual(result.ndata, 300)
+        self.assertEqual(len(s.incremental_fits[0].history), 2)
+
+    def test_fit_options(self):
+        from src import benchmarks
+        import contextlib
+        import io
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(2, model, npoints=60)
+        s = savuka.Savuka()
+        for y in data:
+            s.data.append(buffer.Buffer({'dim0': buffer.Dimension(x),
+                                         'dim1': buffer.Dimension(y)}))
+
+        # options of how a fit is run that don't apply are ignored, with a
+        # message, rather than passed on to the minimizer
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            s.fit((0, 1), model, parameters=p, workers=2)
+        self.assertIn("-workers only applies", out.getvalue())
+        self.assertEqual(len(s.fit_results[0]), 1)
+        self.assertTrue(s.get_nth_result(-1)[0].success)
+        for idx in (0, (0, 1)):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                s.fit(idx, model, parameters=p, batch=True)
+            self.assertIn("-batch only applies", out.getvalue())
+        self.assertEqual(len(s.fit_results[0]), 3)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            s.fit((0, 1), model, parameters=p, incremental=20)
+        self.assertIn("-incremental only applies", out.getvalue())
+        self.assertEqual(len(s.fit_results[0]), 3)
+
+    def test_shared_parameters(self):
+        from src import benchmarks
+        from lmfit import minimize
+
+        model = models.gaussian_1d
+        data, x, p = benchmarks.make_global_problem(4, model, npoints=30)
+        p['cen_2'].expr = 'cen_1'
+        p['cen_3'].expr = 'cen_2'  # a chain, ending at cen_1
+        p['wid_3'].set(expr='wid_0', min=0.0, max=2.0)  # its own bounds
+        p['wid_2'].expr = '2 * wid_1'
+        p['wid_1'].expr = 'wid_0'  # used by wid_2's expr
+
+        reduced, aliases = fit.collapse_aliases(p)
+        self.assertEqual(aliases, {'amp_1': 'amp_0', 'amp_2': 'amp_0',
+                                   'amp_3': 'amp_0', 'cen_2': 'cen_1',
+                                   'cen_3': 'cen_1'})
+        self.assertNotIn('amp_1', reduced)
+        self.assertEqual(reduced['wid_2'].expr, '2 * wid_1')
+
+        # the model of each buffer gets the value of the shared parameter
+        layout = fit.ParameterLayout(reduced, 4, aliases=aliases)
+        values = layout.values(reduced)
+        self.assertEqual(layout.arguments(values, 3)['cen'],
+                         reduced['cen_1'].value)
+
+        for par in p.values():
+            par.value *= 1.1
+        result = fit.fit(data, x, model, p)[0]
+        self.assertEqual(list(result.params), list(p))
+        self.assertEqual(result.params['cen_3'].value,
+                         result.params['cen_1'].value)
+        self.assertEqual(result.params['cen_3'].stderr,
+                         result.params['cen_1'].stderr)
+        self.assertEqual(result.params['cen_3'].expr, 'cen_2')
+
+        # the same fit as with every link left to lmfit
+        full = fit.ParameterLayout(p, 4)
+        linked = minimize(fit.objective, p, args=(x, data, model, full))
+        self.assertAlmostEqual(result.chisqr, linked.chisqr)
+        self.assertEqual(result.nvarys, linked.nvarys)
+
+    def test_compare_models(self):
+        from src import benchmarks
+
+        data, x, p = benchmarks.make_global_problem(2, models.gaussian_1d,
+                                                    npoints=50)
+        streamed = []
+        fits = fit.compare_models(data, x, ['linear', 'gauss'], workers=2,
+                                  on_result=streamed.append)
+        self.assertEqual([f[3].__name__ for f in fits],
+                         ['gaussian_1d', 'linear'])
+        self.assertLess(fits[0][0].aic, fits[1][0].aic)
+        # the ranking was shown after each fit finished
+        self.assertEqual([len(ranking) for ranking in streamed], [1, 2])
+        self.assertEqual(list(fits[1][0].params),
+                         ['intercept_0', 'slope_0', 'intercept_1',
+                          'slope_1'])
+
+        table = fit.ranking_table(fits, 'bic')
+        self.assertEqual(len(table), 3)
+        self.assertIn('gaussian_1d', table[1])
+        self.assertRaises(ValueError, fit.rank_fits, fits, 'chisqr')
+
+        # failed fits rank last
+        failed = (fit.failed_result(p, "error"), data, x, models.linear)
+        self.assertIs(fit.rank_fits([failed] + fits)[-1], failed)
+
+    def test_user_models(self):
+        from src import expressions
+        from lmfit import Parameters
+        import numpy as np
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        model = models.add_user_model('test_decay', 'a*exp(-k*x) + c',
+                                      ['tdecay'], directory)
+        try:
+            self.assertIs(models.get_models('tdecay'), model)
+            self.assertEqual(list(params.create_default_params(model)),
+                             ['a', 'k', 'c'])
+            x = np.linspace(0.0, 5.0, 50)
+            expected = 2.0 * np.exp(-0.5 * x) + 0.1
+            np.testing.assert_allclose(model(x, 2.0, 0.5, 0.1), expected)
+
+            # broadcasts over datasets, into out
+            out = np.empty((2, 50))
+            model(x, np.array([[2.0], [1.0]]), 0.5, 0.1, out=out)
+            np.testing.assert_allclose(out[0], expected)
+
+            p = Parameters()
+            p.add('a_0', 1.5)
+            p.add('k_0', 1.0)
+            p.add('c_0', 0.0)
+            result = fit.fit(np.asarray([expected]), x, model, p)[0]
+            self.assertAlmostEqual(result.params['k_0'].value, 0.5)
+
+            # kept for the next session
+            models.remove_user_model('test_decay')
+            self.assertRaises(IndexError, models.get_models, 'tdecay')
+            models.load_user_models(directory)
+            self.assertIn('test_decay', models.USER_MODELS)
+        finally:
+            models.remove_user_model('test_decay', directory)
+
+        # repeated subexpressions are calculated once
+        source = expressions.model_source('m', 'exp(-k*x) + b*exp(-k*x)')
+        self.assertEqual(source.count('np.exp('), 1)
+        for bad in ('__import__("os")', 'x.real', 'a +', 'open(x)',
+                    'out * x', '1/0'):
+            self.assertRaises(ValueError, expressions.model_source, 'm', bad)
+        self.assertRaises(ValueError, models.add_user_model, 'gauss', 'x',
+                          (), directory)
+
+    def test_reconvolved_model(self):
+        import numpy as np
+
+        x = np.linspace(0.0, 50.0, 512)
+        irf = np.exp(-0.5 * ((x - 3.0) / 0.4) ** 2)
+        model = models.add_reconvolved_model('exp2', x, irf,
+                                             aliases=['test_exp2_irf'])
+        try:
+            self.assertIs(models.get_models('test_exp2_irf'), model)
+            self.assertIn('shift', models.default_values(model))
+            self.assertTrue(models.broadcasts(model))
+
+            # the same as convolving directly, plus the offset
+            decay = models.two_exponential(x, 1.5, 8.0, 2.0, 1.0)
+            direct = np.convolve(irf / irf.sum(), decay)[:len(x)] + 0.3
+            y = model(x, tau1=1.5, tau2=8.0, amp1=2.0, amp2=1.0, offset=0.3)
+            self.assertTrue(np.allclose(y, direct))
+            shifted = model(x, tau1=1.5, tau2=8.0, amp1=2.0, amp2=1.0,
+                            offset=0.3, shift=2 * (x[1] - x[0]))
+            self.assertTrue(np.allclose(shifted[2:], direct[:-2]))
+
+            # a global fit with lifetimes shared between buffers
+            rng = np.random.RandomState(0)
+            amps = [2.0, 1.0, 0.5]
+            data = np.asarray([model(x, tau1=1.5, tau2=8.0, amp1=a,
+                                     amp2=1.0, offset=0.1) for a in amps])
+            data += rng.normal(0.0, 0.002, data.shape)
+            p = params.default_parameters(3, model)
+            for i in (1, 2):
+                p['tau1_{0}'.format(i)].expr = 'tau1_0'
+                p['tau2_{0}'.format(i)].expr = 'tau2_0'
+            p['tau1_0'].min = p['tau2_0'].min = 0.05
+            for varpro in (False, True):
+                result = fit.fit(data, x, 'test_exp2_irf', p,
+                                 varpro=varpro)[0]
+                self.assertAlmostEqual(result.params['tau1_0'].value, 1.5,
+                                       places=1)
+                self.assertAlmostEqual(result.params['tau2_0'].value, 8.0,
+                                       places=1)
+                self.assertAlmostEqual(result.params['amp1_2'].value, 0.5,
+                                       places=2)
+
+            self.assertRaises(ValueError, model, x ** 2)
+
+            # pickled as its recipe, so spawned worker processes have it
+            import pickle
+            self.assertIs(pickle.loads(pickle.dumps(model)), model)
+            unregistered = models.reconvolved_model(models.one_exponential,
+                                                    x, irf)
+            copy = pickle.loads(pickle.dumps(unregistered))
+            self.assertTrue(np.array_equal(copy(x), unregistered(x)))
+            self.assertNotIn(copy.__name__, models.MODELS)
+            self.assertSpawnedFits(data, x, model, p)
+
+            # a session model has to say how to make it again
+            class NoRecipe(models.SessionModel):
+                pass
+            self.assertRaises(TypeError, NoRecipe)
+        finally:
+            models.unregister_model(model.__name__)
+
+    def assertSpawnedFits(self, data, x, model, p):
+        """Fit data in a pool of processes started by spawn, as on Windows
+        and macOS, which have to rebuild the model when they unpickle it."""
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(2, mp_context=context) as pool:
+            futures = [pool.submit(fit.fit_worker, data, x, model, p, {})
+                       for _ in range(2)]
+            for future in futures:
+                result, _, _, returned = future.result()
+                self.assertFalse(getattr(result, 'aborted', False),
+                                 getattr(result, 'message', ''))
+                self.assertTrue(result.success)
+                self.assertIs(returned, model)
+
+    def test_mechanism_model(self):
+        import numpy as np
+        from scipy.linalg import expm
+        from src import kinetics
+
+        self.assertRaises(ValueError, kinetics.parse, 'A B')
+        self.assertRaises(ValueError, kinetics.parse, 'A -> A')
+        self.assertRaises(ValueError, kinetics.parse, 'A -> B; A -> B')
+        mechanism = kinetics.parse('A <=> B -> C')
+        self.assertEqual(mechanism.species, ['A', 'B', 'C'])
+        self.assertEqual(mechanism.rates, ['k1', 'km1', 'k2'])
+
+        x = np.linspace(0.0, 10.0, 200)
+        model = models.add_mechanism_model('A <=> B -> C', 'test_abc',
+                                           aliases=['test_abc_alias'])
+        try:
+            self.assertIs(models.get_models('test_abc_alias'), model)
+            self.assertEqual(models.linear_parameters(model),
+                             ['amp_A', 'amp_B', 'amp_C', 'offset'])
+
+            # the same as the matrix exponential of the rate matrix
+            kwargs = dict(k1=2.0, km1=0.5, k2=0.7, amp_A=1.0, amp_B=3.0,
+                          amp_C=-1.0, offset=0.2)
+            matrix = mechanism.rate_matrix([2.0, 0.5, 0.7])
+            expected = np.asarray([expm(matrix * t)[:, 0] for t in x])
+            self.assertTrue(np.allclose(model(x, **kwargs),
+                                        expected @ [1.0, 3.0, -1.0] + 0.2))
+
+            # decomposed once, while only the amplitudes change
+            misses = model._decompositions.misses
+            model(x, **dict(kwargs, amp_B=5.0))
+            self.assertEqual(model._decompositions.misses, misses)
+
+            # equal rates, which can't be diagonalized, and a cycle
+            sequential = kinetics.mechanism_model('A -> B -> C', 'test_seq')
+            self.assertTrue(np.allclose(
+                sequential(x, k1=1.0, k2=1.0, amp_A=0.0, amp_B=1.0),
+                x * np.exp(-x), atol=1e-7))
+            # smooth through equal rates: d[B]/dk2 = -t^2 exp(-t) / 2 there
+            step = 1.49e-8
+            t = np.asarray([2.0])
+            derivative = (sequential(t, k1=1.0, k2=1.0 + step, amp_A=0.0,
+                                     amp_B=1.0) -
+                          sequential(t, k1=1.0, k2=1.0, amp_A=0.0,
+                                     amp_B=1.0)) / step
+            self.assertAlmostEqual(derivative[0], -2.0 * np.exp(-2.0),
+                                   places=5)
+            cycle = kinetics.mechanism_model('A -> B -> C -> A', 'test_cyc')
+            matrix = cycle.mechanism.rate_matrix([3.0, 3.0, 3.0])
+            self.assertTrue(np.allclose(
+                cycle(x, k1=3.0, k2=3.0, k3=3.0),
+                [expm(matrix * t)[0, 0] for t in x]))
+
+            # broadcasting matches evaluating each dataset
+            k1 = np.asarray([[1.0], [2.0], [3.0]])
+            amp_B = np.asarray([[1.0], [2.0], [3.0]])
+            each = [model(x, k1=k1[i, 0], amp_B=amp_B[i, 0])
+                    for i in range(3)]
+            self.assertTrue(np.allclose(model(x, k1=k1, amp_B=amp_B), each))
+
+            # a global fit with rate constants shared between buffers
+            rng = np.random.RandomState(0)
+            data = np.asarray([model(x, k1=2.0, km1=0.5, k2=0.7, amp_A=0.2,
+                                     amp_B=a, amp_C=0.1)
+                               for a in (1.0, 2.0, 0.5)])
+            data += rng.normal(0.0, 0.002, data.shape)
+            p = params.default_parameters(3, model)
+            for rate in mechanism.rates:
+                # rate constants can't be negative, and start out bounded
+                self.assertEqual(p[rate + '_0'].min, 0.0)
+                for i in (1, 2):
+                    p['{0}_{1}'.format(rate, i)].expr = rate + '_0'
+            for varpro in (False, True):
+                result = fit.fit(data, x, 'test_abc', p, varpro=varpro)[0]
+                self.assertLess(result.redchi, 1.5 * 0.002 ** 2)
+
+            # a fit started from equal rate constants
+            seq_model = models.add_mechanism_model('A -> B -> C',
+                                                   'test_seq_fit')
+            seq = np.asarray([sequential(x, k1=2.0, k2=0.7, amp_A=0.2,
+                                         amp_B=1.0, amp_C=0.4)])
+            seq += rng.normal(0.0, 0.002, seq.shape)
+            start = params.default_parameters(1, seq_model)
+            for rate in ('k1_0', 'k2_0'):
+                start[rate].value = 1.0
+            result = fit.fit(seq, x, 'test_seq_fit', start, varpro=True)[0]
+            self.assertLess(result.redchi, 1.5 * 0.002 ** 2)
+            np.testing.assert_allclose(sorted([
+                result.params['k1_0'].value, result.params['k2_0'].value]),
+                [0.7, 2.0], rtol=0.05)
+
+            # pickled as its scheme, so spawned worker processes have it
+            import pickle
+            self.assertIs(pickle.loads(pickle.dumps(model)), model)
+            copy = pickle.loads(pickle.dumps(sequential))
+            self.assertEqual(copy.scheme, 'A -> B -> C')
+            self.assertNotIn('test_seq', models.MODELS)
+            self.assertSpawnedFits(data, x, model, p)
+        finally:
+            models.unregister_model(model.__name__)
+            models.unregister_model('test_seq_fit')
+
+    def test_model_plugins(self):
+        import numpy as np
+        import os
+        import sys
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'decays.py'), 'w') as f:
+            f.write("import numpy as np\n"
+                    "MODELS = {'plugin_decay': ['plugin_decay', 'pdecay']}\n"
+                    "BROADCASTABLE = {'plugin_decay'}\n"
+                    "def plugin_decay(x, a=1.0, k=2.0):\n"
+                    "    return a * np.exp(-k * x)\n")
+        try:
+            # found without being imported
+            models.load_plugins(directory)
+            self.assertEqual(models.ALIASES['pdecay'], 'plugin_decay')
+            self.assertNotIn('pysavuka_plugin_decays', sys.modules)
+
+            model = models.get_models('pdecay')
+            self.assertIn('pysavuka_plugin_decays', sys.modules)
+            self.assertIs(models.get_models('plugin_decay'), model)
+            self.assertIs(models.plugin_decay, model)
+            self.assertTrue(models.broadcasts(model))
+            self.assertFalse(models.writes_out(model))
+            self.assertEqual(models.default_values(model),
+                             {'a': 1.0, 'k': 2.0})
+
+            x = np.linspace(0.0, 1.0, 20)
+            p = params.default_parameters(1, model)
+            data = np.asarray([model(x, 3.0, 1.5)])
+            result = fit.fit(data, x, 'pdecay', p)[0]
+            self.assertAlmostEqual(result.params['k_0'].value, 1.5)
+
+            # a plugin can't take the name of a built-in model
+            self.assertFalse(models.register_lazy_model('linear', [], None))
+        finally:
+            models.unregister_model('plugin_decay')
+            sys.modules.pop('pysavuka_plugin_decays', None)
+        self.assertRaises(IndexError, models.get_models, 'pdecay')
+
     def debug_parse_funcs(self):
         s = savuka.Savuka()
         s.read(self.xyexample1, 'example')
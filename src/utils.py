@@ -223,6 +223,25 @@ def parse_options(line):
     return args, kwargs
 
 
+def unpack_options(kwargs):
+    """parse_options gives a list of values for each option. Return a new
+    dictionary where options given exactly one value map to that value, and
+    options given no values map to True.
+    E.g.
+    {'method': ['nelder'], 'debug': [], 'range': [0, 1]}
+    -> {'method': 'nelder', 'debug': True, 'range': [0, 1]}
+    """
+    unpacked = {}
+    for opt, vals in kwargs.items():
+        if isinstance(vals, list) and len(vals) == 1:
+            unpacked[opt] = vals[0]
+        elif isinstance(vals, list) and not vals:
+            unpacked[opt] = True
+        else:
+            unpacked[opt] = vals
+    return unpacked
+
+
 def name_scheme_match(name, idx):
     """True if the name matches '_idx' exactly, otherwise false."""
     return (re.match('.*(?<=_){0}'.format(idx), name) is not None and not